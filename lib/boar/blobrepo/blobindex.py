@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+The blob index is a cache of all the blobs in a repository, their
+kind (raw or recipe) and their size. It lets the repository answer
+has_blob() and get_blob_size() from memory instead of probing the
+file system for every file in a commit. The index contains nothing
+that can not be regenerated from the "blobs" and "recipes"
+directories.
+
+The index file starts with a header (magic string and version),
+followed by fixed size records. Records are only ever appended. A
+record is either a blob record or a sync record. A sync record states
+that every blob referenced by the snapshots up to and including the
+given session id has been recorded in the index. A trailing partial
+record (from an interrupted append) is ignored.
+"""
+
+import os
+import struct
+import binascii
+
+from common import replace_file
+
+INDEX_MAGIC = "BOARBIDX"
+INDEX_VERSION = 1
+HEADER_FORMAT = "!8sI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = "!B16sQ"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+KIND_SYNC = 0
+KIND_RAW = 1
+KIND_RECIPE = 2
+
+NULL_DIGEST = "\0" * 16
+
+def pack_record(kind, blobname, size):
+    if kind == KIND_SYNC:
+        digest = NULL_DIGEST
+    else:
+        digest = binascii.unhexlify(blobname)
+    return struct.pack(RECORD_FORMAT, kind, digest, size)
+
+def write_index(path, entries, synced_session):
+    """Writes a complete new index file at the given path. The
+    'entries' argument must be a sequence of (kind, blobname, size)
+    tuples. Any existing index at the path is atomically replaced."""
+    tmp_path = path + ".new"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION))
+        for kind, blobname, size in entries:
+            f.write(pack_record(kind, blobname, size))
+        f.write(pack_record(KIND_SYNC, None, synced_session))
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(tmp_path, path)
+
+class BlobIndex:
+    def __init__(self, path):
+        self.path = path
+        # { digest: size, ... }, digests in binary form to save memory
+        self.raw = {}
+        self.recipes = {}
+        self.synced_session = None
+        self.loaded_size = 0
+        self.loaded_inode = None
+        # The last complete record that was read
+        self.last_record = None
+        self.refresh()
+
+    def exists(self):
+        return self.loaded_size > 0
+
+    def get_synced_session(self):
+        """Returns the session id up to which the index is known to be
+        complete, or None if there is no valid index."""
+        return self.synced_session
+
+    def refresh(self):
+        """Reads any records that has been appended to the index file
+        since it was last read, possibly by another process. Returns
+        True if anything new was read."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self.__clear()
+            return False
+        current_size = st.st_size
+        if current_size < self.loaded_size or st.st_ino != self.loaded_inode:
+            # Index has been rebuilt
+            self.__clear()
+            self.loaded_inode = st.st_ino
+        if current_size == self.loaded_size:
+            return False
+        with open(self.path, "rb") as f:
+            if self.last_record:
+                f.seek(self.loaded_size - RECORD_SIZE)
+                if f.read(RECORD_SIZE) != self.last_record:
+                    # Rebuilt, and the new file got the inode of the old one
+                    self.__clear()
+                    self.loaded_inode = st.st_ino
+                    f.seek(0)
+            if self.loaded_size == 0:
+                header = f.read(HEADER_SIZE)
+                if len(header) != HEADER_SIZE or \
+                        struct.unpack(HEADER_FORMAT, header) != (INDEX_MAGIC, INDEX_VERSION):
+                    # Unknown format - treat as missing
+                    return False
+                self.loaded_size = HEADER_SIZE
+            f.seek(self.loaded_size)
+            data = f.read(current_size - self.loaded_size)
+        complete_size = len(data) - (len(data) % RECORD_SIZE)
+        unpack = struct.unpack_from
+        for pos in xrange(0, complete_size, RECORD_SIZE):
+            kind, digest, size = unpack(RECORD_FORMAT, data, pos)
+            if kind == KIND_RAW:
+                self.raw[digest] = size
+            elif kind == KIND_RECIPE:
+                self.recipes[digest] = size
+            elif kind == KIND_SYNC:
+                self.synced_session = size
+        self.loaded_size += complete_size
+        if complete_size:
+            self.last_record = data[complete_size - RECORD_SIZE:complete_size]
+        return True
+
+    def __clear(self):
+        self.raw = {}
+        self.recipes = {}
+        self.synced_session = None
+        self.loaded_size = 0
+        self.loaded_inode = None
+        self.last_record = None
+
+    def has_raw(self, blobname):
+        return binascii.unhexlify(blobname) in self.raw
+
+    def has_recipe(self, blobname):
+        return binascii.unhexlify(blobname) in self.recipes
+
+    def get_size(self, blobname):
+        """Returns the size of the given blob, or None if the blob is
+        not in the index."""
+        digest = binascii.unhexlify(blobname)
+        size = self.raw.get(digest, None)
+        if size == None:
+            size = self.recipes.get(digest, None)
+        return size
+
+    def iter_raw_names(self):
+        # keys() returns a copy, so refreshes during iteration are safe
+        for digest in self.raw.keys():
+            yield binascii.hexlify(digest)
+
+    def iter_recipe_names(self):
+        for digest in self.recipes.keys():
+            yield binascii.hexlify(digest)
+
+    def add_blobs(self, entries, synced_session):
+        """Appends the given (kind, blobname, size) entries to the
+        index, followed by a sync record for the given session
+        id. Must only be called while holding the repository lock."""
+        assert self.exists(), "Can not append to a missing index"
+        self.refresh()
+        records = [pack_record(kind, blobname, size) for kind, blobname, size in entries]
+        records.append(pack_record(KIND_SYNC, None, synced_session))
+        with open(self.path, "r+b") as f:
+            # Discard any partial record from an interrupted append
+            f.truncate(self.loaded_size)
+            f.seek(self.loaded_size)
+            f.write("".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        self.refresh()
+        assert self.synced_session == synced_session
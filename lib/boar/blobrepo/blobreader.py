@@ -1,4 +1,9 @@
+import os
+import bisect
+
 from common import *
+from jsonrpc import DataSource
+from zblob import ZBlobReader
 
 """ A recipe has the following format:
 
@@ -23,59 +28,131 @@ def create_blob_reader(recipe, repo):
     assert recipe
     return RecipeReader(recipe, repo)
 
+class FileHandleCache:
+    """Keeps the most recently used files open, so that reading many
+    small pieces of the same file does not open it every time."""
+    def __init__(self, max_handles = 16):
+        self.max_handles = max_handles
+        self.handles = {} # { path: file object }
+        self.order = [] # Least recently used first
+
+    def get(self, path, opener = None):
+        """Returns an open file object for the given path. The opener,
+        if given, is called with the path to open it instead of
+        open()."""
+        if path in self.handles:
+            if self.order[-1] != path:
+                self.order.remove(path)
+                self.order.append(path)
+            return self.handles[path]
+        if len(self.order) >= self.max_handles:
+            self.handles.pop(self.order.pop(0)).close()
+        if opener:
+            f = opener(path)
+        else:
+            f = open(path, "rb")
+        self.handles[path] = f
+        self.order.append(path)
+        return f
+
+    def close(self):
+        for f in self.handles.values():
+            f.close()
+        self.handles = {}
+        self.order = []
+
 class RecipeReader:
     def __init__(self, recipe, repo):
         self.repo = repo
         self.pieces = recipe['pieces']
         self.size = recipe['size']
-        # Where it is safe to read without switching source (virtual position)
-        self.blob_source_range_start = 0
-        self.source = None
-        self.source_offset = 0
-        self.source_size = 0
+        # The position in the blob where each piece starts
+        self.piece_starts = []
+        offset = 0
+        for p in self.pieces:
+            assert is_md5sum(p["source"])
+            self.piece_starts.append(offset)
+            offset += p["size"]
+        assert offset == self.size, "Recipe pieces do not add up to the blob size"
+        self.files = FileHandleCache()
+        # { source blob: (path, offset, opener) }
+        self.locations = {}
+        self.piece_index = None
         self.pos = 0
         self.seek(0)
 
-    def seek(self, pos):
-        offset = 0
-        if pos > self.size:
+    def seek(self, pos, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        if pos < 0 or pos > self.size:
             raise Exception("Illegal position %s" % (pos))
+        self.pos = pos
         if pos == self.size:
-            self.pos = pos
-            self.source = None
+            self.piece_index = None
             return
-        for p in self.pieces:
-            self.source = p["source"]
-            self.blob_source_range_start = offset
-            self.source_offset = p["offset"]
-            self.source_size = p["size"]
-            if offset + p["size"] > pos:
-                self.pos = pos
-                break
-            offset += self.source_size
-        assert self.pos == pos
-        assert self.source
-        assert is_md5sum(self.source)
-
-    def __readable_bytes_without_seek(self):
-        pos_from_source_start = self.pos - self.blob_source_range_start
-        readable = self.source_size - pos_from_source_start
-        return readable
-
-    def read(self, readsize, pos = None):
+        # The last piece starting at or before pos. Empty pieces are
+        # skipped, as the piece after them starts at the same position.
+        self.piece_index = bisect.bisect_right(self.piece_starts, pos) - 1
+
+    def tell(self):
+        return self.pos
+
+    def read(self, readsize = -1, pos = None):
         if pos != None:
             self.seek(pos)
+        if readsize < 0:
+            readsize = self.size - self.pos
         readsize = min(readsize, self.size - self.pos)
-        result = ""
-        while len(result) < readsize:
-            blobpath = self.repo.get_blob_path(self.source)
-            bytes_left = readsize - len(result)
-            bytes_to_read = min(self.__readable_bytes_without_seek(), bytes_left)
-            with open(blobpath, "rb") as f:
-                f.seek(self.pos - self.blob_source_range_start)
-                bytes = f.read(bytes_to_read)
-            assert len(bytes) == bytes_to_read
-            result += bytes
-            self.seek(self.pos + len(bytes))
-        assert readsize == len(result)
-        return result
+        result = bytearray(readsize)
+        view = memoryview(result)
+        filled = 0
+        while filled < readsize:
+            piece = self.pieces[self.piece_index]
+            pos_in_piece = self.pos - self.piece_starts[self.piece_index]
+            bytes_to_read = min(piece["size"] - pos_in_piece, readsize - filled)
+            location = self.locations.get(piece["source"])
+            if not location:
+                location = self.__locate(piece["source"])
+                self.locations[piece["source"]] = location
+            path, source_offset, opener = location
+            f = self.files.get(path, opener)
+            f.seek(source_offset + piece["offset"] + pos_in_piece)
+            bytes_read = f.readinto(view[filled:filled + bytes_to_read])
+            assert bytes_read == bytes_to_read, "Blob %s is too short" % piece["source"]
+            filled += bytes_read
+            self.seek(self.pos + bytes_read)
+        return str(result)
+
+    def __locate(self, source):
+        location = self.repo.get_raw_blob_location(source)
+        if location:
+            return location[0], location[1], None
+        compressed_path = self.repo.get_compressed_blob_path(source)
+        assert os.path.exists(compressed_path), "Recipe source blob is missing: %s" % source
+        return compressed_path, 0, ZBlobReader
+
+    def close(self):
+        self.files.close()
+
+class RecipeDataSource(DataSource):
+    """Reads the given range of a recipe based blob."""
+    def __init__(self, reader, offset, size):
+        assert 0 <= offset and offset + size <= reader.size
+        self.reader = reader
+        self.reader.seek(offset)
+        self.remaining = size
+
+    def bytes_left(self):
+        return self.remaining
+
+    def read(self, n = None):
+        if n == None:
+            n = self.remaining
+        data = self.reader.read(min(n, self.remaining))
+        self.remaining -= len(data)
+        assert self.remaining >= 0
+        if self.remaining == 0:
+            self.reader.close()
+        return data
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+Content defined chunking. A large blob is cut into chunks at
+positions that are decided by the contents of the blob itself, so
+that a change in one part of the blob does not move the cuts in the
+rest of it. The chunks are stored as ordinary blobs, and the large
+blob as a recipe over them. A slightly modified version of a large
+blob (such as a virtual machine image or a database dump) then only
+needs the chunks that have actually changed to be stored.
+
+The cuts are found with a "gear" rolling hash. For every byte, the
+hash is shifted one bit to the left and a random value for the byte
+is added. The highest bits of the hash therefore only depend on the
+last HASH_WINDOW bytes. A cut is made after a byte where the highest
+bits of the hash are all zero, which happens on average once every
+2^bits bytes. No cut is made closer than min_size bytes to the last
+one, and a cut is always made after max_size bytes.
+
+The gear table and the cut rule must never change, since that would
+make new chunks differ from the ones already stored.
+
+Hashing every byte in python is much slower than reading the file, so
+if numpy is available, the hash is instead calculated for a large
+block of the file at a time. The hash of a window of 2n bytes is the
+hash of its first n bytes shifted n bits, plus the hash of its last n
+bytes, so the hashes of all HASH_WINDOW byte windows in a block are
+found in log2(HASH_WINDOW) vector operations. Both methods give the
+same cuts. Neither method hashes the start of a chunk, where no cut
+can be made, except for the last HASH_WINDOW bytes before the first
+possible cut.
+"""
+
+import os
+import math
+import tempfile
+
+from common import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HASH_WINDOW = 32
+HASH_MASK = 2**HASH_WINDOW - 1
+
+GEAR = [int(md5sum("boar gear %s" % n)[:8], 16) for n in range(0, 256)]
+
+DEFAULT_MIN_SIZE = 512 * 2**10
+DEFAULT_AVG_SIZE = 2 * 2**20
+DEFAULT_MAX_SIZE = 8 * 2**20
+
+# The number of bytes that are hashed at a time when using numpy. Much
+# larger blocks are slower, as the arrays no longer fit in the cache,
+# and less of the start of every chunk can be skipped.
+SCAN_BLOCK_SIZE = 128 * 2**10
+
+class Chunker:
+    def __init__(self, min_size = DEFAULT_MIN_SIZE, avg_size = DEFAULT_AVG_SIZE,
+                 max_size = DEFAULT_MAX_SIZE):
+        assert HASH_WINDOW <= min_size < avg_size < max_size, \
+            "Invalid chunk sizes %s/%s/%s" % (min_size, avg_size, max_size)
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        # Cuts are made where the distance from min_size is on
+        # average avg_size - min_size bytes
+        bits = int(round(math.log(avg_size - min_size, 2)))
+        self.cut_mask = ((1 << bits) - 1) << (HASH_WINDOW - bits)
+        # Blobs smaller than this are not worth chunking. It must be
+        # larger than any chunk, so that a chunk is never one of the
+        # blobs that are being replaced by recipes.
+        self.min_blob_size = max(4 * avg_size, 2 * max_size)
+
+    def __str__(self):
+        return "%s:%s:%s" % (self.min_size, self.avg_size, self.max_size)
+
+    def find_cut(self, data):
+        """Returns the length of the first chunk of the given
+        data. The data must contain at least max_size bytes, unless it
+        is the end of the blob."""
+        end = min(len(data), self.max_size)
+        if end <= self.min_size:
+            return end
+        # The hash only depends on the last HASH_WINDOW bytes, so the
+        # start of the chunk does not need to be hashed.
+        start = self.min_size - HASH_WINDOW
+        gear, mask = GEAR, self.cut_mask
+        h = 0
+        for byte in bytearray(data[start:self.min_size]):
+            h = ((h << 1) + gear[byte]) & HASH_MASK
+        if not h & mask:
+            return self.min_size
+        pos = self.min_size
+        for byte in bytearray(data[self.min_size:end]):
+            pos += 1
+            h = ((h << 1) + gear[byte]) & HASH_MASK
+            if not h & mask:
+                return pos
+        return end
+
+    def cut_positions(self, f, use_numpy = True):
+        """Reads the given file object from the start to the end and
+        returns the positions where it should be cut, in the form that
+        common.split_file() accepts (but possibly empty)."""
+        f.seek(0)
+        if numpy and use_numpy:
+            cuts = []
+            candidates = find_candidates(f, self.cut_mask,
+                                         lambda: (len(cuts) and cuts[-1]) + self.min_size)
+            return self.__select_cuts(candidates, f.tell, cuts)
+        cuts = []
+        position = 0
+        buf = ""
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_size:
+                data = f.read(max(self.max_size, 2**20))
+                eof = not data
+                buf += data
+            if not buf:
+                return cuts[:-1]
+            length = self.find_cut(buf)
+            position += length
+            cuts.append(position)
+            buf = buf[length:]
+
+    def __select_cuts(self, candidates, size_function, cuts):
+        """Applies the min_size and max_size rules to the given
+        ascending sequence of candidate positions, and appends the
+        cuts to the given empty list as they are found. The size
+        function must return the size of the file after the last
+        candidate has been produced."""
+        last_cut = 0
+        for candidate in candidates:
+            while candidate > last_cut + self.max_size:
+                last_cut += self.max_size
+                cuts.append(last_cut)
+            if candidate >= last_cut + self.min_size:
+                last_cut = candidate
+                cuts.append(last_cut)
+        size = size_function()
+        while size > last_cut + self.max_size:
+            last_cut += self.max_size
+            cuts.append(last_cut)
+        if cuts and cuts[-1] == size:
+            cuts.pop()
+        return cuts
+
+def skip_bytes(f, count):
+    """Reads and discards the given number of bytes from the given
+    file object. Returns the number of bytes that were skipped, which
+    is less than count at the end of the file."""
+    skipped = 0
+    while skipped < count:
+        data = f.read(min(count - skipped, SCAN_BLOCK_SIZE))
+        if not data:
+            break
+        skipped += len(data)
+    return skipped
+
+def find_candidates(f, mask, first_wanted = None):
+    """Reads the given file object to the end and yields, in order,
+    every position after which the hash of the last HASH_WINDOW bytes
+    has no bits in common with the mask, which must consist of the
+    highest bits of the hash. Requires numpy.
+
+    If given, first_wanted() is called before every block is read, and
+    returns the smallest position that is still of interest. The
+    bytes before it that can not affect its hash are skipped without
+    being hashed."""
+    gear = numpy.array(GEAR, dtype = numpy.uint32)
+    # A hash has no bits in common with the mask if it is smaller than
+    # the lowest bit of the mask
+    limit = mask & -mask
+    assert mask == HASH_MASK - limit + 1, "Invalid mask: %x" % mask
+    limit = numpy.uint32(limit)
+    # Preallocated, as allocating the arrays for every block costs
+    # more than the calculations
+    buf = numpy.empty(SCAN_BLOCK_SIZE + HASH_WINDOW, dtype = numpy.uint8)
+    hashes = numpy.empty(len(buf), dtype = numpy.uint32)
+    tmp = numpy.empty(len(buf), dtype = numpy.uint32)
+    is_candidate = numpy.empty(len(buf), dtype = numpy.bool_)
+    context = 0 # The number of bytes kept from the previous block
+    offset = 0 # The file position of the first byte in the buffer
+    while True:
+        if first_wanted:
+            skip = first_wanted() - HASH_WINDOW - (offset + context)
+            if skip > 0:
+                skipped = skip_bytes(f, skip)
+                # The buffered bytes are no longer needed as context
+                offset += context + skipped
+                context = 0
+                if skipped < skip:
+                    return
+        data = f.read(SCAN_BLOCK_SIZE)
+        if not data:
+            return
+        n = context + len(data)
+        buf[context:n] = numpy.frombuffer(data, dtype = numpy.uint8)
+        numpy.take(gear, buf[:n], out = hashes[:n])
+        width = 1
+        while width < min(n, HASH_WINDOW):
+            numpy.left_shift(hashes[:n - width], width, out = tmp[:n - width])
+            numpy.add(hashes[width:n], tmp[:n - width], out = hashes[width:n])
+            width *= 2
+        # The first HASH_WINDOW - 1 hashes are for incomplete windows
+        complete = max(0, n - HASH_WINDOW + 1)
+        numpy.less(hashes[n - complete:n], limit, out = is_candidate[:complete])
+        for index in numpy.flatnonzero(is_candidate[:complete]):
+            yield offset + int(index) + HASH_WINDOW
+        new_context = min(n, HASH_WINDOW - 1)
+        buf[:new_context] = buf[n - new_context:n]
+        offset += n - new_context
+        context = new_context
+
+def parse_chunking(value):
+    """Returns a Chunker for the given chunking setting, which is
+    "off", "on" (default chunk sizes) or "min:avg:max" (chunk sizes in
+    bytes), or None if chunking is off."""
+    if value == "off":
+        return None
+    if value == "on":
+        return Chunker()
+    try:
+        min_size, avg_size, max_size = [int(size) for size in value.split(":")]
+    except ValueError:
+        raise ValueError("Invalid chunking setting: %s" % value)
+    return Chunker(min_size, avg_size, max_size)
+
+def chunk_file(chunker, path, dest_dir, want_piece):
+    """Cuts the file at the given path into chunks, and writes every
+    chunk that the function want_piece(md5sum) returns True for to
+    dest_dir, named by its md5sum (unless such a file already
+    exists). Returns a list of (md5sum, size) tuples for all the
+    chunks, and a {md5sum: size} dict for the written chunks."""
+    pieces = []
+    written = {}
+    with open(path, "rb") as f:
+        cuts = chunker.cut_positions(f)
+        f.seek(0, os.SEEK_END)
+        cuts.append(f.tell())
+        f.seek(0)
+        position = 0
+        for cut in cuts:
+            chunk = f.read(cut - position)
+            assert len(chunk) == cut - position, "Unexpected short read"
+            position = cut
+            piece = md5sum(chunk)
+            pieces.append((piece, len(chunk)))
+            destination = os.path.join(dest_dir, piece)
+            if piece in written or os.path.exists(destination) or not want_piece(piece):
+                continue
+            fd, tmp_path = tempfile.mkstemp(dir = dest_dir, prefix = "chunk_")
+            with os.fdopen(fd, "wb") as out:
+                out.write(chunk)
+                out.flush()
+                os.fsync(out.fileno())
+            os.rename(tmp_path, destination)
+            written[piece] = len(chunk)
+    return pieces, written
+
+def create_recipe(blob, pieces):
+    """Returns a concat recipe for the given blob over the given
+    (md5sum, size) pieces."""
+    return {"method": "concat",
+            "md5sum": blob,
+            "size": sum([size for piece, size in pieces]),
+            "pieces": [{"source": piece, "offset": 0, "size": size} for piece, size in pieces]}
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+A compact binary encoding of a full list of blobinfos (a manifest),
+designed to be memory mapped and searched without decoding the whole
+list. It is only used for derived data. The json bloblists remain the
+authoritative (and documented) format.
+
+The file starts with a header consisting of a magic string and the
+number of entries. The header is followed by one fixed size record
+per entry, sorted by the utf-8 encoded filename, and finally by all
+the utf-8 encoded filenames concatenated in the same order. A record
+contains the position and length of its filename in the name area,
+the binary md5sum, a bit field telling which of the optional fields
+that are present, and the size, mtime and ctime of the file.
+
+Only blobinfos with no other keys than filename, md5sum, size, mtime
+and ctime (the last three being integers) can be encoded.
+"""
+
+import struct
+import binascii
+import mmap
+
+from common import *
+
+MANIFEST_MAGIC = "BOARMAN1"
+HEADER_FORMAT = "!8sI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = "!QI16sBqqq"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+OPTIONAL_FIELDS = ("size", "mtime", "ctime")
+ENCODABLE_FIELDS = set(("filename", "md5sum") + OPTIONAL_FIELDS)
+INT64_RANGE = (-2**63, 2**63 - 1)
+
+def is_encodable(blobinfo):
+    if not set(blobinfo.keys()) <= ENCODABLE_FIELDS:
+        return False
+    if not is_md5sum(blobinfo.get('md5sum', None)):
+        return False
+    for field in OPTIONAL_FIELDS:
+        value = blobinfo.get(field, 0)
+        if type(value) not in (int, long) or not INT64_RANGE[0] <= value <= INT64_RANGE[1]:
+            return False
+    return True
+
+def encode_manifest(blobinfos):
+    """Returns the binary encoding of the given blobinfos as a string,
+    or None if any of them can not be encoded."""
+    entries = []
+    for blobinfo in blobinfos:
+        if not is_encodable(blobinfo):
+            return None
+        entries.append((blobinfo['filename'].encode("utf-8"), blobinfo))
+    entries.sort()
+    records = [struct.pack(HEADER_FORMAT, MANIFEST_MAGIC, len(entries))]
+    names = []
+    name_offset = 0
+    for encoded_name, blobinfo in entries:
+        flags = 0
+        values = []
+        for bit, field in enumerate(OPTIONAL_FIELDS):
+            if field in blobinfo:
+                flags |= 1 << bit
+            values.append(blobinfo.get(field, 0))
+        records.append(struct.pack(RECORD_FORMAT, name_offset, len(encoded_name),
+                                   binascii.unhexlify(blobinfo['md5sum']), flags, *values))
+        names.append(encoded_name)
+        name_offset += len(encoded_name)
+    return "".join(records + names)
+
+class ManifestReader:
+    """Gives access to a binary manifest file without reading it
+    into memory. Iterating over the reader yields the blobinfos in
+    filename order. The file is only mapped while it is being read,
+    so that a cached reader does not hold on to a file descriptor."""
+
+    def __init__(self, path):
+        self.path = path
+        data = self.__map()
+        try:
+            magic, self.count = struct.unpack_from(HEADER_FORMAT, data, 0)
+            assert magic == MANIFEST_MAGIC, "Not a manifest file: " + path
+            self.names_start = HEADER_SIZE + self.count * RECORD_SIZE
+            assert len(data) >= self.names_start, "Truncated manifest file: " + path
+        finally:
+            data.close()
+
+    def __map(self):
+        with open(self.path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        data = self.__map()
+        try:
+            for n in xrange(0, self.count):
+                yield self.__get_entry(data, n)
+        finally:
+            data.close()
+
+    def __get_record(self, data, n):
+        return struct.unpack_from(RECORD_FORMAT, data, HEADER_SIZE + n * RECORD_SIZE)
+
+    def __get_encoded_name(self, data, record):
+        start = self.names_start + record[0]
+        return data[start:start + record[1]]
+
+    def __get_entry(self, data, n, record = None):
+        if record == None:
+            record = self.__get_record(data, n)
+        name_offset, name_length, digest, flags = record[:4]
+        blobinfo = {'filename': self.__get_encoded_name(data, record).decode("utf-8"),
+                    'md5sum': binascii.hexlify(digest)}
+        for bit, field in enumerate(OPTIONAL_FIELDS):
+            if flags & (1 << bit):
+                blobinfo[field] = record[4 + bit]
+        return blobinfo
+
+    def get(self, filename):
+        """Returns the blobinfo for the given filename, or None if
+        there is no such file. Performs a binary search."""
+        wanted = filename.encode("utf-8")
+        data = self.__map()
+        try:
+            low, high = 0, self.count
+            while low < high:
+                middle = (low + high) // 2
+                record = self.__get_record(data, middle)
+                name = self.__get_encoded_name(data, record)
+                if name < wanted:
+                    low = middle + 1
+                elif name > wanted:
+                    high = middle
+                else:
+                    return self.__get_entry(data, middle, record)
+            return None
+        finally:
+            data.close()
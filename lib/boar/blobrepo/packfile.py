@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+Pack files store many small blobs in a single file, to avoid the cost
+of one file (and inode) per blob. The packs are kept in the "packs"
+directory of the repository, and are named by a sequence number
+("1.pack", "2.pack", ...). Blobs are only ever appended to the pack
+with the highest number, until it has grown to MAX_PACK_SIZE.
+
+A pack starts with a header (magic string and version), followed by
+the blobs. Every blob is preceded by its md5sum (16 bytes, binary)
+and its size (8 bytes, big endian). A pack can therefore be read
+without its index.
+
+Every pack has an index ("1.idx", ...) that lists the position of
+every blob in the pack, sorted by md5sum, so that a blob can be found
+with a binary search instead of parsing the whole index. A fanout
+table with the number of blobs whose md5sum starts with each
+possible byte narrows the search. The index also states how much of
+the pack it covers. Anything after that in the pack is the remains of
+an interrupted append and is ignored, and overwritten by the next
+append. An index is always replaced atomically, after the pack data it
+refers to has been written to disk. An index can be regenerated from
+its pack.
+"""
+
+import os
+import re
+import time
+import struct
+import binascii
+import threading
+
+from common import *
+
+PACK_MAGIC = "BOARPACK"
+INDEX_MAGIC = "BOARPIDX"
+PACK_VERSION = 1
+HEADER_FORMAT = "!8sI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ENTRY_FORMAT = "!16sQ"
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+# The index header is followed by the fanout table and the records
+INDEX_HEADER_FORMAT = "!8sIQ"
+INDEX_HEADER_SIZE = struct.calcsize(INDEX_HEADER_FORMAT)
+FANOUT_FORMAT = "!256I"
+FANOUT_SIZE = struct.calcsize(FANOUT_FORMAT)
+INDEX_RECORD_FORMAT = "!16sQQ"
+INDEX_RECORD_SIZE = struct.calcsize(INDEX_RECORD_FORMAT)
+
+MAX_PACK_SIZE = 64 * 2**20
+
+# The pack directory is only listed again when its mtime has changed.
+# A directory modified less than this number of seconds ago may be
+# modified again without its mtime changing, so it is always listed.
+RACY_SECONDS = 2
+
+def scan_pack(path):
+    """Yields a (digest, data offset, size) tuple for every complete
+    blob in the given pack, in the order they are stored. Returns
+    silently at an incomplete entry at the end of the pack."""
+    pack_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        assert struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE)) == (PACK_MAGIC, PACK_VERSION), \
+            "Not a valid pack file: %s" % path
+        position = HEADER_SIZE
+        while position + ENTRY_SIZE <= pack_size:
+            f.seek(position)
+            digest, size = struct.unpack(ENTRY_FORMAT, f.read(ENTRY_SIZE))
+            if position + ENTRY_SIZE + size > pack_size:
+                return
+            yield digest, position + ENTRY_SIZE, size
+            position += ENTRY_SIZE + size
+
+def write_pack_index(path, records, pack_length):
+    """Atomically writes an index with the given (digest, offset,
+    size) records, covering the first pack_length bytes of the
+    pack."""
+    records = sorted(records)
+    fanout = [0] * 256
+    for digest, offset, size in records:
+        fanout[ord(digest[0])] += 1
+    for n in range(1, 256):
+        fanout[n] += fanout[n - 1]
+    tmp_path = path + ".new"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack(INDEX_HEADER_FORMAT, INDEX_MAGIC, PACK_VERSION, pack_length))
+        f.write(struct.pack(FANOUT_FORMAT, *fanout))
+        f.write("".join([struct.pack(INDEX_RECORD_FORMAT, *record) for record in records]))
+        f.flush()
+        os.fsync(f.fileno())
+    replace_file(tmp_path, path)
+
+class PackIndex:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        magic, version, self.pack_length = struct.unpack_from(INDEX_HEADER_FORMAT, self.data)
+        assert (magic, version) == (INDEX_MAGIC, PACK_VERSION), "Not a valid pack index: %s" % path
+        self.fanout = struct.unpack_from(FANOUT_FORMAT, self.data, INDEX_HEADER_SIZE)
+        self.count = self.fanout[255]
+        assert len(self.data) == INDEX_HEADER_SIZE + FANOUT_SIZE + self.count * INDEX_RECORD_SIZE, \
+            "Pack index has the wrong size: %s" % path
+
+    def __record(self, n):
+        return struct.unpack_from(INDEX_RECORD_FORMAT, self.data,
+                                  INDEX_HEADER_SIZE + FANOUT_SIZE + n * INDEX_RECORD_SIZE)
+
+    def lookup(self, digest):
+        """Returns the (offset, size) of the blob with the given
+        binary digest, or None if it is not in the pack."""
+        first_byte = ord(digest[0])
+        low = first_byte and self.fanout[first_byte - 1]
+        high = self.fanout[first_byte]
+        while low < high:
+            middle = (low + high) // 2
+            record = self.__record(middle)
+            if record[0] < digest:
+                low = middle + 1
+            elif record[0] > digest:
+                high = middle
+            else:
+                return record[1], record[2]
+        return None
+
+    def records(self):
+        for n in xrange(0, self.count):
+            yield self.__record(n)
+
+class PackSet:
+    """All the packs in a pack directory. The indexes are reloaded by
+    refresh() when they have been changed, possibly by another
+    process. Adding blobs must only be done while holding the
+    repository mutex."""
+    def __init__(self, pack_dir):
+        self.pack_dir = pack_dir
+        self.lock = threading.RLock()
+        # { pack number: (index stat, PackIndex) }
+        self.indexes = {}
+        # The stat of the pack dir when it was last listed
+        self.dir_stat_key = None
+        self.refresh()
+
+    def get_pack_path(self, number):
+        return os.path.join(self.pack_dir, "%s.pack" % number)
+
+    def get_index_path(self, number):
+        return os.path.join(self.pack_dir, "%s.idx" % number)
+
+    def __pack_numbers(self):
+        if not os.path.exists(self.pack_dir):
+            return []
+        numbers = [int(filename.split(".")[0]) for filename in os.listdir(self.pack_dir)
+                   if re.match("^[0-9]+\.pack$", filename)]
+        numbers.sort()
+        return numbers
+
+    def refresh(self):
+        """Loads any index that is new or has been replaced since it
+        was last loaded. Returns True if anything was loaded. New and
+        replaced indexes are created by renaming, which changes the
+        mtime of the pack dir, so nothing is done if that is
+        unchanged."""
+        with self.lock:
+            try:
+                st = os.stat(self.pack_dir)
+            except OSError:
+                return False # No packs yet
+            dir_stat_key = (st.st_ino, st.st_mtime)
+            if dir_stat_key == self.dir_stat_key:
+                return False
+            self.dir_stat_key = None
+            if time.time() - st.st_mtime >= RACY_SECONDS:
+                self.dir_stat_key = dir_stat_key
+            changed = False
+            for number in self.__pack_numbers():
+                index_path = self.get_index_path(number)
+                try:
+                    st = os.stat(index_path)
+                except OSError:
+                    continue # Interrupted while the pack was created
+                stat_key = (st.st_ino, st.st_size, st.st_mtime)
+                if number in self.indexes and self.indexes[number][0] == stat_key:
+                    continue
+                self.indexes[number] = (stat_key, PackIndex(index_path))
+                changed = True
+            return changed
+
+    def __lookup(self, digest):
+        for number, (stat_key, index) in self.indexes.items():
+            location = index.lookup(digest)
+            if location:
+                return self.get_pack_path(number), location[0], location[1]
+        return None
+
+    def lookup(self, blobname):
+        """Returns a (pack path, offset, size) tuple for the given
+        blob, or None if it is not in any pack."""
+        digest = binascii.unhexlify(blobname)
+        with self.lock:
+            location = self.__lookup(digest)
+            if not location and self.refresh():
+                location = self.__lookup(digest)
+            return location
+
+    def iter_blobs(self):
+        """Yields a (blobname, size) tuple for every packed blob."""
+        with self.lock:
+            self.refresh()
+            indexes = [index for stat_key, index in self.indexes.values()]
+        for index in indexes:
+            for digest, offset, size in index.records():
+                yield binascii.hexlify(digest), size
+
+    def add_blobs(self, blobs):
+        """Appends the given (blobname, path) blobs to the current
+        pack, starting a new pack when it is full. Blobs that are
+        already packed are skipped."""
+        with self.lock:
+            if not os.path.exists(self.pack_dir):
+                os.mkdir(self.pack_dir)
+            self.refresh()
+            blobs = [(blobname, path) for blobname, path in blobs
+                     if not self.__lookup(binascii.unhexlify(blobname))]
+            while blobs:
+                numbers = self.__pack_numbers()
+                if not numbers or os.path.getsize(self.get_pack_path(numbers[-1])) >= MAX_PACK_SIZE:
+                    numbers.append((numbers or [0])[-1] + 1)
+                blobs = self.__append(numbers[-1], blobs)
+            self.refresh()
+
+    def __append(self, number, blobs):
+        """Appends as many of the given blobs as fits to the given pack
+        and writes its index. Returns the blobs that did not fit."""
+        pack_path = self.get_pack_path(number)
+        if number in self.indexes:
+            index = self.indexes[number][1]
+            records = list(index.records())
+            pack_length = index.pack_length
+        elif os.path.exists(pack_path):
+            # The index was never written, recover what we can
+            records = list(scan_pack(pack_path))
+            pack_length = HEADER_SIZE
+            if records:
+                pack_length = max([offset + size for digest, offset, size in records])
+        else:
+            with open(pack_path, "wb") as f:
+                f.write(struct.pack(HEADER_FORMAT, PACK_MAGIC, PACK_VERSION))
+            records = []
+            pack_length = HEADER_SIZE
+        appended = 0
+        with open(pack_path, "r+b") as f:
+            f.truncate(pack_length)
+            f.seek(pack_length)
+            while appended < len(blobs) and (pack_length < MAX_PACK_SIZE or not records):
+                blobname, path = blobs[appended]
+                appended += 1
+                with open(path, "rb") as blob_file:
+                    data = blob_file.read()
+                digest = binascii.unhexlify(blobname)
+                f.write(struct.pack(ENTRY_FORMAT, digest, len(data)))
+                f.write(data)
+                records.append((digest, pack_length + ENTRY_SIZE, len(data)))
+                pack_length += ENTRY_SIZE + len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        write_pack_index(self.get_index_path(number), records, pack_length)
+        return blobs[appended:]
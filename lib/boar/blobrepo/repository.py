@@ -24,19 +24,80 @@ only classes that directly accesses the repository.
 import os
 import re
 import shutil
+import tempfile
+import random
+import threading
 import sessions
+import blobindex
+import sessionindex
+import manifest
+import chunker
+import packfile
+import zblob
 
 #TODO: use/modify the session reader so that we don't have to use json here
 import sys
 from common import *
-from blobreader import create_blob_reader
+from blobreader import create_blob_reader, RecipeDataSource
 from jsonrpc import FileDataSource
 
 QUEUE_DIR = "queue"
 BLOB_DIR = "blobs"
 SESSIONS_DIR = "sessions"
 RECIPES_DIR = "recipes"
+PACKS_DIR = "packs"
 TMP_DIR = "tmp"
+DERIVED_DIR = "derived"
+BLOBINDEX_FILE = "blobindex.bin"
+SESSIONINDEX_FILE = "sessionindex.json"
+MANIFESTS_DIR = "manifests"
+
+# A snapshot only stores the changes relative to its base
+# snapshot. To avoid having to follow long chains of base snapshots,
+# a full list of the files (a manifest) is stored for every snapshot
+# that would otherwise require reading this many bloblists.
+MANIFEST_INTERVAL = 20
+
+# Snapshots whose own bloblist has at least this many entries always
+# get a binary manifest, so that single files can be looked up without
+# reading the whole bloblist. Small changes to large snapshots are
+# still only stored as deltas.
+MANIFEST_MIN_FILES = 1000
+
+# A snapshot that is committed by a SessionWriter contains a list of
+# the blobs that the writer has already verified. The verification
+# policy decides how much of that work is repeated before the blobs
+# are moved into the repository. Snapshots that are found in the
+# queue when the repository is opened (an interrupted commit) are
+# always fully verified.
+VERIFY_FULL = "full"        # Re-hash every blob
+VERIFY_SAMPLED = "sampled"  # Check sizes, re-hash a few random blobs
+VERIFY_NONE = "none"        # Check sizes only
+VERIFY_POLICIES = (VERIFY_FULL, VERIFY_SAMPLED, VERIFY_NONE)
+VERIFY_SAMPLE_COUNT = 4
+VERIFIED_BLOBS_FILE = "verified.json"
+
+# New blobs of at most this size may be stored in pack files (see
+# packfile.py) instead of as files of their own. Older versions of
+# boar can not read packed blobs, so this is off unless enabled.
+MAX_PACKED_BLOB_SIZE = 4096
+BLOB_PACKING_OFF = "off"
+BLOB_PACKING_ON = "on"
+BLOB_PACKINGS = (BLOB_PACKING_OFF, BLOB_PACKING_ON)
+
+# New blobs that are not packed may be stored compressed (see
+# zblob.py), if they compress well. Older versions of boar can not
+# read compressed blobs, so this is off unless enabled.
+BLOB_COMPRESSION_OFF = "off"
+BLOB_COMPRESSION_ZLIB = "zlib"
+BLOB_COMPRESSIONS = (BLOB_COMPRESSION_OFF, BLOB_COMPRESSION_ZLIB)
+COMPRESSED_BLOB_SUFFIX = ".z"
+
+# Large new blobs may be stored as recipes over content defined
+# chunks (see chunker.py), so that blobs that only differ in a few
+# places share most of their data. Older versions of boar can not read
+# such blobs, so this is off unless enabled.
+DEFAULT_CHUNKING = "off"
 
 recoverytext = """Repository format 0.1
 
@@ -65,6 +126,34 @@ To restore a session, iterate over the bloblist and copy the blob with
 the corresponding checksum to a file with the name specified in the
 bloblist.
 
+Small files are not stored in the "blobs" directory, but in pack
+files in the "packs" directory, named 1.pack, 2.pack and so on. A pack
+file starts with the 8 characters "BOARPACK" followed by a 4 byte
+version number. Then follows the files, one after another. Every file
+is preceded by its md5 checksum (16 bytes, in binary form) and its
+size in bytes (8 bytes, big endian integer). If the last file in a
+pack is incomplete, it can be ignored, as it will also be present
+elsewhere. The files 1.idx, 2.idx and so on are only indexes of the
+packs and are not needed for recovery.
+
+A file in the "blobs" directory may also be stored compressed, in
+which case its name ends with ".z". Such a file starts with the 8
+characters "BOARZBLB", a 4 byte version number, a 4 byte chunk size
+and the 8 byte size of the original file. Then follows the compressed
+size of every chunk (4 bytes each), and then the chunks. Every chunk is
+compressed separately with zlib (RFC1950). The original file is
+restored by decompressing the chunks and concatenating them. All
+integers are big endian.
+
+Large files may be stored as a "recipe" in the "recipes" directory,
+named after the checksum of the file followed by ".recipe". A recipe
+is a json file with a list of "pieces". The file is restored by
+concatenating "size" bytes, starting at position "offset", of each
+piece's "source" blob, in the order they are listed.
+
+The "derived" directory only contains indexes and caches that can be
+regenerated from the other directories. It is not needed for recovery.
+
 """
 
 class MisuseError(Exception):
@@ -89,9 +178,13 @@ def create_repository(repopath):
     os.mkdir(os.path.join(repopath, BLOB_DIR))
     os.mkdir(os.path.join(repopath, SESSIONS_DIR))
     os.mkdir(os.path.join(repopath, RECIPES_DIR))
+    os.mkdir(os.path.join(repopath, PACKS_DIR))
     os.mkdir(os.path.join(repopath, TMP_DIR))
+    os.mkdir(os.path.join(repopath, DERIVED_DIR))
     with open(os.path.join(repopath, "recovery.txt"), "w") as f:
         f.write(recoverytext)
+    # A new repository is empty, so its blob index is trivially complete
+    blobindex.write_index(os.path.join(repopath, DERIVED_DIR, BLOBINDEX_FILE), [], 0)
 
 def is_recipe_filename(filename):
     filename_parts = filename.split(".")
@@ -101,21 +194,62 @@ def is_recipe_filename(filename):
             
     
 class Repo:
-    def __init__(self, repopath):
+    def __init__(self, repopath, verify_policy = None, chunking = None, blob_compression = None,
+                 blob_packing = None):
         # The path must be absolute to avoid problems with clients
         # that changes the cwd. For instance, fuse.
         assert(os.path.isabs(repopath)), "The repo path must be absolute. "\
             +"Was: " + repopath
         self.repopath = unicode(repopath)
         self.session_readers = {}
+        # Serializes the access to the caches and indexes, and the
+        # use of the repo mutex, between threads (a server may serve
+        # several clients at once)
+        self.lock = threading.RLock()
         self.repo_mutex = FileMutex(os.path.join(repopath, TMP_DIR), "__REPOLOCK__")
         misuse_assert(os.path.exists(self.repopath), "No such directory: %s" % (self.repopath))
         assert_msg = "Repository at %s is missing vital files. (Is it really a repository?)" % self.repopath
         integrity_assert(os.path.exists(self.repopath + "/sessions"), assert_msg)
         integrity_assert(os.path.exists(self.repopath + "/blobs"), assert_msg)
         integrity_assert(os.path.exists(self.repopath + "/tmp"), assert_msg)
+        # Repositories created by older versions lack the derived dir,
+        # it is created when derived data is first written. Until then
+        # the repository is used without a blob index.
+        self.blobindex = blobindex.BlobIndex(self.get_blobindex_path())
+        self.blobindex_ok = False
+        self.sessionindex = sessionindex.SessionNameIndex(\
+            os.path.join(self.repopath, DERIVED_DIR, SESSIONINDEX_FILE))
+        self.manifest_interval = MANIFEST_INTERVAL
+        self.manifest_min_files = MANIFEST_MIN_FILES
+        # Repositories created by older versions lack the packs dir,
+        # it is created when the first pack is written
+        self.packs = packfile.PackSet(os.path.join(self.repopath, PACKS_DIR))
+        if verify_policy == None:
+            verify_policy = os.getenv("BOAR_VERIFY_POLICY", VERIFY_SAMPLED)
+        misuse_assert(verify_policy in VERIFY_POLICIES, "Unknown verify policy: %s" % verify_policy)
+        self.verify_policy = verify_policy
+        if chunking == None:
+            chunking = os.getenv("BOAR_CHUNKING", DEFAULT_CHUNKING)
+        try:
+            self.chunker = chunker.parse_chunking(chunking)
+        except (ValueError, AssertionError), e:
+            raise MisuseError(str(e))
+        if self.chunker and not chunker.numpy:
+            print >>sys.stderr, "Warning: numpy is not installed, so chunking of large files is very slow"
+        if blob_compression == None:
+            blob_compression = os.getenv("BOAR_BLOB_COMPRESSION", BLOB_COMPRESSION_OFF)
+        misuse_assert(blob_compression in BLOB_COMPRESSIONS, "Unknown blob compression: %s" % blob_compression)
+        self.blob_compression = blob_compression
+        if blob_packing == None:
+            blob_packing = os.getenv("BOAR_BLOB_PACKING", BLOB_PACKING_OFF)
+        misuse_assert(blob_packing in BLOB_PACKINGS, "Unknown blob packing: %s" % blob_packing)
+        # None means that no blobs are packed
+        self.max_packed_blob_size = None
+        if blob_packing == BLOB_PACKING_ON:
+            self.max_packed_blob_size = MAX_PACKED_BLOB_SIZE
         self.repo_mutex.lock_with_timeout(60)
         try:
+            self.__check_blobindex()
             self.process_queue()
         finally:
             self.repo_mutex.release()
@@ -129,10 +263,103 @@ class Repo:
     def get_queue_path(self, filename):
         return os.path.join(self.repopath, QUEUE_DIR, filename)
 
+    def get_blobindex_path(self):
+        return os.path.join(self.repopath, DERIVED_DIR, BLOBINDEX_FILE)
+
+    def __make_derived_dir(self):
+        derived_dir = os.path.join(self.repopath, DERIVED_DIR)
+        if not os.path.exists(derived_dir):
+            try:
+                os.mkdir(derived_dir)
+            except OSError:
+                if not os.path.isdir(derived_dir):
+                    raise
+
+    def __check_blobindex(self):
+        """The blob index may only be used if it is in sync with the
+        latest snapshot (or the queued snapshot, if there is one). If
+        not, it has been missing or a commit has been made without
+        updating it, and it must be rebuilt before it can be used."""
+        synced_session = self.blobindex.get_synced_session()
+        valid_sessions = [self.find_next_session_id() - 1, self.get_queued_session_id()]
+        self.blobindex_ok = synced_session != None and synced_session in valid_sessions
+
+    def __blobindex_lookup(self, lookup, sum):
+        """Performs the given lookup in the blob index. A negative
+        answer may be caused by another process committing after we
+        loaded the index, so the index is refreshed before giving
+        up."""
+        with self.lock:
+            result = lookup(sum)
+            if not result and self.blobindex.refresh():
+                result = lookup(sum)
+            return result
+
+    def rebuild_blobindex(self):
+        """Regenerates the blob index from the contents of the
+        repository. Necessary if the index is missing or stale."""
+        with self.lock:
+            self.repo_mutex.lock_with_timeout(60)
+            try:
+                entries = []
+                for blobname in self.__scan_raw_blob_names():
+                    size = os.path.getsize(self.get_blob_path(blobname))
+                    entries.append((blobindex.KIND_RAW, blobname, size))
+                for blobname, size in self.packs.iter_blobs():
+                    entries.append((blobindex.KIND_RAW, blobname, size))
+                for blobname in self.__scan_compressed_blob_names():
+                    size = zblob.get_size(self.get_compressed_blob_path(blobname))
+                    entries.append((blobindex.KIND_RAW, blobname, size))
+                for blobname in self.__scan_recipe_names():
+                    entries.append((blobindex.KIND_RECIPE, blobname, self.get_recipe(blobname)['size']))
+                self.__make_derived_dir()
+                blobindex.write_index(self.get_blobindex_path(), entries, self.find_next_session_id() - 1)
+                self.blobindex.refresh()
+                self.__check_blobindex()
+                assert self.blobindex_ok
+                return len(entries)
+            finally:
+                self.repo_mutex.release()
+
     def get_blob_path(self, sum):
+        """Returns the path where the given raw blob is stored if it
+        is not packed."""
         assert is_md5sum(sum), "Was: %s" % (sum)
         return os.path.join(self.repopath, BLOB_DIR, sum[0:2], sum)
 
+    def get_compressed_blob_path(self, sum):
+        assert is_md5sum(sum), "Was: %s" % (sum)
+        return os.path.join(self.repopath, BLOB_DIR, sum[0:2], sum + COMPRESSED_BLOB_SUFFIX)
+
+    def get_raw_blob_location(self, sum):
+        """Returns a (path, offset) tuple telling where the data of
+        the given raw blob starts. The path is either the blob's own
+        file or a pack. Returns None if there is no such raw blob, or
+        if it is compressed."""
+        blobpath = self.get_blob_path(sum)
+        if os.path.exists(blobpath):
+            return blobpath, 0
+        location = self.packs.lookup(sum)
+        if location:
+            return location[0], location[1]
+        return None
+
+    def __open_raw_blob(self, sum, offset):
+        """Returns a file object positioned at the given offset in the
+        given raw blob, or None if there is no such raw blob."""
+        location = self.get_raw_blob_location(sum)
+        if location:
+            path, blob_offset = location
+            f = open(path, "rb")
+            f.seek(blob_offset + offset)
+            return f
+        compressed_path = self.get_compressed_blob_path(sum)
+        if os.path.exists(compressed_path):
+            f = zblob.ZBlobReader(compressed_path)
+            f.seek(offset)
+            return f
+        return None
+
     def get_recipe_path(self, recipe):
         if is_recipe_filename(recipe):
             recipe = recipe.split(".")[0]
@@ -142,63 +369,88 @@ class Repo:
     def has_raw_blob(self, sum):
         """Returns true if there is an actual (non-recipe based)
         blob with the given checksum"""
-        blobpath = self.get_blob_path(sum)
-        return os.path.exists(blobpath)
+        if self.blobindex_ok:
+            return self.__blobindex_lookup(self.blobindex.has_raw, sum)
+        return self.get_raw_blob_location(sum) != None or \
+            os.path.exists(self.get_compressed_blob_path(sum))
 
     def has_recipe_blob(self, sum):
+        if self.blobindex_ok:
+            return self.__blobindex_lookup(self.blobindex.has_recipe, sum)
         return os.path.exists(self.get_recipe_path(sum))
 
     def has_blob(self, sum):
         """Returns true if there is a blob with the given
         checksum. The blob may be raw or recipe-based."""
-        blobpath = self.get_blob_path(sum)
+        if self.blobindex_ok:
+            return self.__blobindex_lookup(self.blobindex.get_size, sum) != None
         recpath = self.get_recipe_path(sum)
-        return os.path.exists(blobpath) or os.path.exists(recpath)
+        return self.get_raw_blob_location(sum) != None or \
+            os.path.exists(self.get_compressed_blob_path(sum)) or os.path.exists(recpath)
 
     def get_recipe(self, sum):
         recpath = self.get_recipe_path(sum)
         if not os.path.exists(recpath):
             return None
-        recipe = read_json(f)
+        recipe = read_json(recpath)
         return recipe
 
     def get_blob_size(self, sum):
+        if self.blobindex_ok:
+            size = self.__blobindex_lookup(self.blobindex.get_size, sum)
+            if size == None:
+                raise ValueError("No such blob or recipe exists: "+sum)
+            return size
         blobpath = self.get_blob_path(sum)
         if os.path.exists(blobpath):
             return os.path.getsize(blobpath)
+        location = self.packs.lookup(sum)
+        if location:
+            return location[2]
+        compressed_path = self.get_compressed_blob_path(sum)
+        if os.path.exists(compressed_path):
+            return zblob.get_size(compressed_path)
         recipe = self.get_recipe(sum)
         if not recipe:
             raise ValueError("No such blob or recipe exists: "+sum)
         return recipe['size']
 
     def get_blob_reader(self, sum, offset = 0, size = -1):
-        if self.has_raw_blob(sum):
-            blobsize = self.get_blob_size(sum)
-            if size == -1:
-                size = blobsize
-            assert blobsize <= offset + size
-            path = self.get_blob_path(sum)
-            fo = open(path, "rb")
-            fo.seek(offset)
+        """Returns a data source for the given range of the blob. A
+        size of -1 means the rest of the blob."""
+        blobsize = self.get_blob_size(sum)
+        if size == -1:
+            size = blobsize - offset
+        assert 0 <= offset and 0 <= size and offset + size <= blobsize, \
+            "Invalid range %s+%s for blob of size %s" % (offset, size, blobsize)
+        fo = self.__open_raw_blob(sum, offset)
+        if fo:
             return FileDataSource(fo, size)
         recipe = self.get_recipe(sum)
         if recipe:
-            assert False, "Recipes not implemented yet"
+            return RecipeDataSource(create_blob_reader(recipe, self), offset, size)
         raise ValueError("No such blob or recipe exists: "+sum)
 
     def get_blob(self, sum, offset = 0, size = -1):
         """ Returns None if there is no such blob """
-        if self.has_raw_blob(sum):
-            path = self.get_blob_path(sum)
-            with open(path, "rb") as f:
-                f.seek(offset)
+        f = self.__open_raw_blob(sum, offset)
+        if f:
+            # A packed blob is followed by other data, so reads must
+            # not go beyond its end
+            size_left = max(0, self.get_blob_size(sum) - offset)
+            if size == -1 or size > size_left:
+                size = size_left
+            with f:
                 data = f.read(size)
             return data
         recipe = self.get_recipe(sum)
         if recipe:
             reader = create_blob_reader(recipe, self)
-            reader.seek(offset)
-            return reader.read(size)
+            try:
+                reader.seek(offset)
+                return reader.read(size)
+            finally:
+                reader.close()
         else:
             raise ValueError("No such blob or recipe exists: "+sum)
 
@@ -221,11 +473,109 @@ class Repo:
     def get_session(self, id):
         assert id, "Id was: "+ str(id)
         misuse_assert(self.has_snapshot(id), "There is no snapshot with id %s" % id)
-        if id not in self.session_readers:
-            self.session_readers[id] = sessions.SessionReader(self, self.get_session_path(id))
-        return self.session_readers[id]
+        with self.lock:
+            if id not in self.session_readers:
+                self.session_readers[id] = sessions.SessionReader(self, self.get_session_path(id))
+            return self.session_readers[id]
+
+    def get_manifest_path(self, session_id, binary = True):
+        if binary:
+            filename = str(session_id) + ".bin"
+        else:
+            filename = str(session_id) + ".json"
+        return os.path.join(self.repopath, DERIVED_DIR, MANIFESTS_DIR, filename)
+
+    def has_manifest(self, session_id):
+        return os.path.exists(self.get_manifest_path(session_id)) or \
+            os.path.exists(self.get_manifest_path(session_id, binary = False))
+
+    def read_manifest(self, session_id):
+        """Returns the full list of blobinfos for the given snapshot,
+        or None if no manifest has been stored for it. The returned
+        value is an iterable of blobinfos. If the manifest is in the
+        binary format, it is a ManifestReader that also supports
+        lookups by filename."""
+        path = self.get_manifest_path(session_id)
+        if os.path.exists(path):
+            return manifest.ManifestReader(path)
+        path = self.get_manifest_path(session_id, binary = False)
+        if os.path.exists(path):
+            return read_json(path)
+        return None
+
+    def write_manifest(self, session_id, blobinfos, binary_only = False):
+        """Stores the given full list of blobinfos as the manifest of
+        the given snapshot. It is the responsibility of the caller to
+        provide the correct list. The binary format is used unless
+        some blobinfo contains data that it can not represent. In that
+        case, nothing is stored if binary_only is True. Returns True
+        if a manifest was stored."""
+        blobinfos = list(blobinfos)
+        data = manifest.encode_manifest(blobinfos)
+        binary = (data != None)
+        if not binary:
+            if binary_only:
+                return False
+            data = json.dumps(blobinfos)
+        path = self.get_manifest_path(session_id, binary)
+        manifest_dir = os.path.dirname(path)
+        if not os.path.exists(manifest_dir):
+            self.__make_derived_dir()
+            try:
+                os.mkdir(manifest_dir)
+            except OSError:
+                pass # Probably created concurrently
+        fd, tmp_path = tempfile.mkstemp(dir = manifest_dir, prefix = "manifest_")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        replace_file(tmp_path, path)
+        return True
+
+    def get_delta_chain_length(self, session_id):
+        """Returns the number of bloblists that has to be read to
+        resolve the full file list of the given snapshot, not counting
+        the manifest where the chain ends, if any."""
+        length = 0
+        while session_id and not self.has_manifest(session_id):
+            length += 1
+            session_id = self.get_session(session_id).get_properties().get("base_session", None)
+        return length
+
+    def build_manifests(self, interval = None):
+        """Stores manifests for existing snapshots so that no snapshot
+        requires more than 'interval' bloblists to be resolved, and
+        binary manifests for snapshots whose own bloblist has at least
+        manifest_min_files entries. Returns the number of manifests
+        created."""
+        if interval == None:
+            interval = self.manifest_interval
+        assert interval >= 1
+        chain_lengths = {}
+        created = 0
+        for sid in self.get_all_sessions():
+            if self.has_manifest(sid):
+                chain_lengths[sid] = 0
+                continue
+            base = self.get_session(sid).get_properties().get("base_session", None)
+            if base:
+                length = chain_lengths[base] + 1
+            else:
+                length = 1
+            reader = self.get_session(sid)
+            if length >= interval:
+                self.write_manifest(sid, reader.get_all_blob_infos())
+                length = 0
+                created += 1
+            elif len(reader.get_raw_bloblist()) >= self.manifest_min_files:
+                if self.write_manifest(sid, reader.get_all_blob_infos(), binary_only = True):
+                    length = 0
+                    created += 1
+            chain_lengths[sid] = length
+        return created
 
     def create_session(self, session_name, base_session = None, session_id = None):
+        with self.lock:
+            self.blobindex.refresh()
         return sessions.SessionWriter(self, session_name = session_name, \
                                           base_session = base_session, \
                                           session_id = session_id)
@@ -233,15 +583,45 @@ class Repo:
     def find_last_revision(self, session_name):
         """ Returns the id of the latest snapshot in the specified
         session. Returns None if there is no such session. """
-        all_sids = self.get_all_sessions()
-        all_sids.sort()
-        all_sids.reverse()
-        for sid in all_sids:
-            session = self.get_session(sid)
-            name = session.get_client_value("name")
-            if name == session_name:
-                return sid
-        return None
+        sids = self.get_session_ids_by_name(session_name)
+        if not sids:
+            return None
+        return sids[-1]
+
+    def get_session_ids_by_name(self, session_name):
+        """ Returns a sorted list of the ids of all snapshots in the
+        given session. """
+        with self.lock:
+            return self.__get_sessionindex().get_ids(session_name)
+
+    def __get_sessionindex(self):
+        """Returns the session name index, after making sure that it
+        contains all the snapshots in the repository. Snapshots
+        committed without updating the index (by an interrupted
+        commit or an older version of boar) are added here."""
+        index = self.sessionindex
+        index.refresh()
+        last_session = index.get_last_session()
+        rebuild = last_session == None or \
+            (last_session > 0 and not self.has_snapshot(last_session))
+        if rebuild:
+            # Missing or inconsistent with the repo, start from scratch
+            index.reset()
+            new_sids = self.get_all_sessions()
+        else:
+            new_sids = []
+            while self.has_snapshot(last_session + 1):
+                last_session += 1
+                new_sids.append(last_session)
+        for sid in new_sids:
+            index.add(sid, self.get_session(sid).get_client_value("name"))
+        if rebuild or new_sids:
+            try:
+                self.__make_derived_dir()
+                index.save()
+            except (IOError, OSError):
+                pass # Read-only repository, the index is only kept in memory
+        return index
 
     def find_next_session_id(self):
         assert os.path.exists(self.repopath)
@@ -249,39 +629,90 @@ class Repo:
         session_dirs.append(0)
         return max(session_dirs) + 1            
 
+    def __scan_raw_blob_names(self):
+        """Yields the names of all raw blobs in the blobs directory,
+        one shard directory at a time. Packed blobs are not
+        included."""
+        blobdir = os.path.join(self.repopath, BLOB_DIR)
+        for dirname in sorted(os.listdir(blobdir)):
+            if not re.match("^[0-9a-f]{2}$", dirname):
+                continue
+            for blobname in os.listdir(os.path.join(blobdir, dirname)):
+                if is_md5sum(blobname) and blobname.startswith(dirname):
+                    yield blobname
+
+    def __scan_compressed_blob_names(self):
+        blobdir = os.path.join(self.repopath, BLOB_DIR)
+        for dirname in sorted(os.listdir(blobdir)):
+            if not re.match("^[0-9a-f]{2}$", dirname):
+                continue
+            for filename in os.listdir(os.path.join(blobdir, dirname)):
+                blobname = filename[:-len(COMPRESSED_BLOB_SUFFIX)]
+                if filename.endswith(COMPRESSED_BLOB_SUFFIX) and is_md5sum(blobname) \
+                        and blobname.startswith(dirname):
+                    yield blobname
+
+    def __scan_recipe_names(self):
+        for filename in os.listdir(os.path.join(self.repopath, RECIPES_DIR)):
+            if is_recipe_filename(filename):
+                yield filename.split(".")[0]
+
+    def iter_raw_blob_names(self):
+        if self.blobindex_ok:
+            with self.lock:
+                self.blobindex.refresh()
+                return self.blobindex.iter_raw_names()
+        return self.__scan_all_raw_blob_names()
+
+    def __scan_all_raw_blob_names(self):
+        for blobname in self.__scan_raw_blob_names():
+            yield blobname
+        for blobname, size in self.packs.iter_blobs():
+            yield blobname
+        for blobname in self.__scan_compressed_blob_names():
+            yield blobname
+
+    def iter_recipe_names(self):
+        if self.blobindex_ok:
+            with self.lock:
+                self.blobindex.refresh()
+                return self.blobindex.iter_recipe_names()
+        return self.__scan_recipe_names()
+
+    def iter_blob_names(self):
+        """Yields the names of all blobs in the repository, raw or
+        recipe based, without building a list of them first. Every
+        blob is yielded exactly once."""
+        for blobname in self.iter_raw_blob_names():
+            yield blobname
+        for blobname in self.iter_recipe_names():
+            if not self.has_raw_blob(blobname):
+                yield blobname
+
     def get_blob_names(self):
-        blobpattern = re.compile("/([0-9a-f]{32})$")
-        assert blobpattern.search("b5/b5fb453aeaaef8343353cc1b641644f9")
-        tree = get_tree(os.path.join(self.repopath, BLOB_DIR))
-        matches = set()
-        for f in tree:
-            m = blobpattern.search(f)
-            if m:
-                matches.add(m.group(1))
-        blobpattern = re.compile("([0-9a-f]{32})\\.recipe$")
-        tree = get_tree(os.path.join(self.repopath, RECIPES_DIR))
-        for f in tree:
-            m = blobpattern.search(f)
-            if m:
-                matches.add(m.group(1))
-        return list(matches)
+        return list(self.iter_blob_names())
 
     def verify_blob(self, sum):
         recipe = self.get_recipe(sum)
         if recipe:
             reader = create_blob_reader(recipe, self)
-            verified_ok = (sum == md5sum_file(reader))
+            try:
+                verified_ok = (sum == md5sum_file(reader))
+            finally:
+                reader.close()
         elif self.has_raw_blob(sum):
-            path = self.get_blob_path(sum)
-            verified_ok = (sum == md5sum_file(path))
+            size = self.get_blob_size(sum)
+            f = self.__open_raw_blob(sum, 0)
+            with f:
+                start = f.tell()
+                verified_ok = (sum == md5sum_file(f, start, start + size))
         else:
             raise ValueError("No such blob or recipe: " + sum)
         return verified_ok 
 
     def find_redundant_raw_blobs(self):
-        all_blobs = self.get_blob_names()
-        for blob in all_blobs:
-            if self.has_recipe_blob(blob) and self.has_raw_blob(blob):
+        for blob in self.iter_recipe_names():
+            if self.has_raw_blob(blob):
                 yield blob
 
     def isIdentical(self, other_repo):
@@ -314,14 +745,11 @@ class Repo:
             "Cannot pull: %s is not a continuation of %s" % (other_repo, self)
 
         # Copy all new blobs
-        self_blobs = set(self.get_blob_names())
-        other_blobs = set(other_repo.get_blob_names())
+        self_blobs = set(self.iter_blob_names())
+        other_blobs = set(other_repo.iter_blob_names())
         assert set(self_blobs) <= set(other_blobs), \
             "Other repo is missing some blobs that are present in this repo. Corrupt repository?"
 
-        for blobname in other_blobs - self_blobs:
-            assert other_repo.has_raw_blob(blobname), "Cloning of recipe blobs not yet implemented"
-
         # Copy all new sessions
         self_sessions = set(self.get_all_sessions())
         other_sessions = set(other_repo.get_all_sessions())
@@ -344,11 +772,12 @@ class Repo:
         return result
 
     def consolidate_snapshot(self, session_path, forced_session_id = None):
-        self.repo_mutex.lock_with_timeout(60)
-        try:
-            return self.__consolidate_snapshot(session_path, forced_session_id)
-        finally:
-            self.repo_mutex.release()
+        with self.lock:
+            self.repo_mutex.lock_with_timeout(60)
+            try:
+                return self.__consolidate_snapshot(session_path, forced_session_id)
+            finally:
+                self.repo_mutex.release()
 
     def __consolidate_snapshot(self, session_path, forced_session_id):
         assert self.repo_mutex.is_locked()
@@ -361,10 +790,53 @@ class Repo:
         assert session_id not in self.get_all_sessions()
         queue_dir = self.get_queue_path(str(session_id))
         shutil.move(session_path, queue_dir)
-        self.process_queue()
+        self.process_queue(trusted = True)
         return session_id
 
-    def process_queue(self):
+    def __get_blobs_to_verify(self, queued_item, blobnames, trusted):
+        """Returns the names of the queued blobs that must be
+        re-hashed according to the verify policy. Blobs that the
+        writer has verified are only trusted if 'trusted' is True and
+        their sizes matches what the writer recorded."""
+        verified_path = os.path.join(queued_item, VERIFIED_BLOBS_FILE)
+        if not trusted or self.verify_policy == VERIFY_FULL or not os.path.exists(verified_path):
+            return blobnames
+        verified_sizes = read_json(verified_path)
+        to_verify = []
+        trusted_blobs = []
+        for blobname in blobnames:
+            size = os.path.getsize(os.path.join(queued_item, blobname))
+            if verified_sizes.get(blobname, None) == size:
+                trusted_blobs.append(blobname)
+            else:
+                to_verify.append(blobname)
+        if self.verify_policy == VERIFY_SAMPLED:
+            to_verify += random.sample(trusted_blobs, min(VERIFY_SAMPLE_COUNT, len(trusted_blobs)))
+        return to_verify
+
+    def __store_compressed(self, path, blobname):
+        """Moves the given queued blob into the repository in
+        compressed form, if it compresses well. Returns True if it
+        did."""
+        compressed_path = self.get_compressed_blob_path(blobname)
+        if not os.path.exists(compressed_path):
+            if not zblob.worth_compressing(path):
+                return False
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.join(self.repopath, TMP_DIR), prefix = "zblob_")
+            os.close(fd)
+            compressed_size = zblob.compress_file(path, tmp_path)
+            if compressed_size > os.path.getsize(path) * zblob.MAX_RATIO:
+                os.remove(tmp_path)
+                return False
+            move_file(tmp_path, compressed_path, mkdirs = True)
+        os.remove(path)
+        return True
+
+    def process_queue(self, trusted = False):
+        """Moves a queued snapshot into the repository. If 'trusted'
+        is False, which it must be for snapshots that are left in the
+        queue after an interrupted commit, all blobs are verified
+        regardless of the verify policy."""
         assert self.repo_mutex.is_locked()
         session_id = self.get_queued_session_id()
         if session_id == None:
@@ -372,10 +844,9 @@ class Repo:
         queued_item = self.get_queue_path(str(session_id))
         items = os.listdir(queued_item)
 
-        # Check the checksums of all blobs
-        for filename in items:
-            if not is_md5sum(filename):
-                continue
+        # Check the checksums of the blobs
+        blobnames = [filename for filename in items if is_md5sum(filename)]
+        for filename in self.__get_blobs_to_verify(queued_item, blobnames, trusted):
             blob_path = os.path.join(queued_item, filename)
             assert filename == md5sum_file(blob_path), "Invalid blob found in queue dir:" + blob_path
     
@@ -396,6 +867,9 @@ class Repo:
                 continue
             if filename in ["session.md5"]:
                 continue
+            if filename == VERIFIED_BLOBS_FILE:
+                read_json(os.path.join(queued_item, filename)) # Check if malformed
+                continue
             if is_recipe_filename(filename):
                 read_json(os.path.join(queued_item, filename)) # Check if malformed
                 continue
@@ -407,10 +881,46 @@ class Repo:
                      "session.json", "bloblist.json", "session.md5"]), \
                      "Missing files in queue dir: "+str(contents)
 
-        # Everything seems OK, move the blobs and consolidate the session
+        # Everything seems OK. Update the blob index before anything
+        # is moved, so that an interrupted commit can never leave
+        # blobs in the repository that the index does not know about.
+        if self.blobindex_ok:
+            # Some other process may have committed without updating
+            # the index, in which case it can no longer be trusted.
+            self.blobindex.refresh()
+            self.__check_blobindex()
+        if self.blobindex_ok:
+            index_entries = []
+            for filename in items:
+                if is_md5sum(filename):
+                    size = os.path.getsize(os.path.join(queued_item, filename))
+                    index_entries.append((blobindex.KIND_RAW, filename, size))
+                elif is_recipe_filename(filename):
+                    size = read_json(os.path.join(queued_item, filename))['size']
+                    index_entries.append((blobindex.KIND_RECIPE, filename.split(".")[0], size))
+            self.blobindex.add_blobs(index_entries, session_id)
+
+        # Small blobs are added to a pack. They must be written to disk
+        # before they are removed from the queue.
+        packed_blobs = set()
+        if self.max_packed_blob_size != None:
+            packed_blobs = set([filename for filename in items if is_md5sum(filename) and \
+                                    os.path.getsize(os.path.join(queued_item, filename)) <= self.max_packed_blob_size])
+        if packed_blobs:
+            self.packs.add_blobs([(filename, os.path.join(queued_item, filename))
+                                  for filename in sorted(packed_blobs)])
+            for filename in packed_blobs:
+                os.remove(os.path.join(queued_item, filename))
+
+        # Move the blobs and consolidate the session
         for filename in items:
+            if filename in packed_blobs:
+                continue
             if is_md5sum(filename):
                 blob_to_move = os.path.join(queued_item, filename)
+                if self.blob_compression != BLOB_COMPRESSION_OFF and \
+                        self.__store_compressed(blob_to_move, filename):
+                    continue
                 destination_path = self.get_blob_path(filename)
                 move_file(blob_to_move, destination_path, mkdirs = True)
             elif is_recipe_filename(filename):
@@ -420,8 +930,14 @@ class Repo:
             else:
                 pass # The rest becomes a snapshot definition directory
 
+        verified_path = os.path.join(queued_item, VERIFIED_BLOBS_FILE)
+        if os.path.exists(verified_path):
+            # Only meaningful during the commit
+            os.remove(verified_path)
         session_path = os.path.join(self.repopath, SESSIONS_DIR, str(session_id))
         shutil.move(queued_item, session_path)
         assert not self.get_queued_session_id(), "Commit completed, but queue should be empty after processing"
+        # Makes sure the new snapshot is recorded in the session index
+        self.__get_sessionindex()
 
 
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+The session index maps every session name to the ids of its
+snapshots, so that the latest snapshot of a session can be found
+without reading the session.json file of every snapshot in the
+repository. It is stored as a json file on the following form:
+
+{
+    "version": 1,
+    "last_session": 17,
+    "sessions": {"MySession": [2, 5, 17], "__meta_MySession": [3]}
+}
+
+The "last_session" value is the highest snapshot id that has been
+recorded in the index. Any snapshots with higher ids have been
+committed without updating the index, and must be added before the
+index can be used.
+"""
+
+import os
+import tempfile
+
+from common import *
+
+INDEX_VERSION = 1
+
+class SessionNameIndex:
+    def __init__(self, path):
+        self.path = path
+        self.sessions = {}
+        self.last_session = None
+        self.loaded_stat = None
+        self.refresh()
+
+    def refresh(self):
+        """Reloads the index if the file has been changed since it was
+        last read, possibly by another process."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self.clear()
+            return
+        stat_key = (st.st_ino, st.st_size, st.st_mtime)
+        if stat_key == self.loaded_stat:
+            return
+        self.clear()
+        try:
+            data = read_json(self.path)
+        except ValueError:
+            return # Corrupt index - treat as missing
+        if data.get("version") != INDEX_VERSION:
+            return
+        self.sessions = data['sessions']
+        self.last_session = data['last_session']
+        self.loaded_stat = stat_key
+
+    def clear(self):
+        self.sessions = {}
+        self.last_session = None
+        self.loaded_stat = None
+
+    def reset(self):
+        """Empties the index, in preparation of a rebuild."""
+        self.clear()
+        self.last_session = 0
+
+    def get_last_session(self):
+        """Returns the highest snapshot id recorded in the index, 0 for
+        an empty index or None if there is no index."""
+        return self.last_session
+
+    def get_ids(self, session_name):
+        """Returns a sorted list of all the snapshot ids for the given
+        session name."""
+        return list(self.sessions.get(session_name, []))
+
+    def get_names(self):
+        return self.sessions.keys()
+
+    def add(self, session_id, session_name):
+        """Records a snapshot in the index. Snapshots must be added in
+        increasing id order. The change is not persisted until save()
+        is called."""
+        assert session_id > self.last_session, \
+            "Snapshot %s added to session index out of order" % session_id
+        self.sessions.setdefault(session_name, []).append(session_id)
+        self.last_session = session_id
+
+    def save(self):
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(self.path),
+                                        prefix = "sessionindex_")
+        with os.fdopen(fd, "wb") as f:
+            json.dump({'version': INDEX_VERSION,
+                       'last_session': self.last_session,
+                       'sessions': self.sessions}, f)
+        replace_file(tmp_path, self.path)
+        st = os.stat(self.path)
+        self.loaded_stat = (st.st_ino, st.st_size, st.st_mtime)
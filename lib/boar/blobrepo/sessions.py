@@ -27,6 +27,9 @@ import shutil
 import hashlib
 import types
 
+from manifest import ManifestReader
+from chunker import chunk_file, create_recipe
+
 from common import *
 
 """
@@ -76,6 +79,34 @@ def bloblist_fingerprint(bloblist):
         md5.update(sep)
     return md5.hexdigest()
 
+class BlobUpload:
+    """A handle for writing the data of a new blob in a snapshot. The
+    data may be given as strings or buffers. The file is kept open
+    until the handle is closed, at which point it is synced to disk
+    once."""
+
+    def __init__(self, path, blob_md5, summer):
+        self.blob_md5 = blob_md5
+        self.summer = summer
+        self.bytes_written = 0
+        self.f = open(path, "ab")
+
+    def write(self, data):
+        assert self.f, "Tried to write to a closed blob upload"
+        self.summer.update(data)
+        self.f.write(data)
+        self.bytes_written += len(data)
+
+    def is_closed(self):
+        return self.f == None
+
+    def close(self):
+        if self.f:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+            self.f = None
+
 class SessionWriter:
     def __init__(self, repo, session_name, base_session = None, session_id = None):
         assert session_name and isinstance(session_name, basestring)
@@ -87,6 +118,8 @@ class SessionWriter:
         self.metadatas = {}
         # Summers for new blobs. { blobname: summer, ... }
         self.blob_checksummers = {}
+        # Only one blob upload is kept open at a time
+        self.current_upload = None
         self.session_mutex = FileMutex(os.path.join(self.repo.repopath, repository.TMP_DIR), self.session_name)
         self.session_mutex.lock()
         assert os.path.exists(self.repo.repopath)
@@ -106,22 +139,55 @@ class SessionWriter:
                 self.repo.get_session(self.base_session).get_all_blob_infos())
         self.resulting_blobdict = self.base_bloblist_dict
 
+        # What the chunking of large blobs achieved in this commit
+        self.chunking_stats = {'chunked_blobs': 0,
+                               'chunked_bytes': 0,
+                               'new_bytes': 0}
+
         self.forced_session_id = None
         if session_id != None:
             self.forced_session_id = int(session_id)
             assert self.forced_session_id > 0
 
-    def add_blob_data(self, blob_md5, fragment):
-        """ Adds the given fragment to the end of the new blob with the given checksum."""
+    def open_blob(self, blob_md5):
+        """Returns a BlobUpload handle that appends data to the end of
+        the new blob with the given checksum. Any previously opened
+        upload handle is closed."""
         assert is_md5sum(blob_md5)
         assert not self.repo.has_blob(blob_md5), "blob already exists"
+        self.__close_upload()
         if not self.blob_checksummers.has_key(blob_md5):
             self.blob_checksummers[blob_md5] = hashlib.md5()
-        summer = self.blob_checksummers[blob_md5]
-        summer.update(fragment)
         fname = os.path.join(self.session_path, blob_md5)
-        with open(fname, "ab") as f:
-            f.write(fragment)
+        self.current_upload = BlobUpload(fname, blob_md5, self.blob_checksummers[blob_md5])
+        return self.current_upload
+
+    def add_blob_data(self, blob_md5, fragment):
+        """ Adds the given fragment to the end of the new blob with the given checksum."""
+        if not self.current_upload or self.current_upload.is_closed() or \
+                self.current_upload.blob_md5 != blob_md5:
+            self.open_blob(blob_md5)
+        self.current_upload.write(fragment)
+
+    def add_blob_stream(self, blob_md5, datasource):
+        """ Adds all the data in the given DataSource as a new blob
+        with the given checksum. The checksum is verified when the
+        data source is exhausted. Returns the number of bytes added."""
+        assert blob_md5 not in self.blob_checksummers, "blob already added"
+        upload = self.open_blob(blob_md5)
+        while datasource.bytes_left() > 0:
+            upload.write(datasource.read(2**20))
+        upload.close()
+        if upload.summer.hexdigest() != blob_md5:
+            del self.blob_checksummers[blob_md5]
+            os.remove(os.path.join(self.session_path, blob_md5))
+            raise AddException("Blob data did not match the expected checksum " + blob_md5)
+        return upload.bytes_written
+
+    def __close_upload(self):
+        if self.current_upload:
+            self.current_upload.close()
+            self.current_upload = None
 
     def has_blob(self, csum):
         fname = os.path.join(self.session_path, csum)
@@ -139,9 +205,13 @@ class SessionWriter:
         assert not metadata['filename'].endswith("/"), \
             "Filenames must not end with a path separator. Was:" + metadata['filename']
         new_blob_filename = os.path.join(self.session_path, metadata['md5sum'])
-        assert self.repo.has_blob(metadata['md5sum']) \
+        assert metadata['md5sum'] in self.blob_checksummers \
+            or self.repo.has_blob(metadata['md5sum']) \
             or os.path.exists(new_blob_filename), "Tried to add blob info, but no such blob exists: "+new_blob_filename
         assert metadata['filename'] not in self.metadatas
+        if self.current_upload and self.current_upload.blob_md5 == metadata['md5sum']:
+            # The blob is complete
+            self.__close_upload()
         self.metadatas[metadata['filename']] = metadata
         self.resulting_blobdict[metadata['filename']] = metadata
 
@@ -165,8 +235,7 @@ class SessionWriter:
                 # Probably a deletion entry
                 continue
             blobname = metadata['md5sum']
-            assert session.repo.has_raw_blob(blobname), "Other repo does not appear to have the blob we need"+\
-                "(Recipe? Cloning of recipes not yet supported)"
+            assert session.repo.has_blob(blobname), "Other repo does not appear to have the blob we need"
             if not self.repo.has_blob(blobname) and blobname not in added_blobs:
                 size = session.repo.get_blob_size(blobname)
                 offset = 0
@@ -187,28 +256,34 @@ class SessionWriter:
         the second part will begin with byte n as the first byte."""
 
         blob_path = self.repo.get_blob_path(blob)
-        pieces = split_file(blob_path, self.session_path, cut_positions, \
-                                lambda b: not self.repo.has_blob(b))
+        tmp_path = None
+        if not os.path.exists(blob_path):
+            # A packed or compressed blob
+            fd, tmp_path = tempfile.mkstemp(dir = self.session_path, prefix = "split_")
+            reader = self.repo.get_blob_reader(blob)
+            with os.fdopen(fd, "wb") as f:
+                while reader.bytes_left():
+                    f.write(reader.read(2**20))
+            blob_path = tmp_path
+        try:
+            pieces = split_file(blob_path, self.session_path, cut_positions, \
+                                    lambda b: not self.repo.has_raw_blob(b))
+        finally:
+            if tmp_path:
+                os.remove(tmp_path)
         recipe_pieces = []
-        offset = 0
         for piece in pieces:
             piece_path = os.path.join(self.session_path, piece)
-            if self.repo.has_blob(piece):
-                piece_size = self.get_blob_size(piece)
-            else:
+            if os.path.exists(piece_path):
                 piece_size = os.path.getsize(piece_path)
-            recipe_pieces.append({"source": piece,
-                                  "offset": offset,
-                                  "length": piece_size})
+            else:
+                piece_size = self.repo.get_blob_size(piece)
+            recipe_pieces.append((piece, piece_size))
             
         recipe_path = os.path.join(self.session_path, blob + ".recipe")
         assert not os.path.exists(recipe_path)
         # TODO: resolve secondary recipes - only first level blobs allowed
-        write_json(recipe_path,
-                   {"method": "concat",
-                    "md5sum": blob,
-                    "size": self.repo.get_blob_size(blob),
-                    "pieces": recipe_pieces})
+        write_json(recipe_path, create_recipe(blob, recipe_pieces))
         
         # Exekvera transaktionen
         #     Kopiera de nya blobbarna till sina positioner
@@ -220,7 +295,10 @@ class SessionWriter:
         # Saker att testa: Splitta en fil i delar som finns som blobbar
 
 
-    def commit(self, sessioninfo = {}):
+    def commit(self, sessioninfo = None):
+        if sessioninfo == None:
+            # Not a default argument, as the dict is modified below
+            sessioninfo = {}
         try:
             return self.__commit(sessioninfo)
         finally:
@@ -228,8 +306,16 @@ class SessionWriter:
 
     def __commit(self, sessioninfo):
         assert self.session_path != None
+        self.__close_upload()
         for name, summer in self.blob_checksummers.items():
             assert name == summer.hexdigest(), "Corrupted blob found in new session. Commit aborted."
+        # Tell the repository which blobs that does not need to be verified again
+        verified_sizes = {}
+        for name in self.blob_checksummers.keys():
+            verified_sizes[name] = os.path.getsize(os.path.join(self.session_path, name))
+        if self.repo.chunker:
+            self.__chunk_new_blobs(verified_sizes)
+        write_json(os.path.join(self.session_path, repository.VERIFIED_BLOBS_FILE), verified_sizes)
         if sessioninfo == {}:
             sessioninfo['name'] = self.session_name
         assert self.session_name == sessioninfo['name'], \
@@ -259,8 +345,38 @@ class SessionWriter:
         assert self.latest_snapshot == self.repo.find_last_revision(self.session_name), \
             "Session has been updated concurrently (Should not happen. Lockfile problems?) Commit aborted."
         session_id = self.repo.consolidate_snapshot(self.session_path, self.forced_session_id)
+        if self.base_session and \
+                self.repo.get_delta_chain_length(self.base_session) + 1 >= self.repo.manifest_interval:
+            self.repo.write_manifest(session_id, self.resulting_blobdict.values())
+        elif len(self.metadatas) >= self.repo.manifest_min_files:
+            # A json manifest would be no faster than the bloblist
+            self.repo.write_manifest(session_id, self.resulting_blobdict.values(), binary_only = True)
         return session_id
     
+    def __chunk_new_blobs(self, verified_sizes):
+        """Replaces the large new blobs with recipes over content
+        defined chunks. Only the chunks that do not already exist in
+        the repository are stored. The given {blobname: size} dict of
+        verified blobs is updated to match."""
+        chunker = self.repo.chunker
+        for name in sorted(self.blob_checksummers.keys()):
+            blob_path = os.path.join(self.session_path, name)
+            size = verified_sizes[name]
+            if size < chunker.min_blob_size:
+                continue
+            pieces, written = chunk_file(chunker, blob_path, self.session_path,
+                                         lambda piece: not self.repo.has_raw_blob(piece))
+            assert sum([piece_size for piece, piece_size in pieces]) == size
+            if len(pieces) < 2:
+                continue
+            write_json(os.path.join(self.session_path, name + ".recipe"), create_recipe(name, pieces))
+            os.remove(blob_path)
+            del verified_sizes[name]
+            verified_sizes.update(written)
+            self.chunking_stats['chunked_blobs'] += 1
+            self.chunking_stats['chunked_bytes'] += size
+            self.chunking_stats['new_bytes'] += sum(written.values())
+
     def __del__(self):
         if self.session_mutex.is_locked():
             self.session_mutex.release()
@@ -274,8 +390,10 @@ class SessionReader:
         self.path = session_path
         self.repo = repo
         assert os.path.exists(self.path), "No such session path:" + self.path
+        self.session_id = int(os.path.basename(self.path))
 
         self.bloblist = None
+        self.manifest = None
         self.verified = False
 
         path = os.path.join(self.path, "session.json")
@@ -303,19 +421,83 @@ class SessionReader:
             self.bloblist = read_json(path)
 
     def get_all_blob_infos(self):
+        """Yields the full list of files in this snapshot. Instead of
+        recursing through every base snapshot, the chain of bloblists
+        is followed back to the nearest snapshot that has a stored
+        manifest (or to the first snapshot of the chain), and the
+        bloblists are then applied in order on top of it."""
+        chain = []
+        manifest = None
+        reader = self
+        while reader:
+            manifest = reader.__get_manifest()
+            if manifest != None:
+                break
+            chain.append(reader)
+            base_session_id = reader.properties.get("base_session", None)
+            reader = None
+            if base_session_id:
+                reader = self.repo.get_session(base_session_id)
+        blobdict = {}
+        if manifest:
+            blobdict = bloblist_to_dict(manifest)
+        for reader in reversed(chain):
+            # Later entries overrides earlier ones
+            for blobinfo in reader.__get_checked_bloblist():
+                if blobinfo.get("action", None) == "remove":
+                    blobdict.pop(blobinfo['filename'], None)
+                else:
+                    blobdict[blobinfo['filename']] = blobinfo
+        if len(chain) >= self.repo.manifest_interval:
+            self.__store_manifest(blobdict.values())
+        for blobinfo in blobdict.itervalues():
+            yield copy.copy(blobinfo)
+
+    def get_blob_info(self, filename):
+        """Returns the blobinfo for the given filename in this
+        snapshot, or None if there is no such file. Only the bloblists
+        that are needed to find the file are read, and a binary
+        manifest is searched without being decoded."""
+        reader = self
+        while reader:
+            manifest = reader.__get_manifest()
+            if isinstance(manifest, ManifestReader):
+                return manifest.get(filename)
+            elif manifest != None:
+                for blobinfo in manifest:
+                    if blobinfo['filename'] == filename:
+                        return copy.copy(blobinfo)
+                return None
+            for blobinfo in reader.__get_checked_bloblist():
+                if blobinfo['filename'] == filename:
+                    if blobinfo.get("action", None) == "remove":
+                        return None
+                    return copy.copy(blobinfo)
+            base_session_id = reader.properties.get("base_session", None)
+            reader = None
+            if base_session_id:
+                reader = self.repo.get_session(base_session_id)
+        return None
+
+    def __get_manifest(self):
+        if self.manifest == None:
+            self.manifest = self.repo.read_manifest(self.session_id)
+        return self.manifest
+
+    def __get_checked_bloblist(self):
         self.__load_bloblist()
         seen = set()
         for blobinfo in self.bloblist:
             assert blobinfo['filename'] not in seen, \
                 "Internal error - duplicate file entry in a single session"
             seen.add(blobinfo['filename'])
-            if blobinfo.get("action", None) == "remove":
-                continue
-            yield copy.copy(blobinfo)
-        base_session_id = self.properties.get("base_session", None)
-        if base_session_id:
-            base_session_reader = self.repo.get_session(base_session_id)
-            for info in base_session_reader.get_all_blob_infos():
-                if info['filename'] not in seen:
-                    # Later entries overrides earlier ones
-                    yield info
+        return self.bloblist
+
+    def __store_manifest(self, blobinfos):
+        """Stores a manifest on demand for snapshots that did not get
+        one when they were committed. Failing to do so (for instance
+        in a read-only repository) is not an error."""
+        try:
+            self.repo.write_manifest(self.session_id, blobinfos)
+        except (IOError, OSError):
+            pass
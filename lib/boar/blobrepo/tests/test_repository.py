@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys, os, unittest, tempfile, shutil
+import sys, os, unittest, tempfile, shutil, binascii
 from copy import copy
 
 DATA1 = "tjosan"
@@ -33,6 +33,15 @@ if __name__ == '__main__':
     sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 from blobrepo import repository
+from blobrepo import blobreader
+from blobrepo import chunker
+from blobrepo import packfile
+from blobrepo import blobindex
+from blobrepo import zblob
+from blobrepo.sessions import AddException
+from jsonrpc import FileDataSource
+from StringIO import StringIO
+from common import md5sum, write_json
 
 class TestBlobRepo(unittest.TestCase):
     def setUp(self):
@@ -91,6 +100,277 @@ class TestBlobRepo(unittest.TestCase):
         blobinfos = list(reader.get_all_blob_infos())
         self.assertEqual(blobinfos, [self.fileinfo1])
 
+    def test_blob_upload(self):
+        writer = self.repo.create_session(SESSION_NAME)
+        upload = writer.open_blob(DATA2_MD5)
+        upload.write(DATA2[:4])
+        upload.write(buffer(DATA2, 4))
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        # Interleaved fragments must reopen the blob
+        writer.add_blob_data(DATA3_MD5, DATA3[:10])
+        writer.add_blob_data(DATA1_MD5, "")
+        writer.add_blob_data(DATA3_MD5, DATA3[10:])
+        self.assertTrue(upload.is_closed())
+        self.assertEqual(upload.bytes_written, len(DATA2))
+        writer.add(self.fileinfo1)
+        writer.add(self.fileinfo2)
+        writer.add(self.fileinfo3)
+        writer.commit()
+        self.assertEqual(self.repo.get_blob(DATA2_MD5), DATA2)
+        self.assertEqual(self.repo.get_blob(DATA3_MD5), DATA3)
+
+    def test_blob_stream(self):
+        writer = self.repo.create_session(SESSION_NAME)
+        datasource = FileDataSource(StringIO(DATA1), len(DATA1))
+        self.assertEqual(writer.add_blob_stream(DATA1_MD5, datasource), len(DATA1))
+        datasource = FileDataSource(StringIO(DATA1), len(DATA1))
+        self.assertRaises(AddException, writer.add_blob_stream, DATA2_MD5, datasource)
+        self.assertFalse(writer.has_blob(DATA2_MD5))
+        writer.add(self.fileinfo1)
+        id = writer.commit()
+        self.assertEqual(self.repo.get_blob(DATA1_MD5), DATA1)
+
+    def test_blob_reader_range(self):
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add_blob_data(DATA3_MD5, DATA3)
+        writer.add(self.fileinfo1)
+        writer.add(self.fileinfo3)
+        writer.commit()
+        self.assertEqual(self.repo.get_blob_reader(DATA3_MD5, 7, 6).read(), "hejsan")
+        self.assertEqual(self.repo.get_blob_reader(DATA3_MD5, 28).read(), "hejsan")
+        self.assertEqual(self.repo.get_blob_reader(DATA3_MD5, len(DATA3)).read(), "")
+        self.assertRaises(AssertionError, self.repo.get_blob_reader, DATA3_MD5, 30, 5)
+        # DATA2 as a recipe, using a piece from the middle of DATA3
+        write_json(self.repo.get_recipe_path(DATA2_MD5),
+                   {"method": "concat",
+                    "md5sum": DATA2_MD5,
+                    "size": len(DATA2),
+                    "pieces": [{"source": DATA1_MD5, "offset": 0, "size": 6},
+                               {"source": DATA3_MD5, "offset": 6, "size": 7}]})
+        self.repo.rebuild_blobindex()
+        self.assertEqual(self.repo.get_blob_reader(DATA2_MD5).read(), DATA2)
+        reader = self.repo.get_blob_reader(DATA2_MD5, 4, 5)
+        self.assertEqual(reader.read(3), "an ")
+        self.assertEqual(reader.read(), "he")
+        self.assertEqual(reader.bytes_left(), 0)
+
+    def test_chunking(self):
+        repo = repository.Repo(self.repopath, chunking = "64:256:1024")
+        data1 = os.urandom(20000)
+        data2 = data1[:5000] + "inserted" + data1[5000:15000] + data1[15100:]
+        stats = []
+        for n, data in enumerate((data1, data2)):
+            writer = repo.create_session(SESSION_NAME, base_session = n or None)
+            writer.add_blob_data(md5sum(data), data)
+            writer.add({"filename": "image.bin", "md5sum": md5sum(data)})
+            writer.commit()
+            stats.append(writer.chunking_stats)
+        for data in (data1, data2):
+            self.assertTrue(repo.has_recipe_blob(md5sum(data)))
+            self.assertFalse(repo.has_raw_blob(md5sum(data)))
+            self.assertEqual(repo.get_blob(md5sum(data)), data)
+            self.assertTrue(repo.verify_blob(md5sum(data)))
+        self.assertEqual(stats[0]['new_bytes'], len(data1))
+        self.assertEqual(stats[1]['chunked_bytes'], len(data2))
+        self.assertTrue(stats[1]['new_bytes'] < len(data2) / 4, stats[1])
+        # Small blobs are stored as they are
+        writer = repo.create_session(SESSION_NAME, base_session = 2)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add(self.fileinfo1)
+        writer.commit()
+        self.assertTrue(repo.has_raw_blob(DATA1_MD5))
+
+    def test_packed_blobs(self):
+        large_data = "x" * (repository.MAX_PACKED_BLOB_SIZE + 1)
+        self.repo = repository.Repo(self.repopath, blob_packing = "on")
+        writer = self.repo.create_session(SESSION_NAME)
+        for data in (DATA1, DATA2, large_data):
+            writer.add_blob_data(md5sum(data), data)
+            writer.add({"filename": md5sum(data), "md5sum": md5sum(data)})
+        writer.commit()
+        self.assertFalse(os.path.exists(self.repo.get_blob_path(DATA1_MD5)))
+        self.assertTrue(os.path.exists(self.repo.get_blob_path(md5sum(large_data))))
+        for n in range(0, 2):
+            if n == 0:
+                r = self.repo
+            else:
+                # Without the blob index, the packs must be searched
+                os.remove(self.repo.get_blobindex_path())
+                r = repo = repository.Repo(self.repopath, blob_packing = "on")
+                self.assertFalse(repo.blobindex_ok)
+            for data in (DATA1, DATA2, large_data):
+                self.assertTrue(r.has_raw_blob(md5sum(data)))
+                self.assertEqual(r.get_blob_size(md5sum(data)), len(data))
+                self.assertEqual(r.get_blob(md5sum(data)), data)
+                self.assertTrue(r.verify_blob(md5sum(data)))
+            self.assertEqual(r.get_blob(DATA1_MD5, 2, 100), DATA1[2:])
+            self.assertEqual(r.get_blob_reader(DATA2_MD5, 1, 3).read(), DATA2[1:4])
+            self.assertEqual(sorted(r.iter_raw_blob_names()),
+                             sorted([DATA1_MD5, DATA2_MD5, md5sum(large_data)]))
+        self.assertEqual(repo.rebuild_blobindex(), 3)
+        # The remains of an interrupted append are ignored and overwritten
+        with open(repo.packs.get_pack_path(1), "ab") as f:
+            f.write("garbage")
+        max_pack_size = packfile.MAX_PACK_SIZE
+        packfile.MAX_PACK_SIZE = 100
+        try:
+            writer = repo.create_session(SESSION_NAME, base_session = 1)
+            for n in range(0, 10):
+                writer.add_blob_data(md5sum(str(n) * 50), str(n) * 50)
+                writer.add({"filename": str(n), "md5sum": md5sum(str(n) * 50)})
+            writer.commit()
+        finally:
+            packfile.MAX_PACK_SIZE = max_pack_size
+        self.assertTrue(os.path.exists(repo.packs.get_pack_path(3)))
+        for n in range(0, 10):
+            self.assertEqual(self.repo.get_blob(md5sum(str(n) * 50)), str(n) * 50)
+        self.assertEqual([digest for digest, offset, size in packfile.scan_pack(repo.packs.get_pack_path(1))][:2],
+                         [binascii.unhexlify(sum) for sum in sorted([DATA1_MD5, DATA2_MD5])])
+        # Packing is off by default
+        repo = repository.Repo(self.repopath)
+        writer = repo.create_session(SESSION_NAME, base_session = 2)
+        writer.add_blob_data(md5sum("small"), "small")
+        writer.add({"filename": "small.txt", "md5sum": md5sum("small")})
+        writer.commit()
+        self.assertTrue(os.path.exists(repo.get_blob_path(md5sum("small"))))
+        # A miss does not make an unchanged pack directory be listed again
+        os.utime(repo.packs.pack_dir, (1000000000, 1000000000))
+        repo.packs.refresh()
+        original_listdir = os.listdir
+        os.listdir = None
+        try:
+            self.assertEqual(repo.packs.lookup(md5sum("small")), None)
+        finally:
+            os.listdir = original_listdir
+
+    def test_compressed_blobs(self):
+        repo = repository.Repo(self.repopath, blob_compression = "zlib")
+        text = "".join(["line %s\n" % n for n in range(0, 30000)])
+        noise = os.urandom(100000)
+        small = "s" * zblob.MAX_UNCOMPRESSED_SIZE
+        writer = repo.create_session(SESSION_NAME)
+        for data in (text, noise, small):
+            writer.add_blob_data(md5sum(data), data)
+            writer.add({"filename": md5sum(data), "md5sum": md5sum(data)})
+        writer.commit()
+        self.assertTrue(os.path.exists(repo.get_blob_path(md5sum(small))))
+        self.assertTrue(os.path.exists(repo.get_compressed_blob_path(md5sum(text))))
+        self.assertFalse(os.path.exists(repo.get_blob_path(md5sum(text))))
+        self.assertTrue(os.path.getsize(repo.get_compressed_blob_path(md5sum(text))) < len(text) / 2)
+        self.assertTrue(os.path.exists(repo.get_blob_path(md5sum(noise))))
+        for n in range(0, 2):
+            if n == 1:
+                os.remove(repo.get_blobindex_path())
+                repo = repository.Repo(self.repopath)
+                self.assertFalse(repo.blobindex_ok)
+            for data in (text, noise):
+                self.assertTrue(repo.has_raw_blob(md5sum(data)))
+                self.assertEqual(repo.get_blob_size(md5sum(data)), len(data))
+                self.assertEqual(repo.get_blob(md5sum(data)), data)
+                self.assertTrue(repo.verify_blob(md5sum(data)))
+            # Ranges that start and end in different chunks
+            self.assertEqual(repo.get_blob(md5sum(text), 65000, 70000), text[65000:135000])
+            self.assertEqual(repo.get_blob_reader(md5sum(text), 131071, 3).read(), text[131071:131074])
+            self.assertEqual(repo.get_blob(md5sum(text), len(text) - 5, 100), text[-5:])
+        self.assertEqual(repo.rebuild_blobindex(), 3)
+        # A recipe with pieces from the compressed blob
+        pieces = [{"source": md5sum(text), "offset": 200000, "size": 1000},
+                  {"source": md5sum(noise), "offset": 0, "size": 10},
+                  {"source": md5sum(text), "offset": 60000, "size": 10000}]
+        expected = text[200000:201000] + noise[:10] + text[60000:70000]
+        recipe = {"method": "concat", "md5sum": md5sum(expected),
+                  "size": len(expected), "pieces": pieces}
+        reader = blobreader.create_blob_reader(recipe, repo)
+        self.assertEqual(reader.read(), expected)
+        reader.close()
+
+    def test_chunker_cuts(self):
+        cdc = chunker.Chunker(64, 256, 1024)
+        data = os.urandom(10000) + "\0" * 5000 + os.urandom(10000)
+        cuts = cdc.cut_positions(StringIO(data), use_numpy = False)
+        lengths = [b - a for a, b in zip([0] + cuts, cuts + [len(data)])]
+        self.assertTrue(min(lengths[:-1]) >= 64 and max(lengths) <= 1024, lengths)
+        if chunker.numpy:
+            # Small blocks, to test the windows that cross block borders
+            block_size = chunker.SCAN_BLOCK_SIZE
+            chunker.SCAN_BLOCK_SIZE = 1000
+            try:
+                self.assertEqual(cdc.cut_positions(StringIO(data)), cuts)
+            finally:
+                chunker.SCAN_BLOCK_SIZE = block_size
+
+    def test_recipe_reader(self):
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA3_MD5, DATA3)
+        writer.add(self.fileinfo3)
+        writer.commit()
+        # Many small pieces, some of them empty, from all over DATA3
+        pieces = []
+        expected = ""
+        for n in range(0, 300):
+            offset, size = (n * 7) % len(DATA3), n % 4
+            size = min(size, len(DATA3) - offset)
+            pieces.append({"source": DATA3_MD5, "offset": offset, "size": size})
+            expected += DATA3[offset:offset + size]
+        recipe = {"method": "concat", "md5sum": md5sum(expected),
+                  "size": len(expected), "pieces": pieces}
+        reader = blobreader.create_blob_reader(recipe, self.repo)
+        self.assertEqual(reader.read(), expected)
+        for pos, size in [(0, 1), (5, 100), (len(expected) - 3, 10), (len(expected), 1), (17, 0)]:
+            self.assertEqual(reader.read(size, pos), expected[pos:pos + size])
+            self.assertEqual(reader.tell(), min(pos + size, len(expected)))
+        reader.seek(-5, os.SEEK_END)
+        self.assertEqual(reader.read(), expected[-5:])
+        reader.close()
+        write_json(self.repo.get_recipe_path(recipe['md5sum']), recipe)
+        self.repo.rebuild_blobindex()
+        self.assertTrue(self.repo.verify_blob(recipe['md5sum']))
+        self.assertEqual(self.repo.get_blob(recipe['md5sum'], 10), expected[10:])
+
+    def __count_verified_blobs(self, verify_policy):
+        """ Commits six new blobs and returns the number of blobs that
+        were hashed again by the repository. """
+        repo = repository.Repo(self.repopath, verify_policy = verify_policy)
+        writer = repo.create_session(SESSION_NAME)
+        for n in range(0, 6):
+            data = "%s %s" % (verify_policy, n)
+            writer.add_blob_data(md5sum(data), data)
+            writer.add({"filename": "file%s.txt" % n, "md5sum": md5sum(data)})
+        hashed = []
+        original_md5sum_file = repository.md5sum_file
+        def counting_md5sum_file(path):
+            hashed.append(path)
+            return original_md5sum_file(path)
+        repository.md5sum_file = counting_md5sum_file
+        try:
+            id = writer.commit()
+        finally:
+            repository.md5sum_file = original_md5sum_file
+        self.assertFalse(os.path.exists(os.path.join(repo.get_session_path(id),
+                                                     repository.VERIFIED_BLOBS_FILE)))
+        return len(hashed)
+
+    def test_verify_policy(self):
+        self.assertEqual(self.__count_verified_blobs(repository.VERIFY_FULL), 6)
+        self.assertEqual(self.__count_verified_blobs(repository.VERIFY_SAMPLED), repository.VERIFY_SAMPLE_COUNT)
+        self.assertEqual(self.__count_verified_blobs(repository.VERIFY_NONE), 0)
+        self.assertRaises(repository.MisuseError, repository.Repo, self.repopath, "nonsense")
+
+    def test_queue_recovery_verifies_blobs(self):
+        """ A snapshot left in the queue by an interrupted commit must
+        be fully verified, even if the writer claims to have verified
+        its blobs."""
+        self.repo.process_queue = lambda trusted = False: None # Simulate a crash
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add(self.fileinfo1)
+        id = writer.commit()
+        queued_blob = self.repo.get_queue_path(os.path.join(str(id), DATA1_MD5))
+        with open(queued_blob, "wb") as f:
+            f.write(DATA1.upper())
+        self.assertRaises(AssertionError, repository.Repo, self.repopath, repository.VERIFY_NONE)
+
     def test_secondary_session(self):
         writer1 = self.repo.create_session(SESSION_NAME)
         writer1.add_blob_data(DATA1_MD5, DATA1)
@@ -121,11 +401,242 @@ class TestBlobRepo(unittest.TestCase):
         writer1 = self.repo.create_session(SESSION_NAME)
         self.assertRaises(Exception, writer1.remove, "doesnotexist.txt")        
 
+    def test_blob_index(self):
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add(self.fileinfo1)
+        writer.commit()
+        self.assertTrue(self.repo.blobindex_ok)
+        repo = repository.Repo(self.repopath)
+        self.assertTrue(repo.blobindex_ok)
+        self.assertTrue(repo.has_blob(DATA1_MD5))
+        self.assertTrue(repo.has_raw_blob(DATA1_MD5))
+        self.assertFalse(repo.has_recipe_blob(DATA1_MD5))
+        self.assertFalse(repo.has_blob(DATA2_MD5))
+        self.assertEqual(repo.get_blob_size(DATA1_MD5), len(DATA1))
+
+    def test_blob_index_rebuild(self):
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add(self.fileinfo1)
+        writer.commit()
+        os.remove(self.repo.get_blobindex_path())
+        repo = repository.Repo(self.repopath)
+        self.assertFalse(repo.blobindex_ok)
+        self.assertTrue(repo.has_blob(DATA1_MD5))
+        self.assertEqual(repo.rebuild_blobindex(), 1)
+        self.assertTrue(repo.blobindex_ok)
+        self.assertTrue(repo.has_blob(DATA1_MD5))
+        self.assertEqual(repo.get_blob_size(DATA1_MD5), len(DATA1))
+
+    def test_old_read_only_repo(self):
+        """ Repositories created by older versions lack the derived
+        dir. They must be usable even if it can not be created."""
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add(self.fileinfo1)
+        id = writer.commit()
+        derived_dir = os.path.join(self.repopath, repository.DERIVED_DIR)
+        shutil.rmtree(derived_dir)
+        original_mkdir = os.mkdir
+        def read_only_mkdir(path, *args):
+            if path.startswith(derived_dir):
+                raise OSError(30, "Read-only file system")
+            return original_mkdir(path, *args)
+        os.mkdir = read_only_mkdir
+        try:
+            repo = repository.Repo(self.repopath)
+            self.assertFalse(repo.blobindex_ok)
+            self.assertTrue(repo.has_blob(DATA1_MD5))
+            self.assertEqual(repo.get_session_ids_by_name(SESSION_NAME), [id])
+            self.assertEqual(repo.get_session(id).get_blob_info(self.fileinfo1['filename']), self.fileinfo1)
+        finally:
+            os.mkdir = original_mkdir
+        self.assertFalse(os.path.exists(derived_dir))
+        self.assertEqual(repo.rebuild_blobindex(), 1)
+        self.assertTrue(repo.blobindex_ok)
+
+    def test_blob_index_reused_inode(self):
+        """ An index that is rebuilt by another process may get the
+        inode of the old one. It must still be read from the start."""
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add(self.fileinfo1)
+        writer.commit()
+        path = self.repo.get_blobindex_path()
+        index = blobindex.BlobIndex(path)
+        tmp_path = path + ".rebuilt"
+        blobindex.write_index(tmp_path, [(blobindex.KIND_RAW, DATA2_MD5, len(DATA2)),
+                                         (blobindex.KIND_RAW, DATA3_MD5, len(DATA3)),
+                                         (blobindex.KIND_RAW, DATA1_MD5, len(DATA1))], 1)
+        with open(tmp_path, "rb") as f:
+            data = f.read()
+        os.remove(tmp_path)
+        with open(path, "r+b") as f:
+            f.write(data)
+        self.assertTrue(index.refresh())
+        self.assertEqual(index.get_size(DATA2_MD5), len(DATA2))
+        self.assertEqual(index.get_size(DATA1_MD5), len(DATA1))
+
+    def test_blob_index_concurrent_commit(self):
+        """ A commit by another repo instance must be visible even
+        though the index was loaded before the commit."""
+        other_repo = repository.Repo(self.repopath)
+        writer = other_repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add(self.fileinfo1)
+        writer.commit()
+        self.assertTrue(self.repo.has_blob(DATA1_MD5))
+        self.assertEqual(self.repo.get_blob_size(DATA1_MD5), len(DATA1))
+
+    def test_blob_names(self):
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add(self.fileinfo1)
+        writer.add_blob_data(DATA2_MD5, DATA2)
+        writer.add(self.fileinfo2)
+        writer.commit()
+        self.assertListsEqualAsSets(self.repo.get_blob_names(), [DATA1_MD5, DATA2_MD5])
+        os.remove(self.repo.get_blobindex_path())
+        repo = repository.Repo(self.repopath)
+        self.assertFalse(repo.blobindex_ok)
+        self.assertListsEqualAsSets(list(repo.iter_blob_names()), [DATA1_MD5, DATA2_MD5])
+
+    def test_find_last_revision(self):
+        id1 = self.repo.create_session(SESSION_NAME).commit()
+        id2 = self.repo.create_session("OtherSession").commit()
+        id3 = self.repo.create_session(SESSION_NAME).commit()
+        self.assertEqual(self.repo.find_last_revision(SESSION_NAME), id3)
+        self.assertEqual(self.repo.find_last_revision("OtherSession"), id2)
+        self.assertEqual(self.repo.find_last_revision("NoSuchSession"), None)
+        self.assertEqual(self.repo.get_session_ids_by_name(SESSION_NAME), [id1, id3])
+
+    def test_session_index_rebuild(self):
+        """ The session index must recover both from being deleted and
+        from snapshots being committed without updating it."""
+        id1 = self.repo.create_session(SESSION_NAME).commit()
+        index_path = os.path.join(self.repopath, repository.DERIVED_DIR,
+                                  repository.SESSIONINDEX_FILE)
+        stale_index = open(index_path, "rb").read()
+        id2 = self.repo.create_session(SESSION_NAME).commit()
+        os.remove(index_path)
+        self.assertEqual(repository.Repo(self.repopath).find_last_revision(SESSION_NAME), id2)
+        with open(index_path, "wb") as f:
+            f.write(stale_index)
+        self.assertEqual(repository.Repo(self.repopath).get_session_ids_by_name(SESSION_NAME), [id1, id2])
+
+    def __commit_chain(self, count):
+        """ Commits a chain of snapshots where every snapshot adds a
+        file to the previous one. Returns the ids of the snapshots."""
+        ids = []
+        base = None
+        for n in range(0, count):
+            writer = self.repo.create_session(SESSION_NAME, base_session = base)
+            if n == 0:
+                writer.add_blob_data(DATA1_MD5, DATA1)
+            writer.add({"filename": "file%s.txt" % n, "md5sum": DATA1_MD5})
+            base = writer.commit()
+            ids.append(base)
+        return ids
+
+    def test_manifests(self):
+        self.repo.manifest_interval = 3
+        ids = self.__commit_chain(7)
+        has_manifest = [self.repo.has_manifest(sid) for sid in ids]
+        self.assertEqual(has_manifest, [False, False, True, False, False, True, False])
+        for n in range(0, len(ids)):
+            reader = repository.Repo(self.repopath).get_session(ids[n])
+            filenames = [bi['filename'] for bi in reader.get_all_blob_infos()]
+            self.assertListsEqualAsSets(filenames, ["file%s.txt" % i for i in range(0, n + 1)])
+
+    def test_build_manifests(self):
+        self.repo.manifest_interval = 1000
+        ids = self.__commit_chain(7)
+        self.assertEqual(self.repo.get_delta_chain_length(ids[-1]), 7)
+        self.assertEqual(self.repo.build_manifests(3), 2)
+        self.assertEqual(self.repo.get_delta_chain_length(ids[-1]), 1)
+        self.assertEqual(self.repo.build_manifests(3), 0)
+        reader = repository.Repo(self.repopath).get_session(ids[-1])
+        self.assertEqual(len(list(reader.get_all_blob_infos())), 7)
+
+    def test_binary_manifest(self):
+        self.repo.manifest_interval = 2
+        ids = self.__commit_chain(3)
+        self.assertTrue(os.path.exists(self.repo.get_manifest_path(ids[1])))
+        writer = self.repo.create_session(SESSION_NAME, base_session = ids[2])
+        writer.remove(u"file1.txt")
+        writer.add({"filename": u"n\xe5got.txt", "md5sum": DATA1_MD5, "size": 5, "mtime": 2**40})
+        id4 = writer.commit()
+        reader = repository.Repo(self.repopath).get_session(id4)
+        self.assertEqual(reader.get_blob_info(u"n\xe5got.txt"),
+                         {"filename": u"n\xe5got.txt", "md5sum": DATA1_MD5, "size": 5, "mtime": 2**40})
+        self.assertEqual(reader.get_blob_info(u"file0.txt"), {"filename": u"file0.txt", "md5sum": DATA1_MD5})
+        self.assertEqual(reader.get_blob_info(u"file1.txt"), None)
+        self.assertEqual(reader.get_blob_info(u"file2.txt")['md5sum'], DATA1_MD5)
+        self.assertEqual(reader.get_blob_info(u"nosuchfile.txt"), None)
+        self.assertListsEqualAsSets([bi['filename'] for bi in reader.get_all_blob_infos()],
+                                    [u"file0.txt", u"file2.txt", u"n\xe5got.txt"])
+
+    def test_large_snapshot_manifest(self):
+        """ Snapshots with many changed files get a binary manifest,
+        however short their history is."""
+        self.repo.manifest_min_files = 3
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        for n in range(0, 3):
+            writer.add({"filename": "file%s.txt" % n, "md5sum": DATA1_MD5})
+        id1 = writer.commit()
+        self.assertTrue(os.path.exists(self.repo.get_manifest_path(id1)))
+        reader = repository.Repo(self.repopath).get_session(id1)
+        self.assertEqual(reader.get_blob_info("file1.txt"), {"filename": "file1.txt", "md5sum": DATA1_MD5})
+        self.assertEqual(reader.get_blob_info("file3.txt"), None)
+        # Small changes to a large snapshot are only stored as a delta
+        writer = self.repo.create_session(SESSION_NAME, base_session = id1)
+        writer.add({"filename": "file3.txt", "md5sum": DATA1_MD5})
+        id2 = writer.commit()
+        self.assertFalse(self.repo.has_manifest(id2))
+        # A json manifest would only duplicate the bloblist
+        writer = self.repo.create_session(SESSION_NAME, base_session = id2)
+        for n in range(4, 7):
+            writer.add({"filename": "file%s.txt" % n, "md5sum": DATA1_MD5, "extra": "value"})
+        id3 = writer.commit()
+        self.assertFalse(self.repo.has_manifest(id3))
+        # Existing snapshots
+        os.remove(self.repo.get_manifest_path(id1))
+        repo = repository.Repo(self.repopath)
+        repo.manifest_min_files = 3
+        self.assertEqual(repo.build_manifests(), 1)
+        self.assertTrue(os.path.exists(self.repo.get_manifest_path(id1)))
+        self.assertFalse(self.repo.has_manifest(id2))
+        if os.path.isdir("/proc/self/fd"):
+            # Cached manifest readers must not keep files open
+            repo = repository.Repo(self.repopath)
+            open_files = len(os.listdir("/proc/self/fd"))
+            for sid in (id1, id2, id3):
+                list(repo.get_session(sid).get_all_blob_infos())
+                repo.get_session(sid).get_blob_info("file1.txt")
+            self.assertEqual(len(os.listdir("/proc/self/fd")), open_files)
+
+    def test_json_manifest_fallback(self):
+        """ Blobinfos that can not be represented in the binary
+        manifest format must be stored as json."""
+        self.repo.manifest_interval = 2
+        writer = self.repo.create_session(SESSION_NAME)
+        writer.add_blob_data(DATA1_MD5, DATA1)
+        writer.add({"filename": "file.txt", "md5sum": DATA1_MD5, "extra": "value"})
+        id1 = writer.commit()
+        id2 = self.repo.create_session(SESSION_NAME, base_session = id1).commit()
+        self.assertFalse(os.path.exists(self.repo.get_manifest_path(id2)))
+        self.assertTrue(os.path.exists(self.repo.get_manifest_path(id2, binary = False)))
+        reader = repository.Repo(self.repopath).get_session(id2)
+        self.assertEqual(reader.get_blob_info("file.txt")['extra'], "value")
+
     def test_split(self):
         #  0          1        2         3
         #  0123456789012345678901234567890123456789
         # "tjosan hejsan tjosan hejsan hejsan"
         # cafa2ed1e085869b3bfe9e43b60e7a5a
+        self.repo.max_packed_blob_size = 0 # The raw blob file is removed below
         writer = self.repo.create_session(SESSION_NAME)
         writer.add_blob_data(DATA3_MD5, DATA3)
         writer.add(self.fileinfo3)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+Compressed blobs. The contents are divided into chunks of
+CHUNK_SIZE bytes (the last one may be shorter), and every chunk is
+compressed with zlib on its own. Any part of the blob can then be read
+by only decompressing the chunks that contain it.
+
+The file starts with a header:
+
+  magic string  8 bytes  "BOARZBLB"
+  version       4 bytes
+  chunk size    4 bytes
+  blob size     8 bytes  (the uncompressed size)
+
+followed by the compressed size of every chunk (4 bytes each) and then
+the compressed chunks, one after another. All integers are big
+endian. A compressed blob is named after the md5sum of its
+uncompressed contents.
+"""
+
+import os
+import zlib
+import struct
+
+from common import *
+
+MAGIC = "BOARZBLB"
+VERSION = 1
+HEADER_FORMAT = "!8sIIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CHUNK_SIZE = 64 * 2**10
+COMPRESSION_LEVEL = 6
+
+# A blob is only stored compressed if a trial compression of some
+# samples of it, and then the compression of the whole blob, results
+# in at most this fraction of the original size.
+TRIAL_SAMPLES = 4
+MAX_RATIO = 0.9
+
+# Blobs of at most this size are never compressed, as they take up a
+# disk block anyway.
+MAX_UNCOMPRESSED_SIZE = 4096
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+def worth_compressing(path):
+    """Compresses a few samples from different parts of the given file
+    and returns True if they compressed well. Small files are never
+    worth compressing."""
+    size = os.path.getsize(path)
+    if size <= MAX_UNCOMPRESSED_SIZE:
+        return False
+    sample_bytes = 0
+    compressed_bytes = 0
+    with open(path, "rb") as f:
+        for n in range(0, TRIAL_SAMPLES):
+            f.seek(size * n // TRIAL_SAMPLES)
+            data = f.read(CHUNK_SIZE)
+            sample_bytes += len(data)
+            compressed_bytes += len(zlib.compress(data, 1))
+    return compressed_bytes < sample_bytes * MAX_RATIO
+
+def compress_file(source_path, dest_path, chunk_size = CHUNK_SIZE):
+    """Writes a compressed blob with the contents of the source file to
+    dest_path. Returns the size of the compressed blob."""
+    size = os.path.getsize(source_path)
+    count = chunk_count(size, chunk_size)
+    lengths = []
+    with open(source_path, "rb") as source:
+        with open(dest_path, "wb") as dest:
+            dest.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, chunk_size, size))
+            # The chunk sizes are filled in when they are known
+            dest.write("\0" * (4 * count))
+            for data in file_reader(source, blocksize = chunk_size):
+                compressed = zlib.compress(data, COMPRESSION_LEVEL)
+                dest.write(compressed)
+                lengths.append(len(compressed))
+            assert len(lengths) == count
+            dest.seek(HEADER_SIZE)
+            dest.write(struct.pack("!%sI" % count, *lengths))
+            dest.flush()
+            os.fsync(dest.fileno())
+    return HEADER_SIZE + 4 * count + sum(lengths)
+
+def read_header(f):
+    """Returns the (chunk size, blob size) of the compressed blob in
+    the given file object, which must be positioned at its start."""
+    magic, version, chunk_size, size = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+    assert (magic, version) == (MAGIC, VERSION), "Not a compressed blob: %s" % f.name
+    return chunk_size, size
+
+def get_size(path):
+    """Returns the uncompressed size of the given compressed blob."""
+    with open(path, "rb") as f:
+        return read_header(f)[1]
+
+class ZBlobReader:
+    """A read only file object for the uncompressed contents of a
+    compressed blob. The last decompressed chunk is kept, so that
+    sequential reads only decompress every chunk once."""
+    def __init__(self, path):
+        self.name = path
+        self.f = open(path, "rb")
+        self.chunk_size, self.size = read_header(self.f)
+        count = chunk_count(self.size, self.chunk_size)
+        lengths = struct.unpack("!%sI" % count, self.f.read(4 * count))
+        # The position in the file of every chunk, and of the end
+        self.chunk_offsets = []
+        offset = HEADER_SIZE + 4 * count
+        for length in lengths:
+            self.chunk_offsets.append(offset)
+            offset += length
+        self.chunk_offsets.append(offset)
+        self.pos = 0
+        self.chunk_index = None
+        self.chunk_data = None
+
+    def seek(self, pos, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        assert 0 <= pos, "Illegal position %s" % pos
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def __get_chunk(self, index):
+        if index != self.chunk_index:
+            self.f.seek(self.chunk_offsets[index])
+            compressed = self.f.read(self.chunk_offsets[index + 1] - self.chunk_offsets[index])
+            data = zlib.decompress(compressed)
+            assert len(data) == min(self.chunk_size, self.size - index * self.chunk_size), \
+                "Corrupt chunk %s in compressed blob %s" % (index, self.name)
+            self.chunk_index, self.chunk_data = index, data
+        return self.chunk_data
+
+    def read(self, n = -1):
+        if n < 0:
+            n = self.size
+        end = min(self.pos + n, self.size)
+        parts = []
+        while self.pos < end:
+            index = self.pos // self.chunk_size
+            pos_in_chunk = self.pos - index * self.chunk_size
+            data = self.__get_chunk(index)[pos_in_chunk:pos_in_chunk + end - self.pos]
+            parts.append(data)
+            self.pos += len(data)
+        return "".join(parts)
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
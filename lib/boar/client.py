@@ -15,9 +15,75 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import with_statement
+
 import jsonrpc
 import base64
+import os
 import re
+import threading
+
+from boar_exceptions import UserError
+
+COMPRESSION_SETTINGS = {"auto": None,
+                        "none": [],
+                        "zlib": [jsonrpc.CODEC_ZLIB],
+                        "lz4": [jsonrpc.CODEC_LZ4]}
+
+def get_codecs():
+    """Returns the compression codecs to offer the server, as selected
+    by the $BOAR_COMPRESSION environment variable. None means all
+    available codecs."""
+    setting = os.getenv("BOAR_COMPRESSION", "auto")
+    if setting not in COMPRESSION_SETTINGS:
+        raise UserError("Invalid value for $BOAR_COMPRESSION: %s (must be one of %s)" % \
+                            (setting, ", ".join(sorted(COMPRESSION_SETTINGS.keys()))))
+    codecs = COMPRESSION_SETTINGS[setting]
+    if codecs and not set(codecs) <= set(jsonrpc.available_codecs()):
+        raise UserError("Compression method '%s' is not available" % setting)
+    return codecs
+
+class ConnectionPool:
+    """Keeps one server proxy per server address. The proxies use
+    persistent connections (one per thread), so all fronts for the
+    same server share connections instead of connecting anew for
+    every call."""
+    def __init__(self):
+        self.transports = {}
+        self.proxies = {}
+        self.lock = threading.Lock()
+
+    def get_transport(self, address, port):
+        with self.lock:
+            if (address, port) not in self.transports:
+                transport = jsonrpc.KeepAliveTransportTcpIp(addr=(address, port), codecs=get_codecs(),
+                                                            timeout=60.0, limit=2**16)
+                self.transports[(address, port)] = transport
+                self.proxies[(address, port)] = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(), transport)
+            return self.transports[(address, port)]
+
+    def get_proxy(self, address, port):
+        self.get_transport(address, port)
+        return self.proxies[(address, port)]
+
+    def get_stats(self):
+        """Returns a (payload_bytes, wire_bytes) tuple with the totals
+        of all binary data transferred through the pool."""
+        payload_bytes, wire_bytes = 0, 0
+        with self.lock:
+            for transport in self.transports.values():
+                payload_bytes += transport.stats.payload_bytes
+                wire_bytes += transport.stats.wire_bytes
+        return payload_bytes, wire_bytes
+
+    def close(self):
+        """Closes all connections. They will be reopened if the
+        proxies are used again."""
+        with self.lock:
+            for transport in self.transports.values():
+                transport.close_all()
+
+connection_pool = ConnectionPool()
 
 def connect(url):
     m = re.match("boar://(.*?)(:[0-9]+)?/", url)
@@ -27,8 +93,6 @@ def connect(url):
     if m.group(2):
         port = int(m.group(2)[1:])
     #print "Connecting to '%s' on port %s" % (address, port)
-    server = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(), 
-                                 jsonrpc.TransportTcpIp(addr=(address, port), 
-                                                        timeout=60.0, limit=2**16))
+    server = connection_pool.get_proxy(address, port)
     return server.front
 
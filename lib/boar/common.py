@@ -24,6 +24,8 @@ import platform
 import locale
 import codecs
 import time
+import threading
+import Queue
 
 if sys.version_info >= (2, 6):
     import json
@@ -87,6 +89,67 @@ def md5sum_file(f, start = 0, end = None):
             return md5sum_fileobj(fobj, start, end)
     return md5sum_fileobj(f, start, end)
 
+def md5sum_files(paths, jobs = 1):
+    """Accepts a sequence of filenames and yields a (filename, md5sum)
+    tuple for each of them. If more than one job is requested, the
+    files are read and hashed by that many worker threads (hashlib
+    releases the GIL while hashing) and the tuples are yielded in the
+    order the files are completed."""
+    return parallel_map(md5sum_file, paths, jobs)
+
+def parallel_map(function, items, jobs = 1):
+    """Calls the function for every item in the given sequence, and
+    yields an (item, result) tuple for each of them. If more than one
+    job is requested, the calls are made by that many worker threads
+    and the tuples are yielded in the order the calls complete. Only
+    a few items per worker are queued ahead of the workers. Any
+    exception raised by the function is raised by the generator."""
+    assert jobs >= 1
+    if jobs == 1:
+        for item in items:
+            yield item, function(item)
+        return
+    tasks = Queue.Queue(maxsize = jobs * 2)
+    results = Queue.Queue()
+    stopped = threading.Event()
+    def worker():
+        while True:
+            task = tasks.get()
+            if task == None:
+                return
+            item, = task
+            if stopped.is_set():
+                continue
+            try:
+                results.put((item, function(item), None))
+            except Exception:
+                results.put((item, None, sys.exc_info()))
+    def get_result(block):
+        # A timeout is given to keep the wait interruptible
+        item, result, exc_info = results.get(block, 2**31)
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return item, result
+    workers = [threading.Thread(target = worker) for n in range(0, jobs)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    try:
+        pending = 0
+        for item in items:
+            tasks.put((item,))
+            pending += 1
+            while not results.empty():
+                pending -= 1
+                yield get_result(False)
+        while pending > 0:
+            pending -= 1
+            yield get_result(True)
+    finally:
+        stopped.set()
+        for w in workers:
+            tasks.put(None)
+
 def copy_file(source, destination, start = 0, end = None, expected_md5sum = None):
     assert os.path.exists(source), "Source doesn't exist"
     assert not os.path.exists(destination), "Destination already exist"
@@ -102,6 +165,14 @@ def copy_file(source, destination, start = 0, end = None, expected_md5sum = None
         assert m.hexdigest() == expected_md5sum, \
             "Copied file did not have expected md5sum"
 
+def replace_file(source, destination):
+    """Renames source to destination, replacing any existing
+    destination file. Atomic on systems that allow it."""
+    if os.name == "nt" and os.path.exists(destination):
+        # Windows does not allow renaming over an existing file
+        os.remove(destination)
+    os.rename(source, destination)
+
 def move_file(source, destination, mkdirs = False):
     assert not os.path.exists(destination)
     dirname = os.path.dirname(destination)
@@ -129,7 +200,7 @@ def split_file(source, dest_dir, cut_positions, want_piece = None):
     assert len(set(cuts)) == len(cuts), "Duplicate entry in cut list"
     assert len(cuts) >= 1, "Empty cuts not allowed"
     source_size = os.path.getsize(source)
-    assert max(cuts) < source_size and min(cuts) > 0, "Cut for %s out of range: %s" % (blob, cuts)
+    assert max(cuts) < source_size and min(cuts) > 0, "Cut for %s out of range: %s" % (source, cuts)
     cuts.append(0) # Always have an implicit cut starting at 0
     cuts.append(source_size) # Always have an implicit cut ending at source_size
     cuts.sort()
@@ -138,7 +209,7 @@ def split_file(source, dest_dir, cut_positions, want_piece = None):
     while len(cuts) > 0:
         end = cuts.pop(0)
         checksum = md5sum_file(source, start, end)
-        if not want_piece(checksum) or checksum in added_blobs:
+        if (want_piece and not want_piece(checksum)) or checksum in added_blobs:
             added_blobs.append(checksum)
             start = end
             continue
@@ -314,7 +385,7 @@ class FileMutex:
             try:
                 self.lock()
                 break
-            except MutexLocked:                
+            except FileMutex.MutexLocked:
                 if time.time() - t0 > timeout:
                     break
                 time.sleep(1)
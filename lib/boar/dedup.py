@@ -1,70 +1,131 @@
-import os
-from common import *
-import string
+# -*- coding: utf-8 -*-
 
-def file_prefix_md5sum(filename, prefix_size):
-    assert os.path.getsize(filename) >= prefix_size
-    return md5sum_file(filename, 0, prefix_size)
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
 
-def file_suffix_md5sum(filename, suffix_size):
-    filesize = os.path.getsize(filename)
-    assert filesize >= suffix_size
-    return md5sum_file(filename, filesize - suffix_size, filesize)
+from __future__ import with_statement
 
-def groupBy(files, size, md5summer):
-    groups = {}
-    n = 0
-    for filename in files:
-        print n, len(files)
-        n+=1
-        filesize = os.path.getsize(filename)
-        if filesize < size:
-            continue
-        md5 = md5summer(filename, size)
-        group = groups.get(md5, [])
-        group.append(filename)
-        groups[md5] = group
-    return groups.values()
+"""
+Finds blobs in a repository that begin or end with the same data as
+some other blob, such as a log file that has been appended to, or a
+video file where only the tags at the start have been changed. Such
+blobs can be stored more compactly by cutting them with
+SessionWriter.split_blob() at the end of the shared part, so that the
+shared part becomes a single blob.
 
-def findIdenticalSuffix(file1, file2):
-    blocksize = 4096
-    fsize1, fsize2 = os.path.getsize(file1), os.path.getsize(file2)
-    remaining = min(fsize1, fsize2)
-    identical = 0
-    while remaining > 0:
-        s1 = md5sum_file(file1, fsize1 - identical - blocksize, fsize1 - identical)
-        s2 = md5sum_file(file2, fsize2 - identical - blocksize, fsize2 - identical)
-        if s1 != s2:
-            break
-        identical += blocksize
-        remaining -= blocksize
-        print remaining
-    return identical
+Every blob is read once. The md5sums of its blocks are kept, both for
+blocks aligned to the start of the blob and for blocks aligned to its
+end. When the block lists of all blobs are sorted, the blob that
+shares the longest prefix with a given blob is always next to it in
+the sorted order. Only such neighbours are compared, which takes
+roughly linear time. The same goes for suffixes, with the block lists
+reversed.
+"""
+
+import os
+import hashlib
+
+from common import *
 
-def main():
-    file1, file2 = sys.argv[1:]
-    print findIdenticalSuffix(file1, file2)
+BLOCK_SIZE = 64 * 2**10
 
+# Blobs that share less than this are not worth cutting
+DEFAULT_MIN_SHARED = 2**20
 
-def main_old():
-    if sys.argv[2] == "-":
-        files = map(string.strip, sys.stdin.readlines())
-    else:
-        files = sys.argv[2:]
+def block_sums(reader, size, block_size = BLOCK_SIZE):
+    """Returns two lists of block checksums for the given number of
+    bytes from the given reader. The blocks of the first list are
+    aligned to the start of the data, and the blocks of the second are
+    aligned to the end of it. Either list may have a shorter first or
+    last block."""
+    remainder = size % block_size
+    prefix_sums, suffix_sums = [], []
+    previous = ""
+    position = 0
+    while position < size:
+        block = reader.read(min(block_size, size - position))
+        assert block, "Unexpected end of blob"
+        position += len(block)
+        prefix_sums.append(hashlib.md5(block).digest()[:8])
+        if remainder:
+            # The block that ends at the same distance from the
+            # end as this block does from the start of the file
+            suffix_block = previous[remainder:] + block[:remainder]
+            suffix_sums.append(hashlib.md5(suffix_block).digest()[:8])
+        previous = block
+    if not remainder:
+        suffix_sums = prefix_sums
+    return prefix_sums, suffix_sums
 
-    files = [ filename for filename in files if os.path.getsize(filename) > 1000000 ]
+def common_length(list1, list2):
+    """Returns the number of leading items that the lists have in
+    common."""
+    n = 0
+    for item1, item2 in zip(list1, list2):
+        if item1 != item2:
+            break
+        n += 1
+    return n
 
-    size = 4096
-    if sys.argv[1] == "prefix":
-        groups = groupBy(files, size, file_prefix_md5sum)
-    elif sys.argv[1] == "suffix":
-        groups = groupBy(files, size, file_suffix_md5sum)
-    else:
-        assert False
+class DedupReport:
+    def __init__(self):
+        self.blob_count = 0
+        self.blob_bytes = 0
+        # A list of ("prefix"|"suffix", length, blob1, blob2) tuples
+        self.shared = []
+        # {blob: [cut positions]} in the form split_blob() accepts
+        self.cuts = {}
+        self.savings = 0
 
-    for g in groups:
-        if len(g) > 1:
-            for f in g:                
-                print f
+    def add_shared(self, kind, length, blob1, size1, blob2, size2):
+        self.shared.append((kind, length, blob1, blob2))
+        self.savings += length
+        for blob, size in ((blob1, size1), (blob2, size2)):
+            if kind == "prefix":
+                cut = length
+            else:
+                cut = size - length
+            # A blob that is all shared data does not need to be cut
+            if 0 < cut < size:
+                cuts = self.cuts.setdefault(blob, [])
+                if cut not in cuts:
+                    cuts.append(cut)
+                    cuts.sort()
 
-main()
+def find_shared_data(repo, min_shared = DEFAULT_MIN_SHARED, block_size = BLOCK_SIZE):
+    """Examines every raw blob in the repository that is at least
+    min_shared bytes large, and returns a DedupReport of the blobs
+    that share at least that much data at their start or end. The
+    shared lengths are a multiple of the block size."""
+    report = DedupReport()
+    sizes = {}
+    prefixes, suffixes = [], []
+    for blob in repo.iter_raw_blob_names():
+        size = repo.get_blob_size(blob)
+        if size < min_shared:
+            continue
+        prefix_sums, suffix_sums = block_sums(repo.get_blob_reader(blob), size, block_size)
+        sizes[blob] = size
+        prefixes.append((prefix_sums, blob))
+        suffixes.append((suffix_sums[::-1], blob))
+        report.blob_count += 1
+        report.blob_bytes += size
+    for kind, sums in (("prefix", prefixes), ("suffix", suffixes)):
+        sums.sort()
+        for (sums1, blob1), (sums2, blob2) in zip(sums, sums[1:]):
+            length = min(common_length(sums1, sums2) * block_size, sizes[blob1], sizes[blob2])
+            if length >= min_shared:
+                report.add_shared(kind, length, blob1, sizes[blob1], blob2, sizes[blob2])
+    report.shared.sort(key = lambda shared: shared[1], reverse = True)
+    return report
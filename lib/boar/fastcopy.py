@@ -0,0 +1,162 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+Copies files without passing the contents through python, when the
+operating system allows it. In order of preference:
+
+reflink          The copy shares the data blocks of the source until
+                 either file is modified (btrfs, xfs and others). Takes
+                 no time regardless of the file size.
+copy_file_range  The kernel copies the data, possibly without reading
+                 it (Linux 4.5 and later, some file systems share
+                 blocks just like a reflink).
+sendfile         The kernel copies the data (Linux 2.6.33 and later).
+
+The sendfile function is also used to send files to sockets.
+
+If none of these work, the file is copied the ordinary way. The
+system calls are made through ctypes, as they are not available in
+the os module of this python version.
+"""
+
+import os
+import errno
+import shutil
+import select
+import ctypes
+import ctypes.util
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int), from linux/fs.h
+FICLONE = 0x40049409
+
+# The largest number of bytes to pass to a single sendfile call
+MAX_CHUNK = 2**30
+
+# Errors meaning that the method is not supported for these files,
+# and that the next method should be tried.
+UNSUPPORTED_ERRORS = set([errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP,
+                          errno.ENOTTY, errno.EBADF, errno.EPERM])
+
+def _load_libc():
+    if os.name != "posix":
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    except OSError:
+        return None
+    for name, restype, argtypes in \
+            (("sendfile", ctypes.c_ssize_t,
+              [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]),
+             ("copy_file_range", ctypes.c_ssize_t,
+              [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+               ctypes.c_size_t, ctypes.c_uint])):
+        function = getattr(libc, name, None)
+        if function:
+            function.restype = restype
+            function.argtypes = argtypes
+    return libc
+
+libc = _load_libc()
+
+class Unsupported(Exception):
+    pass
+
+def reflink(source_fd, dest_fd):
+    if not fcntl or not hasattr(os, "uname") or os.uname()[0] != "Linux":
+        raise Unsupported()
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, source_fd)
+    except IOError, e:
+        if e.errno in UNSUPPORTED_ERRORS:
+            raise Unsupported()
+        raise
+
+def _kernel_copy(function_name, call, size, dest_fd = None, timeout = None):
+    """Calls the given function until size bytes have been
+    copied. The call must return the number of copied bytes, or -1 on
+    errors. If a dest_fd is given, it may be non-blocking, and the
+    copy waits at most timeout seconds for it to become writable."""
+    if not libc or not getattr(libc, function_name, None):
+        raise Unsupported()
+    copied = 0
+    while copied < size:
+        result = call(min(size - copied, MAX_CHUNK))
+        if result < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err == errno.EAGAIN and dest_fd is not None:
+                if not select.select([], [dest_fd], [], timeout)[1]:
+                    raise IOError(errno.ETIMEDOUT, "Timed out while sending")
+                continue
+            if copied == 0 and err in UNSUPPORTED_ERRORS:
+                raise Unsupported()
+            raise OSError(err, "%s failed: %s" % (function_name, os.strerror(err)))
+        if result == 0:
+            raise IOError(errno.EIO, "Source file is shorter than expected")
+        copied += result
+
+def copy_file_range(source_fd, dest_fd, size):
+    _kernel_copy("copy_file_range",
+                 lambda n: libc.copy_file_range(source_fd, None, dest_fd, None, n, 0), size)
+
+def sendfile(source_fd, dest_fd, size, offset = None, timeout = None):
+    """Copies size bytes from the source file to the destination,
+    which may be a socket. If an offset is given, the data is read
+    from that position and the position of the source is not
+    changed."""
+    if offset is None:
+        _kernel_copy("sendfile", lambda n: libc.sendfile(dest_fd, source_fd, None, n), size,
+                     dest_fd, timeout)
+        return
+    position = ctypes.c_int64(offset)
+    _kernel_copy("sendfile", lambda n: libc.sendfile(dest_fd, source_fd, ctypes.byref(position), n), size,
+                 dest_fd, timeout)
+
+def copy_fileobj(source, dest):
+    """Copies the full contents of the source file object to the dest
+    file object, which must both be positioned at the start of the
+    files. Returns the name of the method that was used."""
+    size = os.fstat(source.fileno()).st_size
+    dest.flush()
+    try:
+        reflink(source.fileno(), dest.fileno())
+        return "reflink"
+    except Unsupported:
+        pass
+    for name, method in (("copy_file_range", copy_file_range), ("sendfile", sendfile)):
+        try:
+            method(source.fileno(), dest.fileno(), size)
+            return name
+        except Unsupported:
+            pass
+    shutil.copyfileobj(source, dest, 2**16)
+    return "copy"
+
+def copy_file(source_path, dest_fo):
+    """Copies the contents of the file at the given path to the given
+    (empty) file object. Returns the name of the method that was
+    used."""
+    with open(source_path, "rb") as source:
+        return copy_fileobj(source, dest_fo)
@@ -24,6 +24,7 @@ implement an RPC mechanism for this interface.
 from blobrepo import repository
 from boar_exceptions import *
 import sys
+import hashlib
 from time import ctime, time
 from common import md5sum
 
@@ -43,11 +44,11 @@ def get_file_contents(front, session_name, file_name):
     rev = front.find_last_revision(session_name)
     if not rev:
         raise SessionNotFoundError("No such session: %s" % session_name)
-    for blobinfo in front.get_session_bloblist(rev):
-        if blobinfo['filename'] == file_name:
-            blob_reader = front.get_blob(blobinfo['md5sum'])
-            return blob_reader.read()
-    return None
+    blobinfo = front.get_session_blobinfo(rev, file_name)
+    if not blobinfo:
+        return None
+    blob_reader = front.get_blob(blobinfo['md5sum'])
+    return blob_reader.read()
 
 def add_file_simple(front, filename, contents):
     """Adds a file with contents to a new snapshot. The front instance
@@ -81,21 +82,15 @@ class Front:
         self.repo = repo
         self.new_session = None
         self.blobs_to_verify = []
+        self.commit_stats = None
 
     def get_repo_path(self):
         return self.repo.get_repo_path()
 
     def get_session_ids(self, session_name = None):
-        sids = self.repo.get_all_sessions()
         if not session_name:
-            return sids
-        result = []
-        for sid in sids:
-            session_info = self.get_session_info(sid)
-            name = session_info.get("name")
-            if name == session_name:
-                result.append(sid)
-        return result
+            return self.repo.get_all_sessions()
+        return self.repo.get_session_ids_by_name(session_name)
 
     def __set_session_property(self, session_name, property_name, new_value):
         assert property_name in valid_session_props
@@ -147,12 +142,34 @@ class Front:
         properties = session_reader.get_properties()
         return properties['client_data']
 
+    def get_session_infos(self, ids):
+        """ Returns a list of the session infos of the given snapshots,
+        in the same order. """
+        return [self.get_session_info(id) for id in ids]
+
+    def get_session_file_counts(self, ids):
+        """ Returns a list of the number of files in each of the given
+        snapshots, in the same order. """
+        counts = []
+        for id in ids:
+            count = 0
+            for blobinfo in self.repo.get_session(id).get_all_blob_infos():
+                count += 1
+            counts.append(count)
+        return counts
+
     def get_session_fingerprint(self, id):
         session_reader = self.repo.get_session(id)        
         properties = session_reader.get_properties()
         assert "fingerprint" in properties
         return properties["fingerprint"]
 
+    def get_session_blobinfo(self, id, filename):
+        """ Returns the blobinfo for the given filename in the given
+        snapshot, or None if there is no such file."""
+        session_reader = self.repo.get_session(id)
+        return session_reader.get_blob_info(filename)
+
     def get_session_bloblist(self, id):
         session_reader = self.repo.get_session(id)
         bloblist = list(session_reader.get_all_blob_infos())
@@ -172,16 +189,18 @@ class Front:
     def has_snapshot(self, session_name, snapshot_id):
         """ Returns True if there exists a session with the given
         session_name and snapshot id """
-        if snapshot_id not in self.get_session_ids():
-            return False
-        session_info = self.get_session_info(snapshot_id)
-        name = session_info.get("name", None)
-        return name == session_name        
+        return snapshot_id in self.repo.get_session_ids_by_name(session_name)
 
     def add_blob_data(self, blob_md5, b64data):
         """ Must be called after a create_session()  """
         self.new_session.add_blob_data(blob_md5, base64.b64decode(b64data))
 
+    def add_blob_stream(self, blob_md5, datasource):
+        """ Must be called after a create_session(). Adds all the data
+        in the given DataSource as a new blob, without any base64
+        encoding. Returns the number of bytes added. """
+        return self.new_session.add_blob_stream(blob_md5, datasource)
+
     def add(self, metadata):
         """ Must be called after a create_session(). Adds a link to a existing
         blob. Will throw an exception if there is no such blob """
@@ -189,12 +208,22 @@ class Front:
         assert metadata.has_key("filename")
         self.new_session.add(metadata)
 
+    def add_many(self, metadatas):
+        """ Same as add(), for a list of files. """
+        for metadata in metadatas:
+            self.add(metadata)
+
     def remove(self, filename):
         """ Remove the given file in the workdir from the current
         session. Requires that the current session has a base
         session""" 
         self.new_session.remove(filename)
 
+    def remove_many(self, filenames):
+        """ Same as remove(), for a list of files. """
+        for filename in filenames:
+            self.remove(filename)
+
     def mksession(self, sessionName):
         if sessionName.startswith("__"):
             raise UserError("Session names must not begin with double underscores.")
@@ -214,9 +243,17 @@ class Front:
         assert self.new_session, "There is no active snapshot to commit"
         assert "name" in sessioninfo
         id = self.new_session.commit(sessioninfo)
+        self.commit_stats = self.new_session.chunking_stats
         self.new_session = None
         return id
 
+    def get_commit_stats(self):
+        """ Returns a dict telling how many large blobs were stored
+        as chunks by the last commit, their total size, and the size
+        of the chunks that were not already in the repository. Returns
+        None if nothing has been committed. """
+        return self.commit_stats
+
 ## Disabled until I can figure out how to make transparent 
 ##calls with binary data in jasonrpc
 #    def get_blob(self, sum):
@@ -229,11 +266,35 @@ class Front:
         datasource = self.repo.get_blob_reader(sum, offset, size)
         return datasource
 
+    def get_raw_blob_path(self, sum):
+        """ Returns the path of the file that holds the given blob, or
+        None if the blob is recipe based or stored in a pack. Only
+        useful for clients on the same machine as the repository. """
+        location = self.repo.get_raw_blob_location(sum)
+        if not location or location[0] != self.repo.get_blob_path(sum):
+            return None
+        return location[0]
+
+    def get_blob_prefix_md5(self, sum, size):
+        """ Returns the md5sum of the first "size" bytes of the given
+        blob. Used to verify a partially downloaded blob before the
+        download is resumed. """
+        datasource = self.repo.get_blob_reader(sum, 0, size)
+        summer = hashlib.md5()
+        while datasource.bytes_left() > 0:
+            summer.update(datasource.read(2**16))
+        return summer.hexdigest()
+
     def has_blob(self, sum):
         if self.new_session:
             return self.repo.has_blob(sum) or self.new_session.has_blob(sum)
         return self.repo.has_blob(sum)
 
+    def has_blobs(self, sums):
+        """ Returns a list of booleans, telling if the blobs with the
+        given checksums exist. """
+        return [self.has_blob(sum) for sum in sums]
+
     def find_last_revision(self, session_name):
         """ Returns the id of the latest snapshot in the specified
         session. Returns None if there is no such session. """
@@ -241,7 +302,7 @@ class Front:
 
     def init_verify_blobs(self):
         assert self.blobs_to_verify == []
-        self.blobs_to_verify = self.repo.get_blob_names()
+        self.blobs_to_verify = list(self.repo.iter_blob_names())
         return len(self.blobs_to_verify)
 
     def verify_some_blobs(self):
@@ -266,7 +327,16 @@ class DryRunFront:
         return self.realfront.get_session_ids()
 
     def get_session_info(self, id):
-        return self.realfront.get_session_properties(id)['client_data']
+        return self.realfront.get_session_info(id)
+
+    def get_session_infos(self, ids):
+        return self.realfront.get_session_infos(ids)
+
+    def get_session_file_counts(self, ids):
+        return self.realfront.get_session_file_counts(ids)
+
+    def get_session_blobinfo(self, id, filename):
+        return self.realfront.get_session_blobinfo(id, filename)
 
     def get_session_bloblist(self, id):
         return self.realfront.get_session_bloblist(id)
@@ -277,15 +347,27 @@ class DryRunFront:
     def add_blob_data(self, blob_md5, b64data):
         pass
 
+    def add_blob_stream(self, blob_md5, datasource):
+        return datasource.bytes_left()
+
     def add(self, metadata):
         pass
 
+    def add_many(self, metadatas):
+        pass
+
     def remove(self, filename):
         pass
 
+    def remove_many(self, filenames):
+        pass
+
     def commit(self, sessioninfo = {}):
         return 0
 
+    def get_commit_stats(self):
+        return None
+
     def get_blob_size(self, sum):
         return self.realfront.get_blob_size(sum)
 
@@ -295,6 +377,9 @@ class DryRunFront:
     def has_blob(self, sum):
         return self.realfront.has_blob(sum)
 
+    def has_blobs(self, sums):
+        return self.realfront.has_blobs(sums)
+
     def find_last_revision(self, session_name):
         return self.realfront.find_last_revision(session_name)
 
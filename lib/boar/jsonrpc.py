@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from __future__ import with_statement
+
 __version__ = "2008-08-31-beta"
 __author__   = "Roland Koebler <rk(at)simple-is-better.org>"
 __license__  = """Copyright (c) 2007-2008 by Roland Koebler (rk(at)simple-is-better.org)
@@ -29,6 +31,17 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE."""
 
 import sys
 import struct
+import threading
+import itertools
+import Queue
+import zlib
+
+import fastcopy
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
 
 #=========================================
 # errors
@@ -69,6 +82,9 @@ ERROR_MESSAGE = {
 class RPCError(Exception):
     """Base class for rpc-errors."""
 
+class ConnectionLost(Exception):
+    """The other end closed the connection unexpectedly."""
+
 class RPCFault(RPCError):
     """RPC error/fault package received.
     
@@ -170,25 +186,35 @@ class DataSource:
         raise NotImplementedError()
 
 class SocketDataSource(DataSource):
-    def __init__(self, socket, data_size):
+    def __init__(self, socket, data_size, close_when_done = True, stats = None):
+        """If close_when_done is False, the socket is left open after
+        the last byte has been read, so that it can be reused. The
+        transferred bytes are recorded in the given TransferStats, if
+        any."""
         self.socket = socket
         self.remaining = data_size
-        if self.remaining == 0:
+        self.close_when_done = close_when_done
+        self.stats = stats
+        if self.remaining == 0 and self.close_when_done:
             self.socket.close()
 
     def bytes_left(self):
         return self.remaining
 
-    def read(self, n):
+    def read(self, n = None):
+        if n == None:
+            n = self.remaining
         if self.remaining == 0:
             return ""
         bytes_to_read = min(n, self.remaining)
         data = RecvNBytes(self.socket, bytes_to_read)
+        if self.stats:
+            self.stats.add(bytes_to_read, bytes_to_read)
         self.remaining -= bytes_to_read
         assert len(data) == bytes_to_read
         assert len(data) <= n
         assert self.remaining >= 0
-        if self.remaining == 0:
+        if self.remaining == 0 and self.close_when_done:
             self.socket.close()
         return data
 
@@ -217,6 +243,194 @@ class FileDataSource(DataSource):
             self.fo.close()
         return data
 
+    def send_to_socket(self, sock, n = None):
+        """Sends the next n bytes to the given socket. When the data
+        source reads a real file, the data is sent by the operating
+        system without passing through python. Returns the number of
+        bytes sent."""
+        if n == None:
+            n = self.remaining
+        n = min(n, self.remaining)
+        try:
+            fileno = self.fo.fileno()
+        except AttributeError:
+            fileno = None
+        try:
+            if fileno is None:
+                raise fastcopy.Unsupported()
+            fastcopy.sendfile(fileno, sock.fileno(), n, self.fo.tell(), sock.gettimeout())
+        except fastcopy.Unsupported:
+            sock.sendall(self.read(n))
+            return n
+        except EnvironmentError, e:
+            raise socket.error(e.errno, e.strerror)
+        self.fo.seek(n, 1)
+        self.remaining -= n
+        if self.remaining == 0:
+            self.fo.close()
+        return n
+
+"""
+A compressed binary payload is sent as a sequence of chunks, each
+consisting of a chunk header followed by the chunk data. The chunk
+header tells how the chunk data is encoded, the size of the decoded
+data and the size of the chunk data. The chunks follow each other
+until the full (decoded) payload size, as given in the message
+header, has been sent. Every chunk can be encoded differently, so
+data that does not compress well (such as jpeg images or video) can
+be sent as it is.
+"""
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+
+CHUNK_HEADER_FORMAT = "!BII"
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_HEADER_FORMAT)
+COMPRESSION_CHUNK_SIZE = 2**16
+ZLIB_LEVEL = 6
+
+# A chunk that does not shrink below this ratio is sent uncompressed,
+# and the following chunks are then sent uncompressed without trying
+# to compress them.
+INCOMPRESSIBLE_RATIO = 0.9
+INCOMPRESSIBLE_SKIP_CHUNKS = 16
+
+def available_codecs():
+    """Returns the compression codecs that are supported by this
+    installation, the preferred (fastest) one first."""
+    codecs = [CODEC_ZLIB]
+    if lz4_block:
+        codecs.insert(0, CODEC_LZ4)
+    return codecs
+
+def compress_chunk(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    assert codec == CODEC_LZ4, "Unknown codec: " + str(codec)
+    return lz4_block.compress(data, store_size = False)
+
+def decompress_chunk(codec, data, size):
+    if codec == CODEC_RAW:
+        result = data
+    elif codec == CODEC_ZLIB:
+        result = zlib.decompress(data)
+    elif codec == CODEC_LZ4 and lz4_block:
+        result = lz4_block.decompress(data, uncompressed_size = size)
+    else:
+        raise RPCError("Unsupported codec in payload: " + str(codec))
+    if len(result) != size:
+        raise RPCError("Corrupt compressed payload")
+    return result
+
+class TransferStats:
+    """Counts the number of payload bytes transferred, and the
+    number of bytes that it took to transfer them."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.payload_bytes = 0
+        self.wire_bytes = 0
+
+    def add(self, payload_bytes, wire_bytes):
+        with self.lock:
+            self.payload_bytes += payload_bytes
+            self.wire_bytes += wire_bytes
+
+class CompressedSocketDataSource(DataSource):
+    """Reads a compressed binary payload from a socket."""
+    def __init__(self, socket, data_size, close_when_done = True, stats = None):
+        self.socket = socket
+        self.remaining = data_size
+        self.not_received = data_size
+        self.buffer = ""
+        self.close_when_done = close_when_done
+        self.stats = stats
+        if self.remaining == 0 and self.close_when_done:
+            self.socket.close()
+
+    def bytes_left(self):
+        return self.remaining
+
+    def __receive_chunk(self):
+        codec, size, stored_size = struct.unpack(CHUNK_HEADER_FORMAT, \
+                                                     RecvNBytes(self.socket, CHUNK_HEADER_SIZE))
+        if size > self.not_received:
+            raise RPCError("Protocol error. Compressed payload is too large")
+        data = decompress_chunk(codec, RecvNBytes(self.socket, stored_size), size)
+        self.not_received -= size
+        if self.stats:
+            self.stats.add(size, CHUNK_HEADER_SIZE + stored_size)
+        return data
+
+    def read(self, n = None):
+        if n == None:
+            n = self.remaining
+        if self.remaining == 0:
+            return ""
+        bytes_to_read = min(n, self.remaining)
+        parts = [self.buffer]
+        buffered = len(self.buffer)
+        while buffered < bytes_to_read:
+            chunk = self.__receive_chunk()
+            parts.append(chunk)
+            buffered += len(chunk)
+        self.buffer = "".join(parts)
+        data = self.buffer[:bytes_to_read]
+        self.buffer = self.buffer[bytes_to_read:]
+        self.remaining -= bytes_to_read
+        assert self.remaining >= 0
+        if self.remaining == 0 and self.close_when_done:
+            self.socket.close()
+        return data
+
+def send_data_source(socket, data_source, codec = None, stats = None):
+    """Sends all the remaining data of the given data source. If a
+    codec is given, the data is sent as a compressed payload. The
+    transferred bytes are recorded in the given TransferStats, if
+    any."""
+    if codec is None:
+        while data_source.bytes_left() > 0:
+            if isinstance(data_source, FileDataSource):
+                sent = data_source.send_to_socket(socket, 2**24)
+            else:
+                data = data_source.read(2**16)
+                socket.sendall(data)
+                sent = len(data)
+            if stats:
+                stats.add(sent, sent)
+        return
+    skip_chunks = 0
+    while data_source.bytes_left() > 0:
+        if skip_chunks > 0 and isinstance(data_source, FileDataSource):
+            # Known to be incompressible - let the OS send it
+            skip_chunks -= 1
+            size = min(COMPRESSION_CHUNK_SIZE, data_source.bytes_left())
+            socket.sendall(struct.pack(CHUNK_HEADER_FORMAT, CODEC_RAW, size, size))
+            data_source.send_to_socket(socket, size)
+            if stats:
+                stats.add(size, CHUNK_HEADER_SIZE + size)
+            continue
+        data = data_source.read(COMPRESSION_CHUNK_SIZE)
+        chunk_codec, stored = CODEC_RAW, data
+        if skip_chunks > 0:
+            skip_chunks -= 1
+        else:
+            compressed = compress_chunk(codec, data)
+            if len(compressed) < len(data) * INCOMPRESSIBLE_RATIO:
+                chunk_codec, stored = codec, compressed
+            else:
+                skip_chunks = INCOMPRESSIBLE_SKIP_CHUNKS
+        socket.sendall(struct.pack(CHUNK_HEADER_FORMAT, chunk_codec, len(data), len(stored)) + stored)
+        if stats:
+            stats.add(len(data), CHUNK_HEADER_SIZE + len(stored))
+
+def create_socket_data_source(socket, data_size, flags, close_when_done = True, stats = None):
+    """Returns a data source that reads a binary payload with the
+    given message header flags from the socket."""
+    if flags & FLAG_COMPRESSED_PAYLOAD:
+        return CompressedSocketDataSource(socket, data_size, close_when_done, stats)
+    return SocketDataSource(socket, data_size, close_when_done, stats)
+
 def RecvNBytes(socket, n, timeout = None):
     data_parts = []
     readsize = 0
@@ -224,9 +438,9 @@ def RecvNBytes(socket, n, timeout = None):
         ready_list = select.select((socket,), (), (), timeout)[0]
         if not ready_list:
             raise Exception("Communication timeout")
-        d = socket.recv( min(4096, n - readsize ))
+        d = socket.recv( min(2**16, n - readsize ))
         if len(d) == 0:
-            raise Exception("Unexpected end of stream")
+            raise ConnectionLost("Unexpected end of stream")
         data_parts.append(d)
         readsize += len(d)
     assert readsize == n, "Protocol error. Expected %s bytes, got %s" % (n, readsize)
@@ -281,6 +495,17 @@ class JsonRpc20:
             return '{"jsonrpc": "2.0", "method": %s, "id": %s}' % \
                     (self.dumps(method), self.dumps(id))
 
+    def dumps_batch_request( self, requests ):
+        """serialize a JSON-RPC batch of requests
+
+        :Parameters:
+            - requests: list of (method, params, id) tuples
+        :Returns:   | [{"jsonrpc": "2.0", "method": ...}, ...]
+        """
+        assert requests, "A batch must contain at least one request"
+        return "[%s]" % ", ".join([self.dumps_request( method, params, id )
+                                   for method, params, id in requests])
+
     def dumps_response( self, result, id=None ):
         """serialize a JSON-RPC-Response (without error)
 
@@ -322,6 +547,13 @@ class JsonRpc20:
             data = self.loads(string)
         except ValueError, err:
             raise RPCParseError("No valid JSON. (%s)" % str(err))
+        return self.parse_request(data)
+
+    def parse_request( self, data ):
+        """check a de-serialized JSON-RPC Request (one item of a batch)
+
+        :See: loads_request
+        """
         if not isinstance(data, dict):  raise RPCInvalidRPC("No valid RPC-package.")
         if "jsonrpc" not in data:       raise RPCInvalidRPC("""Invalid Response, "jsonrpc" missing.""")
         if not isinstance(data["jsonrpc"], (str, unicode)):
@@ -355,6 +587,14 @@ class JsonRpc20:
             data = self.loads(string)
         except ValueError, err:
             raise RPCParseError("No valid JSON. (%s)" % str(err))
+        return self.parse_response(data)
+
+    def parse_response( self, data ):
+        """check a de-serialized JSON-RPC Response/error (one item of
+        a batch)
+
+        :See: loads_response
+        """
         if not isinstance(data, dict):  raise RPCInvalidRPC("No valid RPC-package.")
         if "jsonrpc" not in data:       raise RPCInvalidRPC("""Invalid Response, "jsonrpc" missing.""")
         if not isinstance(data["jsonrpc"], (str, unicode)):
@@ -401,6 +641,33 @@ class JsonRpc20:
         else:
             return data["result"], data["id"]
 
+    def loads_batch_response( self, string ):
+        """de-serialize the response to a JSON-RPC batch
+
+        :Returns: | a dict {id: [result, None]} for Responses and
+                  | {id: [None, RPCFault]} for errors
+        :Raises:  | RPCParseError, RPCInvalidRPC
+        """
+        try:
+            data = self.loads(string)
+        except ValueError, err:
+            raise RPCParseError("No valid JSON. (%s)" % str(err))
+        if not isinstance(data, list):
+            # A batch that could not be parsed is answered with a
+            # single error
+            self.parse_response(data)
+            raise RPCInvalidRPC("Invalid Response, expected a batch.")
+        responses = {}
+        for item in data:
+            try:
+                result, id = self.parse_response(item)
+                responses[id] = [result, None]
+            except RPCFault, err:
+                if not isinstance(item, dict) or "id" not in item:
+                    raise
+                responses[item["id"]] = [None, err]
+        return responses
+
 jsonrpc20 = JsonRpc20()
 
 #=========================================
@@ -444,28 +711,92 @@ def log_filedate( filename ):
 HEADER_SIZE=17
 HEADER_MAGIC=0x12345678
 HEADER_VERSION=1
+KEEPALIVE_HEADER_VERSION=2
 """
 The header has 
 """
-def pack_header(payload_size, binary_payload_size = None):
-    has_binary_payload = True
+"""
+A request with a version 1 header is answered, and then the
+connection is closed. A request with a version 2 header is answered
+with a version 2 header, after which the server waits for another
+request on the same connection. Every request on a version 2
+connection must have a unique JSON-RPC id, which is returned in the
+response.
+
+In version 2, the has_binary_payload byte of the header is a set of
+flags. Apart from telling if there is a binary payload, they tell if
+the payload is compressed, and which codecs the sender can receive
+compressed payloads in. A peer may only send a compressed payload
+if the other side has announced that it accepts the codec in an
+earlier message on the same connection. Clients announce this in
+every request, and servers in every response.
+
+A server sets the connection state flag in a response when it holds
+state for the connection that would be lost with it, such as a
+snapshot that is being created. Such a connection is never closed by
+the server for being idle, and a client must not silently replace it
+with a new connection.
+"""
+
+FLAG_BINARY_PAYLOAD = 0x01
+FLAG_COMPRESSED_PAYLOAD = 0x02
+FLAG_ACCEPT_ZLIB = 0x04
+FLAG_ACCEPT_LZ4 = 0x08
+FLAG_CONNECTION_STATE = 0x10
+
+CODEC_FLAGS = ((CODEC_LZ4, FLAG_ACCEPT_LZ4), (CODEC_ZLIB, FLAG_ACCEPT_ZLIB))
+
+def codecs_to_flags(codecs):
+    flags = 0
+    for codec, flag in CODEC_FLAGS:
+        if codec in codecs:
+            flags |= flag
+    return flags
+
+def choose_codec(flags, codecs):
+    """Returns the first of the given codecs that the peer accepts
+    according to its header flags, or None if there is no such
+    codec."""
+    for codec in codecs:
+        if flags & dict(CODEC_FLAGS)[codec]:
+            return codec
+    return None
+
+# The number of seconds a server keeps an idle keep-alive connection
+# open while waiting for the next request, unless it holds state for
+# the connection.
+KEEPALIVE_IDLE_TIMEOUT=10.0
+
+def pack_header(payload_size, binary_payload_size = None, version = HEADER_VERSION, flags = 0):
+    """The binary_payload_size is the size of the binary payload
+    before any compression."""
+    assert version in (HEADER_VERSION, KEEPALIVE_HEADER_VERSION)
+    assert version == KEEPALIVE_HEADER_VERSION or flags == 0
     if binary_payload_size == None:
-        has_binary_payload = False
+        assert not flags & FLAG_COMPRESSED_PAYLOAD
         binary_payload_size = 0
-    header_str = struct.pack("!III?I", HEADER_MAGIC, HEADER_VERSION, payload_size,\
-                                 has_binary_payload, binary_payload_size)
+    else:
+        flags |= FLAG_BINARY_PAYLOAD
+    header_str = struct.pack("!IIIBI", HEADER_MAGIC, version, payload_size,\
+                                 flags, binary_payload_size)
     assert len(header_str) == HEADER_SIZE
     return header_str
 
 def unpack_header(header_str):
+    """Returns a (version, payload_size, binary_payload_size, flags)
+    tuple. The binary_payload_size is None if there is no binary
+    payload."""
     assert len(header_str) == HEADER_SIZE
-    magic, version, payload_size, has_binary_payload, binary_payload_size = \
-        struct.unpack("!III?I", header_str)
+    magic, version, payload_size, flags, binary_payload_size = \
+        struct.unpack("!IIIBI", header_str)
     assert magic == HEADER_MAGIC, header_str
-    if not has_binary_payload:
+    assert version in (HEADER_VERSION, KEEPALIVE_HEADER_VERSION), "Unknown protocol version: " + str(version)
+    if version == HEADER_VERSION:
+        assert flags in (0, FLAG_BINARY_PAYLOAD), "Invalid header flags: " + str(flags)
+    if not flags & FLAG_BINARY_PAYLOAD:
         assert binary_payload_size == 0
         binary_payload_size = None
-    return payload_size, binary_payload_size
+    return version, payload_size, binary_payload_size, flags
 
 import socket, select
 class TransportTcpIp:
@@ -509,19 +840,26 @@ class TransportTcpIp:
     def __repr__(self):
         return "<TransportSocket, %s>" % repr(self.addr)
     
-    def send( self, string ):
+    def send( self, string, data_source = None ):
+        """Sends the request string, followed by the contents of the
+        data source as a binary payload if one is given."""
         if self.s is None:
             self.connect()
-        header = pack_header(len(string))
+        binary_data_size = None
+        if data_source is not None:
+            binary_data_size = data_source.bytes_left()
+        header = pack_header(len(string), binary_data_size)
         self.s.sendall( header )
         self.s.sendall( string )
+        if data_source is not None:
+            send_data_source(self.s, data_source)
         self.log( "TransportSocket.Send() --> "+repr(string) )
         
     def recv( self ):
         if self.s is None:
             self.connect()
         header = RecvNBytes(self.s, HEADER_SIZE)
-        datasize, binary_data_size = unpack_header(header)
+        version, datasize, binary_data_size, flags = unpack_header(header)
         data = RecvNBytes(self.s, datasize, 5.0)
         self.log( "TransportSocket.Recv() --> "+repr(data) )
         if binary_data_size != None:            
@@ -529,13 +867,13 @@ class TransportTcpIp:
         else:
             return data, None
 
-    def sendrecv( self, string ):
+    def sendrecv( self, string, payload = None ):
         """send data + receive data + close"""
         self.close()
         data_source = None
         try:
             self.log("SendRecv id = " + str(id(self)))
-            self.send( string )
+            self.send( string, payload )
             self.log("SendRecv Waiting for reply")
             reply, data_source = self.recv()
             self.log("SendRecv Got a reply")
@@ -551,50 +889,338 @@ class TransportTcpIp:
         self.s = socket.socket( self.s_type, self.s_prot )
         self.log( "Server id %s listens at %s" % (id(self),self.addr) )
         self.s.bind( self.addr )
-        self.s.listen(1)
+        self.s.listen(socket.SOMAXCONN)
 
-    def serve(self, handler, n=None):
+    def serve(self, handler_factory, n=None, workers=None):
         """open socket, wait for incoming connections and handle them.
         
         :Parameters:
+            - handler_factory: handler_factory(persistent) is called
+              for every connection and returns the function that
+              handles the requests on that connection. persistent is
+              True for keep-alive connections.
             - n: serve n requests, None=forever
+            - workers: the number of connections to serve
+              concurrently. If None, the connections are served one
+              at a time by the calling thread.
         """
+        assert workers is None or (workers > 0 and n is None), \
+            "A request limit can only be used when serving on a single thread"
         try:
             self.init_server()
+            if workers is not None:
+                self.__serve_concurrently(handler_factory, workers)
+                return
             n_current = 0
             while 1:
                 if n is not None  and  n_current >= n:
                     break
                 conn, addr = self.s.accept()
-                self.log( "TransportSocket.Serve(): %s connected" % repr(addr) )
-                header = RecvNBytes(conn, HEADER_SIZE)
-                self.log( "TransportSocket.Serve(): got an header")
-                datasize, binary_data_size = unpack_header(header)
-                assert binary_data_size == None, "Not implemented yet. Was: " + str(binary_data_size)
-                data = RecvNBytes(conn, datasize, 5.0)
-                self.log( "TransportSocket.Serve(): Got a message: %s --> %s" % (repr(addr), repr(data)) )
-                result = handler(data)
-                self.log( "TransportSocket.Serve(): Message was handled ok" )
-                assert result != None
-                self.log( "TransportSocket.Serve(): Responding to %s <-- %s" % (repr(addr), repr(result)) )  
-                if isinstance(result, DataSource):
-                    dummy_result = jsonrpc20.dumps_response(None)
-                    header = pack_header(len(dummy_result), result.bytes_left())
-                    conn.sendall( header )
-                    conn.sendall( dummy_result )
-                    while result.bytes_left() > 0:
-                        conn.sendall(result.read(2**14))
-                else:
-                    header = pack_header(len(result))
-                    conn.sendall( header )
-                    conn.sendall( result )
-                self.log( "TransportSocket.Serve(): Response sent" )
-                self.log( "TransportSocket.Serve(): %s close" % repr(addr) )
-                conn.close()
-                n_current += 1
+                max_requests = None
+                if n is not None:
+                    max_requests = n - n_current
+                n_current += self.serve_connection(conn, addr, handler_factory, max_requests,
+                                                   lambda: listener_ready(self.s))
         finally:
             self.close()
 
+    def __serve_concurrently(self, handler_factory, workers):
+        """Accepts connections and hands them over to a pool of
+        worker threads. When all workers are busy and there are as
+        many connections waiting, no more connections are accepted
+        until a worker becomes available."""
+        pending = Queue.Queue(workers)
+        def worker():
+            while 1:
+                conn, addr = pending.get()
+                self.serve_connection(conn, addr, handler_factory, None,
+                                      lambda: not pending.empty())
+        for i in range(0, workers):
+            t = threading.Thread(target = worker)
+            t.setDaemon(True)
+            t.start()
+        while 1:
+            conn, addr = self.s.accept()
+            pending.put((conn, addr))
+
+    def serve_connection(self, conn, addr, handler_factory, max_requests = None, others_waiting = None):
+        """Serves requests on the given connection until it is closed
+        by the client, or until it is a keep-alive connection that has
+        been idle for too long. An idle keep-alive connection is also
+        closed if the function others_waiting() returns True. A
+        connection that the handler holds state for (see
+        Server.register_factory()) is never closed for being
+        idle. Returns the number of handled requests."""
+        self.log( "TransportSocket.Serve(): %s connected" % repr(addr) )
+        set_nodelay(conn)
+        handler = None
+        n_current = 0
+        try:
+            while 1:
+                version, data, payload, flags = self.read_request(conn, addr)
+                if handler is None:
+                    handler = handler_factory(version == KEEPALIVE_HEADER_VERSION)
+                result = handler(data, payload)
+                if payload is not None:
+                    # Skip whatever the handler did not read
+                    while payload.bytes_left() > 0:
+                        payload.read(2**16)
+                has_state = getattr(handler, "has_state", lambda: False)()
+                self.send_response(conn, addr, version, result, choose_codec(flags, available_codecs()),
+                                   has_state)
+                n_current += 1
+                if version != KEEPALIVE_HEADER_VERSION:
+                    break
+                if max_requests is not None  and  n_current >= max_requests:
+                    break
+                if has_state:
+                    if not wait_for_request(conn, None):
+                        break
+                elif not wait_for_request(conn, KEEPALIVE_IDLE_TIMEOUT, others_waiting):
+                    break
+        except (socket.error, ConnectionLost), e:
+            # Only the current connection is affected
+            self.log( "TransportSocket.Serve(): %s failed: %s" % (repr(addr), e) )
+        finally:
+            self.log( "TransportSocket.Serve(): %s close" % repr(addr) )
+            conn.close()
+        return n_current
+
+    def read_request(self, conn, addr):
+        """Reads one request from the given connection. Returns the
+        protocol version, the request and a data source for the
+        binary payload (or None if there is no binary payload), and
+        the header flags. The binary payload must be read to the end
+        before the next request can be read."""
+        header = RecvNBytes(conn, HEADER_SIZE)
+        self.log( "TransportSocket.Serve(): got an header")
+        version, datasize, binary_data_size, flags = unpack_header(header)
+        data = RecvNBytes(conn, datasize, 5.0)
+        self.log( "TransportSocket.Serve(): Got a message: %s --> %s" % (repr(addr), repr(data)) )
+        payload = None
+        if binary_data_size != None:
+            payload = create_socket_data_source(conn, binary_data_size, flags, close_when_done = False)
+        return version, data, payload, flags
+
+    def send_response(self, conn, addr, version, result, codec = None, has_state = False):
+        """Sends the result. A binary result is compressed with the
+        given codec, if any. If has_state is True, the client is told
+        that the server holds state for the connection."""
+        assert result != None
+        self.log( "TransportSocket.Serve(): Responding to %s <-- %s" % (repr(addr), repr(result)) )  
+        flags = 0
+        if version == KEEPALIVE_HEADER_VERSION:
+            flags = codecs_to_flags(available_codecs())
+            if has_state:
+                flags |= FLAG_CONNECTION_STATE
+        if isinstance(result, DataSource):
+            if codec is not None:
+                flags |= FLAG_COMPRESSED_PAYLOAD
+            dummy_result = jsonrpc20.dumps_response(None)
+            header = pack_header(len(dummy_result), result.bytes_left(), version, flags)
+            conn.sendall( header )
+            conn.sendall( dummy_result )
+            send_data_source(conn, result, codec)
+        else:
+            header = pack_header(len(result), version = version, flags = flags)
+            conn.sendall( header + result )
+        self.log( "TransportSocket.Serve(): Response sent" )
+
+def set_nodelay(s):
+    """Disables the Nagle algorithm for the given socket, if it is a
+    TCP socket. Small requests and responses on a persistent
+    connection would otherwise be delayed."""
+    if s.family == socket.AF_INET:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def is_connection_open(conn):
+    """Returns False if the other end has closed the given idle
+    connection."""
+    try:
+        if not select.select((conn,), (), (), 0)[0]:
+            return True
+        return conn.recv(1, socket.MSG_PEEK) != ""
+    except socket.error:
+        return False
+
+def listener_ready(listener):
+    """Returns True if a client is waiting to connect to the given
+    listening socket."""
+    return bool(select.select((listener,), (), (), 0)[0])
+
+def wait_for_request(conn, timeout, others_waiting = None):
+    """Waits for more data to arrive on the given connection. Returns
+    False if the other end closed the connection, if nothing arrived
+    within the timeout or if others_waiting() returns True. An idle
+    connection must not keep other clients waiting for the server. A
+    timeout of None waits until data arrives or the connection is
+    closed."""
+    if timeout is None:
+        try:
+            select.select((conn,), (), ())
+            return conn.recv(1, socket.MSG_PEEK) != ""
+        except socket.error:
+            return False
+    deadline = time.time() + timeout
+    try:
+        while 1:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if select.select((conn,), (), (), min(remaining, 0.1))[0]:
+                return conn.recv(1, socket.MSG_PEEK) != ""
+            if others_waiting and others_waiting():
+                return False
+    except socket.error:
+        return False
+
+class KeepAliveTransportTcpIp(TransportTcpIp):
+    """Transport via persistent sockets. Every thread gets a
+    connection of its own, which is kept open and reused for all
+    requests made by that thread.
+
+    If the server has closed an idle connection, the request is
+    retried once on a new connection. That is never done for a
+    connection that the server holds state for, since the state would
+    be silently lost. ConnectionLost is raised instead.
+    """
+    def __init__( self, addr = None, codecs = None, **kwargs ):
+        """
+        :Parameters:
+            - codecs: the compression codecs to use, in order of
+              preference. None means all available codecs.
+            - see TransportTcpIp for the rest
+        """
+        TransportTcpIp.__init__( self, addr, **kwargs )
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sockets = set() # The open sockets of all threads
+        if codecs is None:
+            codecs = available_codecs()
+        for codec in codecs:
+            assert codec in available_codecs(), "Codec not available: " + str(codec)
+        self.codecs = codecs
+        self.stats = TransferStats()
+
+    def __get_socket( self ):
+        return getattr(self.local, "s", None)
+
+    def connect( self ):
+        self.close()
+        self.log( "connect to %s" % repr(self.addr) )
+        s = socket.socket( self.s_type, self.s_prot )
+        s.settimeout( self.timeout )
+        s.connect( self.addr )
+        set_nodelay(s)
+        self.local.s = s
+        self.local.peer_flags = 0
+        self.local.server_state = False
+        with self.lock:
+            self.sockets.add(s)
+
+    def close( self ):
+        s = self.__get_socket()
+        if s is not None:
+            self.log( "close %s" % repr(self.addr) )
+            s.close()
+            with self.lock:
+                self.sockets.discard(s)
+        self.local.s = None
+        self.local.data_source = None
+
+    def close_all( self ):
+        """Closes the connections of all threads. Any thread that
+        makes another request will get a new connection."""
+        with self.lock:
+            for s in self.sockets:
+                s.close()
+            self.sockets.clear()
+
+    def __repr__(self):
+        return "<KeepAliveTransportSocket, %s>" % repr(self.addr)
+
+    def send( self, string, data_source = None ):
+        if self.__get_socket() is None:
+            self.connect()
+        binary_data_size = None
+        flags = codecs_to_flags(self.codecs)
+        codec = None
+        if data_source is not None:
+            binary_data_size = data_source.bytes_left()
+            codec = choose_codec(self.local.peer_flags, self.codecs)
+            if codec is not None:
+                flags |= FLAG_COMPRESSED_PAYLOAD
+        header = pack_header(len(string), binary_data_size, KEEPALIVE_HEADER_VERSION, flags)
+        self.local.s.sendall( header + string )
+        if data_source is not None:
+            send_data_source(self.local.s, data_source, codec, self.stats)
+        self.log( "KeepAliveTransportSocket.Send() --> "+repr(string) )
+
+    def recv( self ):
+        s = self.__get_socket()
+        header = RecvNBytes(s, HEADER_SIZE)
+        version, datasize, binary_data_size, flags = unpack_header(header)
+        assert version == KEEPALIVE_HEADER_VERSION, "Server does not support keep-alive connections"
+        self.local.peer_flags = flags
+        self.local.server_state = bool(flags & FLAG_CONNECTION_STATE)
+        data = RecvNBytes(s, datasize, 5.0)
+        self.log( "KeepAliveTransportSocket.Recv() --> "+repr(data) )
+        if binary_data_size != None:
+            self.local.data_source = create_socket_data_source(s, binary_data_size, flags, \
+                                                                   close_when_done = False, stats = self.stats)
+            return data, self.local.data_source
+        return data, None
+
+    def __check_server_state( self ):
+        """Raises ConnectionLost if the server held state for the
+        connection of the current thread, which has been closed."""
+        if getattr(self.local, "server_state", False):
+            self.local.server_state = False
+            raise ConnectionLost("The connection to the server was lost while the server "
+                                 "held state for it, such as a snapshot being created")
+
+    def sendrecv( self, string, payload = None ):
+        """send data + receive data, reusing the connection of the
+        current thread if there is one. A request with a binary
+        payload can not be retried, so the connection is checked
+        before such a request is sent."""
+        data_source = getattr(self.local, "data_source", None)
+        if data_source and data_source.bytes_left() > 0:
+            if getattr(self.local, "server_state", False):
+                # Closing the connection would lose the server state
+                while data_source.bytes_left() > 0:
+                    data_source.read(2**16)
+            else:
+                # The previous binary response was not read to the
+                # end, so the connection can not be reused.
+                self.close()
+        self.local.data_source = None
+        s = self.__get_socket()
+        with self.lock:
+            if s is not None and s not in self.sockets:
+                # Closed by close_all()
+                self.local.s = None
+        if payload is not None and self.__get_socket() is not None:
+            if not is_connection_open(self.__get_socket()):
+                self.close()
+        if self.__get_socket() is None:
+            self.__check_server_state()
+        reused = self.__get_socket() is not None
+        try:
+            try:
+                self.send( string, payload )
+                return self.recv()
+            except (socket.error, ConnectionLost), e:
+                if not reused or payload is not None:
+                    raise
+                self.__check_server_state()
+                self.log( "KeepAliveTransportSocket: retrying after %s" % e )
+                self.connect()
+                self.send( string )
+                return self.recv()
+        except:
+            self.close()
+            raise
 
 #=========================================
 # client side: server proxy
@@ -622,27 +1248,67 @@ class ServerProxy:
         #TODO: check parameters
         self.__data_serializer = data_serializer
         self.__transport = transport
+        self.__ids = itertools.count(1)
 
     def __str__(self):
         return repr(self)
     def __repr__(self):
         return "<ServerProxy for %s, with serializer %s>" % (self.__transport, self.__data_serializer)
 
-    def __req( self, methodname, args=None, kwargs=None, id=0 ):
+    def __req( self, methodname, args=None, kwargs=None ):
+        id = self.__ids.next()
         # JSON-RPC 2.0: only args OR kwargs allowed!
         if len(args) > 0 and len(kwargs) > 0:
             raise ValueError("Only positional or named parameters are allowed!")
+        # A DataSource given as the last positional argument is sent
+        # as a binary payload
+        payload = None
+        if len(args) > 0 and isinstance(args[-1], DataSource):
+            payload = args[-1]
+            args = args[:-1]
         if len(kwargs) == 0:
             req_str  = self.__data_serializer.dumps_request( methodname, args, id )
         else:
             req_str  = self.__data_serializer.dumps_request( methodname, kwargs, id )
 
-        resp_str, data_source = self.__transport.sendrecv( req_str )
+        resp_str, data_source = self.__transport.sendrecv( req_str, payload )
         if data_source:
             return data_source
         resp = self.__data_serializer.loads_response( resp_str )
+        if resp[1] != id:
+            raise RPCInvalidRPC("Invalid Response, expected id %s but got %s" % (id, resp[1]))
         return resp[0]
 
+    def batch(self, calls):
+        """Performs several calls in one round trip. The calls are
+        executed in order.
+
+        :Parameters:
+            - calls: list of (methodname, args) tuples
+        :Returns: a list of the results
+        :Raises: the error of the first failed call, if any
+        """
+        if not calls:
+            return []
+        requests = []
+        for methodname, args in calls:
+            for arg in args:
+                assert not isinstance(arg, DataSource), "Binary payloads can not be batched"
+            requests.append((methodname, args, self.__ids.next()))
+        req_str = self.__data_serializer.dumps_batch_request( requests )
+        resp_str, data_source = self.__transport.sendrecv( req_str )
+        assert data_source is None
+        responses = self.__data_serializer.loads_batch_response( resp_str )
+        results = []
+        for methodname, args, id in requests:
+            if id not in responses:
+                raise RPCInvalidRPC("Invalid Response, no response with id %s" % id)
+            result, error = responses[id]
+            if error:
+                raise error
+            results.append(result)
+        return results
+
     def __getattr__(self, name):
         # magic method dispatcher
         #  note: to call a remote object with an non-standard name, use
@@ -702,6 +1368,11 @@ class Server:
             f.close()
 
         self.funcs = {}
+        self.factories = []
+        self.shared_funcs = None
+        # The shared instances are not thread safe
+        self.shared_lock = threading.Lock()
+        self.lock = threading.Lock()
 
     def __repr__(self):
         return "<Server for %s, with serializer %s>" % (self.__transport, self.__data_serializer)
@@ -733,6 +1404,55 @@ class Server:
                     self.register_function( getattr(myinst, e) )
                 else:
                     self.register_function( getattr(myinst, e), name="%s.%s" % (name, e) )
+
+    def register_factory(self, factory, name, has_state = None):
+        """Add all functions of class-instances created by the given
+        factory to the RPC-services, as "name.function".
+
+        Every keep-alive connection gets an instance of its own, so
+        that clients do not share any state. Connections that only
+        carry a single request (which is all that old clients can
+        handle) must be able to use the state created by earlier
+        requests, and therefore share a common instance, which only
+        handles one request at a time.
+
+        :Parameters:
+            - factory: function that returns a new class-instance
+            - name:    hierarchical prefix
+            - has_state: function that is given an instance and
+              returns True while the instance holds state that would
+              be lost with its connection. Such a connection is not
+              closed by the server for being idle.
+        """
+        self.factories.append((factory, name, has_state))
+
+    def __create_funcs(self):
+        """Returns the available functions, and a list of functions
+        that tell if any of the created instances hold state."""
+        funcs = dict(self.funcs)
+        state_checks = []
+        for factory, name, has_state in self.factories:
+            myinst = factory()
+            for e in dir(myinst):
+                if e[0][0] != "_":
+                    funcs["%s.%s" % (name, e)] = getattr(myinst, e)
+            if has_state is not None:
+                state_checks.append(lambda has_state = has_state, myinst = myinst: has_state(myinst))
+        return funcs, state_checks
+
+    def get_handler(self, persistent):
+        """Returns a ConnectionHandler for the requests of one
+        connection."""
+        if persistent:
+            funcs, state_checks = self.__create_funcs()
+            return ConnectionHandler(self, funcs, state_checks)
+        with self.lock:
+            if self.shared_funcs is None:
+                self.shared_funcs = self.__create_funcs()[0]
+            funcs = self.shared_funcs
+        # The state is shared, not tied to the connection
+        return ConnectionHandler(self, funcs, [], self.shared_lock)
+
     def register_function(self, function, name=None):
         """Add a function to the RPC-services.
         
@@ -746,17 +1466,48 @@ class Server:
         else:
             self.funcs[name] = function
     
-    def handle(self, rpcstr):
+    def handle(self, rpcstr, funcs=None, payload=None):
         """Handle a RPC-Request.
 
         :Parameters:
             - rpcstr: the received rpc-string
+            - funcs: the available functions, if not the ones
+              registered with register_function()/register_instance()
+            - payload: a DataSource with the binary payload of the
+              request, if any. It is passed on as the last positional
+              parameter.
         :Returns: the data to send back or None if nothing should be sent back
         :Raises:  RPCFault (and maybe others)
         """
+        try:
+            data = self.__data_serializer.loads( rpcstr )
+        except ValueError, err:
+            return self.__data_serializer.dumps_error( RPCParseError("No valid JSON. (%s)" % str(err)), id=None )
+        if funcs is None:
+            funcs = self.funcs
+        if not isinstance(data, list):
+            return self.__handle_request( data, funcs, payload )
+        # A batch of requests
+        if not data:
+            return self.__data_serializer.dumps_error( RPCInvalidRPC("Empty batch"), id=None )
+        if payload is not None:
+            return self.__data_serializer.dumps_error( RPCInvalidRPC("Binary payloads can not be batched"), id=None )
+        responses = []
+        for item in data:
+            response = self.__handle_request( item, funcs, None )
+            if isinstance(response, DataSource):
+                response = self.__data_serializer.dumps_error( RPCInvalidRPC("Binary results can not be batched"), item["id"] )
+            responses.append( response )
+        return "[%s]" % ", ".join(responses)
+
+    def __handle_request(self, data, funcs, payload):
+        """Handle one de-serialized request.
+
+        :See: handle
+        """
         #TODO: id
         try:
-            req = self.__data_serializer.loads_request( rpcstr )
+            req = self.__data_serializer.parse_request( data )
             if len(req) == 2:
                 raise RPCFault("JsonRPC notifications not supported")
             method, params, id = req
@@ -766,19 +1517,23 @@ class Server:
             self.log( "%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)) )
             return self.__data_serializer.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id=None )
 
-        if method not in self.funcs:
+        if method not in funcs:
             return self.__data_serializer.dumps_error( RPCFault(METHOD_NOT_FOUND, ERROR_MESSAGE[METHOD_NOT_FOUND]), id )
+        if payload is not None:
+            if isinstance(params, dict):
+                return self.__data_serializer.dumps_error( RPCInvalidMethodParams("A binary payload requires positional parameters"), id )
+            params = list(params) + [payload]
 
         try:
             if isinstance(params, dict):
-                result = self.funcs[method]( **params )
+                result = funcs[method]( **params )
             else:
-                result = self.funcs[method]( *params )
+                result = funcs[method]( *params )
             if isinstance(result, DataSource):
                 return result
 
         except RPCFault, err:
-            return self.__data_serializer.dumps_error( err, id=None )
+            return self.__data_serializer.dumps_error( err, id )
         except Exception, err:
             print( "%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)) )
             return self.__data_serializer.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id )
@@ -789,12 +1544,36 @@ class Server:
             self.log( "%d (%s): %s" % (INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR], str(err)) )
             return self.__data_serializer.dumps_error( RPCFault(INTERNAL_ERROR, ERROR_MESSAGE[INTERNAL_ERROR]), id )
 
-    def serve(self, n=None):
+    def serve(self, n=None, workers=None):
         """serve (forever or for n communicaions).
         
         :See: Transport
         """
-        self.__transport.serve( self.handle, n )
+        self.__transport.serve( self.get_handler, n, workers )
+
+class ConnectionHandler:
+    """Handles the requests of one connection with the given
+    functions. has_state() tells if the functions hold state that would
+    be lost with the connection. If a lock is given, it is held while
+    a request is handled, as the functions are shared with other
+    connections."""
+    def __init__(self, server, funcs, state_checks, lock = None):
+        self.server = server
+        self.funcs = funcs
+        self.state_checks = state_checks
+        self.lock = lock
+
+    def __call__(self, rpcstr, payload = None):
+        if self.lock is None:
+            return self.server.handle(rpcstr, self.funcs, payload)
+        with self.lock:
+            return self.server.handle(rpcstr, self.funcs, payload)
+
+    def has_state(self):
+        for check in self.state_checks:
+            if check():
+                return True
+        return False
 
 #=========================================
 
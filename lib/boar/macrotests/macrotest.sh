@@ -35,7 +35,7 @@ $BOAR >/dev/null && { echo "No subcommand should cause an exit error code"; exit
 $BOAR nonexisting_cmd >/dev/null && { echo "Non-existing subcommand should cause an exit error code"; exit 1; }
 
 echo --- Test --help flag
-for subcmd in ci clone co diffrepo getprop info import list locate mkrepo mksession setprop status update verify; do
+for subcmd in ci clone co diffrepo getprop info import list locate mkmanifests mkrepo mksession reindex setprop status update verify watch; do
     echo Testing $subcmd --help
     ( REPO_PATH="" $BOAR $subcmd --help | grep "Usage:" >/dev/null ) || \
 	{ echo "Subcommand '$subcmd' did not give a help message with --help flag"; exit 1; }
@@ -178,6 +178,14 @@ echo "Some new content" >test_tree/new_file.txt
 echo --- Test verify
 REPO_PATH=$REPO $BOAR verify || { echo "Couldn't verify repo"; exit 1; }
 
+echo --- Test reindex
+REPO_PATH=$REPO $BOAR reindex || { echo "Couldn't rebuild blob index"; exit 1; }
+REPO_PATH=$REPO $BOAR verify || { echo "Couldn't verify repo after reindex"; exit 1; }
+
+echo --- Test mkmanifests
+REPO_PATH=$REPO $BOAR mkmanifests -i 2 || { echo "Couldn't create manifests"; exit 1; }
+REPO_PATH=$REPO $BOAR verify -q || { echo "Couldn't verify repo with manifests"; exit 1; }
+
 echo --- Test repo cloning
 $BOAR clone $REPO $CLONE || { echo "Couldn't clone repo"; exit 1; }
 $BOAR diffrepo $REPO $CLONE || { echo "Some differences where found in cloned repo"; exit 1; }
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Measures how fast the cuts of a large file are found, compared to
+how fast the file can be checksummed. Usage: chunker.py [size in MB] """
+
+from __future__ import with_statement
+import sys
+import os
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "blobrepo"))
+
+import chunker
+from common import md5sum_file
+
+# The pure python scan is slow, so it only reads the start of the file
+PYTHON_SCAN_SIZE = 8 * 2**20
+
+class LimitedFile:
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+
+    def seek(self, pos):
+        self.f.seek(pos)
+
+    def tell(self):
+        return self.f.tell()
+
+    def read(self, n):
+        return self.f.read(max(0, min(n, self.size - self.f.tell())))
+
+def measure(name, size, function):
+    t0 = time.time()
+    result = function()
+    elapsed = max(time.time() - t0, 0.001)
+    print "%-20s %8.1f MB/s" % (name, size / 2.0**20 / elapsed)
+    return result
+
+def main():
+    size = 256 * 2**20
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1]) * 2**20
+    fd, path = tempfile.mkstemp(prefix = "chunker_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for n in range(0, size, 2**20):
+                f.write(os.urandom(2**20))
+        cdc = chunker.Chunker()
+        measure("md5sum_file", size, lambda: md5sum_file(path))
+        with open(path, "rb") as f:
+            if chunker.numpy:
+                cuts = measure("cut_positions", size, lambda: cdc.cut_positions(f))
+                print "%s chunks, %.2f MB on average" % (len(cuts) + 1, size / 2.0**20 / (len(cuts) + 1))
+            else:
+                print "cut_positions        numpy is not installed"
+            limited = LimitedFile(f, min(size, PYTHON_SCAN_SIZE))
+            measure("cut_positions (py)", limited.size,
+                    lambda: cdc.cut_positions(limited, use_numpy = False))
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Measures how fast a blob consisting of many small recipe pieces
+can be read. Usage: recipereader.py [number of pieces] [piece size] """
+
+from __future__ import with_statement
+import sys
+import os
+import time
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blobrepo.blobreader import create_blob_reader
+from common import md5sum
+
+SOURCE_COUNT = 10
+SOURCE_SIZE = 2**20
+
+class FakeRepo:
+    def __init__(self, path):
+        self.path = path
+
+    def get_blob_path(self, sum):
+        return os.path.join(self.path, sum)
+
+    def get_raw_blob_location(self, sum):
+        return self.get_blob_path(sum), 0
+
+    def get_compressed_blob_path(self, sum):
+        return None
+
+def create_recipe(repo, piece_count, piece_size):
+    sources = []
+    for n in range(0, SOURCE_COUNT):
+        name = md5sum(str(n))
+        with open(repo.get_blob_path(name), "wb") as f:
+            f.write(os.urandom(SOURCE_SIZE))
+        sources.append(name)
+    pieces = []
+    for n in range(0, piece_count):
+        pieces.append({"source": random.choice(sources),
+                       "offset": random.randrange(0, SOURCE_SIZE - piece_size),
+                       "size": piece_size})
+    return {"method": "concat",
+            "md5sum": md5sum(""), # Not verified by the reader
+            "size": piece_count * piece_size,
+            "pieces": pieces}
+
+def main():
+    piece_count = 100000
+    piece_size = 100
+    if len(sys.argv) > 1:
+        piece_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        piece_size = int(sys.argv[2])
+    path = tempfile.mkdtemp(prefix = "recipereader_")
+    try:
+        repo = FakeRepo(path)
+        recipe = create_recipe(repo, piece_count, piece_size)
+        t0 = time.time()
+        reader = create_blob_reader(recipe, repo)
+        bytes_read = 0
+        while True:
+            data = reader.read(2**16)
+            if not data:
+                break
+            bytes_read += len(data)
+        reader.close()
+        elapsed = time.time() - t0
+        assert bytes_read == recipe['size']
+        print "Sequential read of %s pieces (%.1f MB) in %.2f seconds (%.1f MB/s)" % \
+            (piece_count, bytes_read / 2.0**20, elapsed, bytes_read / 2.0**20 / elapsed)
+        reader = create_blob_reader(recipe, repo)
+        t0 = time.time()
+        for n in range(0, 10000):
+            reader.read(1000, random.randrange(0, recipe['size']))
+        reader.close()
+        print "10000 random reads in %.2f seconds" % (time.time() - t0)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    main()
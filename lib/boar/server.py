@@ -20,24 +20,31 @@ import jsonrpc
 import os, time, threading
 import front
 
+# The number of clients that are served concurrently
+DEFAULT_WORKERS = 8
+
 class BoarServer:
-    def __init__(self, repopath, port = 50000):
+    def __init__(self, repopath, port = 50000, workers = DEFAULT_WORKERS):
         self.server = jsonrpc.Server(jsonrpc.JsonRpc20(), 
                                      jsonrpc.TransportTcpIp(timeout=60.0, 
                                                             addr=("0.0.0.0", port)))
+        self.workers = workers
         repo = repository.Repo(repopath)
-        fr = front.Front(repo)
-        self.server.register_instance(fr, "front")
+        # Every client gets a front of its own, so that they can
+        # create snapshots concurrently. The connection of a client
+        # that is creating a snapshot must be kept open.
+        self.server.register_factory(lambda: front.Front(repo), "front",
+                                     has_state = lambda f: f.new_session is not None)
 
     def serve(self):
-        self.server.serve()
+        self.server.serve(workers = self.workers)
 
 class ThreadedBoarServer(BoarServer):
-    def __init__(self, repopath, port = 50000):
-        BoarServer.__init__(self, repopath, port)
+    def __init__(self, repopath, port = 50000, workers = DEFAULT_WORKERS):
+        BoarServer.__init__(self, repopath, port, workers)
 
     def serve(self):
-        self.serverThread = threading.Thread(target = self.server.serve)
+        self.serverThread = threading.Thread(target = BoarServer.serve, args = [self])
         self.serverThread.setDaemon(True)
         self.serverThread.start()
 
@@ -46,7 +53,11 @@ def main():
     if repopath == None:
         print "You need to set REPO_PATH"
         return
-    server = BoarServer(repopath)
+    workers = int(os.getenv("BOAR_SERVER_WORKERS", DEFAULT_WORKERS))
+    if workers < 1:
+        print "BOAR_SERVER_WORKERS must be at least 1"
+        return
+    server = BoarServer(repopath, workers = workers)
     print "Serving"
     pid = server.serve()
 
@@ -0,0 +1,150 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+The stat cache remembers the md5sum of every file in a workdir
+together with the stat information (inode, device, size, mtime and
+ctime) the file had when it was checksummed. As long as the stat
+information is unchanged, the file is assumed to be unchanged and
+does not need to be read again.
+
+A file that is modified within the timestamp resolution of the file
+system after being checksummed would not be detected. To avoid that,
+files that were modified very recently when they were checksummed
+(they are "racy") are never cached. Only a few files are affected
+by this in practice, namely the ones that were written just before
+the workdir was scanned.
+"""
+
+import os
+import time
+import cPickle
+import tempfile
+
+from common import replace_file
+
+STATCACHE_VERSION = 1
+
+# Files modified less than this number of seconds before they were
+# checksummed are not cached.
+RACY_SECONDS = 2
+
+def stat_key(st):
+    """Returns the tuple of stat values that must be unchanged for a
+    cached checksum to be valid."""
+    return (st.st_ino, st.st_dev, st.st_size,
+            int(st.st_mtime * 1000000000), int(st.st_ctime * 1000000000))
+
+def rename_key(key):
+    """Renaming a file changes its ctime on most systems, so a renamed
+    file is recognized by the remaining values only."""
+    return key[:4]
+
+class StatCache:
+    def __init__(self, path = None):
+        """Creates a stat cache that is persisted at the given path. If
+        no path is given, the cache only lives in memory."""
+        self.path = path
+        # { relative_path: (ino, dev, size, mtime_ns, ctime_ns, md5sum), ... }
+        self.entries = {}
+        self.renames = None
+        self.dirty = False
+        if self.path and os.path.exists(self.path):
+            self.__load()
+
+    def __load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = cPickle.load(f)
+        except Exception:
+            return # Unreadable cache - start over
+        if type(data) != dict or data.get("version") != STATCACHE_VERSION:
+            return
+        self.entries = data['entries']
+
+    def lookup(self, relative_path, st):
+        """Returns the cached md5sum of the given file, which must have
+        the given stat result, or None if the file needs to be
+        checksummed."""
+        key = stat_key(st)
+        entry = self.entries.get(relative_path, None)
+        if entry and entry[:5] == key:
+            return entry[5]
+        if entry:
+            # The file has been changed, perhaps with its size and
+            # mtime restored. Only the ctime tells.
+            return None
+        # Maybe the file has been renamed
+        if self.renames == None:
+            self.renames = {}
+            for path, entry in self.entries.iteritems():
+                self.renames[rename_key(entry)] = path
+        other_path = self.renames.get(rename_key(key), None)
+        if other_path != relative_path and other_path in self.entries and \
+                rename_key(self.entries[other_path]) == rename_key(key):
+            return self.entries[other_path][5]
+        return None
+
+    def get(self, relative_path):
+        """Returns the cached md5sum of the given file without checking
+        that the file is unchanged, or None if there is no entry for
+        it. Only to be used if it is known by other means that the
+        file has not been changed."""
+        entry = self.entries.get(relative_path, None)
+        if entry:
+            return entry[5]
+        return None
+
+    def record(self, relative_path, st, md5sum, now = None):
+        """Stores the md5sum of the given file, that had the given stat
+        result when it was checksummed."""
+        if now == None:
+            now = time.time()
+        if now - st.st_mtime < RACY_SECONDS:
+            self.forget(relative_path)
+            return
+        entry = stat_key(st) + (md5sum,)
+        if self.entries.get(relative_path, None) != entry:
+            self.entries[relative_path] = entry
+            if self.renames != None:
+                self.renames[rename_key(entry)] = relative_path
+            self.dirty = True
+
+    def forget(self, relative_path):
+        if relative_path in self.entries:
+            del self.entries[relative_path]
+            self.dirty = True
+
+    def compact(self, existing_paths):
+        """Removes all entries for files that are not among the given
+        paths. Returns the number of removed entries."""
+        existing_paths = set(existing_paths)
+        obsolete = [p for p in self.entries.iterkeys() if p not in existing_paths]
+        for relative_path in obsolete:
+            self.forget(relative_path)
+        return len(obsolete)
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(self.path), prefix = "statcache_")
+        with os.fdopen(fd, "wb") as f:
+            cPickle.dump({'version': STATCACHE_VERSION,
+                          'entries': self.entries}, f, cPickle.HIGHEST_PROTOCOL)
+        replace_file(tmp_path, self.path)
+        self.dirty = False
@@ -16,9 +16,10 @@
 
 
 from __future__ import with_statement
-import sys, os, unittest, tempfile, shutil
+import sys, os, unittest, tempfile, shutil, time
 from copy import copy
 import socket, errno
+import threading
 
 DATA1 = "tjosan"
 DATA1_MD5 = "5558e0551622725a5fa380caffa94c5d"
@@ -37,10 +38,16 @@ if __name__ == '__main__':
 
 import workdir
 from blobrepo import repository
-from common import get_tree, my_relpath, convert_win_path_to_unix
+from common import get_tree, my_relpath, convert_win_path_to_unix, md5sum, md5sum_files
 from boar_exceptions import UserError
 import server
-from front import Front
+import client
+import jsonrpc
+from front import Front, add_file_simple, get_file_contents
+from statcache import StatCache, STATCACHE_VERSION
+import watcher
+import fastcopy
+import dedup
 
 class DevNull:
     def write(self, s):
@@ -157,10 +164,103 @@ class TestFront(unittest.TestCase, WorkdirHelper):
         self.assertRaises(AssertionError, self.front.set_session_ignore_list, 
                           "TestSession", None) # None not allowed
 
+    def testDedupReport(self):
+        shared_start, shared_end = os.urandom(10000), os.urandom(8000)
+        tree = {'a.bin': shared_start + os.urandom(2500),
+                'b.bin': shared_start + os.urandom(3100),
+                'c.bin': os.urandom(1500) + shared_end,
+                'd.bin': os.urandom(700) + shared_end,
+                'e.bin': os.urandom(6000),
+                'small.txt': shared_start[:3000]}
+        write_tree(self.workdir, tree, create_root = False)
+        self.wd.checkin()
+        report = dedup.find_shared_data(self.front.repo, min_shared = 4000, block_size = 1000)
+        sums = dict([(name, md5sum(data)) for name, data in tree.items()])
+        self.assertEquals(report.blob_count, 5)
+        self.assertEquals([(kind, length, set([blob1, blob2])) for kind, length, blob1, blob2 in report.shared],
+                          [("prefix", 10000, set([sums['a.bin'], sums['b.bin']])),
+                           ("suffix", 8000, set([sums['c.bin'], sums['d.bin']]))])
+        self.assertEquals(report.cuts, {sums['a.bin']: [10000],
+                                        sums['b.bin']: [10000],
+                                        sums['c.bin']: [1500],
+                                        sums['d.bin']: [700]})
+        self.assertEquals(report.savings, 18000)
+
     def tearDown(self):
         for d in self.remove_at_teardown:
             shutil.rmtree(d, ignore_errors = True)
 
+class TestStatCache(unittest.TestCase, WorkdirHelper):
+    def setUp(self):
+        self.remove_at_teardown = []
+        self.workdir = self.createTmpName()
+        os.mkdir(self.workdir)
+        self.cache_path = os.path.join(self.workdir, "statcache.bin")
+
+    def tearDown(self):
+        for d in self.remove_at_teardown:
+            shutil.rmtree(d, ignore_errors = True)
+
+    def testLookup(self):
+        self.addWorkdirFile("a.txt", DATA1)
+        st = os.stat(os.path.join(self.workdir, "a.txt"))
+        cache = StatCache(self.cache_path)
+        self.assertEqual(cache.lookup("a.txt", st), None)
+        cache.record("a.txt", st, DATA1_MD5, now = st.st_mtime + 10)
+        self.assertEqual(cache.lookup("a.txt", st), DATA1_MD5)
+        cache.save()
+        self.assertEqual(StatCache(self.cache_path).lookup("a.txt", st), DATA1_MD5)
+        self.addWorkdirFile("a.txt", DATA2)
+        st2 = os.stat(os.path.join(self.workdir, "a.txt"))
+        self.assertEqual(StatCache(self.cache_path).lookup("a.txt", st2), None)
+
+    def testRename(self):
+        self.addWorkdirFile("a.txt", DATA1)
+        st = os.stat(os.path.join(self.workdir, "a.txt"))
+        cache = StatCache(self.cache_path)
+        cache.record("a.txt", st, DATA1_MD5, now = st.st_mtime + 10)
+        os.rename(os.path.join(self.workdir, "a.txt"), os.path.join(self.workdir, "b.txt"))
+        st = os.stat(os.path.join(self.workdir, "b.txt"))
+        self.assertEqual(cache.lookup("b.txt", st), DATA1_MD5)
+
+    def testRewriteWithRestoredMtime(self):
+        """A file rewritten in place with the same size and its mtime
+        restored (as by "cp -p" or "touch -r") must not be cached."""
+        self.addWorkdirFile("a.txt", "aaaa")
+        path = os.path.join(self.workdir, "a.txt")
+        os.utime(path, (1000000000, 1000000000))
+        st = os.stat(path)
+        cache = StatCache(self.cache_path)
+        cache.record("a.txt", st, md5sum("aaaa"))
+        time.sleep(0.01)
+        with open(path, "r+b") as f:
+            f.write("bbbb")
+        os.utime(path, (1000000000, 1000000000))
+        st2 = os.stat(path)
+        self.assertEqual((st2.st_ino, st2.st_size, st2.st_mtime), (st.st_ino, st.st_size, st.st_mtime))
+        self.assertEqual(cache.lookup("a.txt", st2), None)
+
+    def testRacyEntriesNotCached(self):
+        self.addWorkdirFile("a.txt", DATA1)
+        st = os.stat(os.path.join(self.workdir, "a.txt"))
+        cache = StatCache(self.cache_path)
+        cache.record("a.txt", st, DATA1_MD5, now = st.st_mtime)
+        self.assertEqual(cache.lookup("a.txt", st), None)
+
+    def testCompactAndVersion(self):
+        self.addWorkdirFile("a.txt", DATA1)
+        st = os.stat(os.path.join(self.workdir, "a.txt"))
+        cache = StatCache(self.cache_path)
+        cache.record("a.txt", st, DATA1_MD5, now = st.st_mtime + 10)
+        cache.record("b.txt", st, DATA1_MD5, now = st.st_mtime + 10)
+        self.assertEqual(cache.compact(["a.txt"]), 1)
+        self.assertEqual(cache.entries.keys(), ["a.txt"])
+        cache.save()
+        import cPickle
+        with open(self.cache_path, "wb") as f:
+            cPickle.dump({'version': STATCACHE_VERSION + 1, 'entries': cache.entries}, f)
+        self.assertEqual(StatCache(self.cache_path).entries, {})
+
 class TestWorkdir(unittest.TestCase, WorkdirHelper):
     def setUp(self):
         self.remove_at_teardown = []
@@ -192,6 +292,48 @@ class TestWorkdir(unittest.TestCase, WorkdirHelper):
         changes = self.wd.get_changes()
         self.assertEqual(changes, ((), (), (), (), ()))
 
+    def testCheckInFile(self):
+        self.addWorkdirFile("a.txt", DATA1)
+        front = self.wd.get_front()
+        front.create_session("TestSession", front.find_last_revision("TestSession"))
+        abspath = os.path.join(unicode(self.workdir), u"a.txt")
+        try:
+            workdir.check_in_file(front, abspath, u"a.txt", DATA2_MD5)
+            self.fail("Expected an error")
+        except AssertionError, e:
+            assert "File changed during checkin process" in str(e)
+        self.assertEquals(workdir.check_in_file(front, abspath, u"a.txt", DATA1_MD5), len(DATA1))
+        front.commit({'name': "TestSession"})
+        self.assertEquals(get_file_contents(front, "TestSession", "a.txt"), DATA1)
+
+    def testResumeFetch(self):
+        self.addWorkdirFile("a.txt", DATA2)
+        self.wd.checkin()
+        front = self.wd.get_front()
+        offsets = []
+        class RecordingFront:
+            def __getattr__(self, name):
+                return getattr(front, name)
+            def get_blob(self, sum, offset = 0):
+                offsets.append(offset)
+                return front.get_blob(sum, offset)
+        partial_dir = self.createTmpName()
+        os.mkdir(partial_dir)
+        partial_path = os.path.join(partial_dir, DATA2_MD5 + ".partial")
+        target = os.path.join(self.workdir, "a.txt")
+        # A correct partial download is resumed
+        with open(partial_path, "wb") as f:
+            f.write(DATA2[:5])
+        workdir.fetch_blob(RecordingFront(), DATA2_MD5, target, overwrite = True, partial_dir = partial_dir)
+        self.assertContents(target, DATA2)
+        self.assertFalse(os.path.exists(partial_path))
+        # A partial download with the wrong contents is restarted
+        with open(partial_path, "wb") as f:
+            f.write("tjosab hejsan and some more")
+        workdir.fetch_blob(RecordingFront(), DATA2_MD5, target, overwrite = True, partial_dir = partial_dir)
+        self.assertContents(target, DATA2)
+        self.assertEquals(offsets, [5, 0])
+
     def testGetChangesUnversionedFile(self):
         # Test unversioned file
         self.addWorkdirFile("tjosan.txt", "tjosanhejsan")
@@ -234,6 +376,123 @@ class TestWorkdir(unittest.TestCase, WorkdirHelper):
         # Order doesnt matter below really, so this is fragile
         self.assertEqual(changes, (tuple(["subdir/tjosan2.txt", "subdir/tjosan1.txt"]), (), (), (), ()))
 
+    def testQuickModificationDetected(self):
+        """ A modification that does not change the size and is made
+        immediately after a commit must still be detected. """
+        self.addWorkdirFile("tjosan.txt", "tjosanhejsan")
+        self.wd.checkin()
+        self.addWorkdirFile("tjosan.txt", "TJOSANHEJSAN")
+        changes = self.wd.get_changes()
+        self.assertEqual(changes, ((), (), ("tjosan.txt",), (), ()))
+
+    def testWatchJournal(self):
+        if not sys.platform.startswith("linux"):
+            return # inotify is only available on linux
+        self.addWorkdirFile("a.txt", "a")
+        self.addWorkdirFile("b.txt", "b")
+        self.addWorkdirFile("d.txt", "d")
+        # Old enough for its checksum to be cached
+        os.utime(os.path.join(self.workdir, "d.txt"), (1000000000, 1000000000))
+        self.wd.checkin()
+        w = watcher.Watcher(self.workdir)
+        w.start()
+        stopping = []
+        def watch():
+            while not stopping:
+                # A slow watcher, that records changes some time after
+                # they were made
+                time.sleep(0.05)
+                w.process_events()
+        t = threading.Thread(target = watch)
+        t.start()
+        cookie_dir = watcher.get_cookie_dir(self.workdir)
+        try:
+            self.assertEqual(sorted(self.wd.get_changes()[0]), ["a.txt", "b.txt", "d.txt"])
+            journal_path = watcher.get_journal_path(self.workdir)
+            token, offset = watcher.get_journal_position(journal_path)
+            self.addWorkdirFile("a.txt", "modified")
+            self.rmWorkdirFile("b.txt")
+            self.mkdir("sub")
+            self.addWorkdirFile("sub/c.txt", "c")
+            self.assertTrue(watcher.sync_journal(self.workdir))
+            # The new file may or may not be reported on its own,
+            # depending on when the watch on its directory was added
+            self.assertEqual(watcher.read_journal(journal_path, token, offset)[2] - set(["sub/c.txt"]),
+                             set(["a.txt", "b.txt", "sub"]))
+            unchanged_files, new_files, modified_files, deleted_files, ignored_files = self.wd.get_changes()
+            self.assertEqual((unchanged_files, new_files, modified_files, deleted_files),
+                             (("d.txt",), ("sub/c.txt",), ("a.txt",), ("b.txt",)))
+            # A change made just before the changes are requested
+            self.addWorkdirFile("d.txt", "modified d")
+            self.assertEqual(sorted(self.wd.get_changes()[2]), ["a.txt", "d.txt"])
+            self.assertEqual(os.listdir(cookie_dir), [])
+        finally:
+            stopping.append(True)
+            open(os.path.join(cookie_dir, "stop"), "wb").close()
+            t.join()
+            w.stop()
+        self.assertEqual(watcher.get_journal_position(journal_path), None)
+        self.assertEqual(self.wd.get_changes()[1], ("sub/c.txt",))
+
+    def testWatchInterruptedChecksums(self):
+        if not sys.platform.startswith("linux"):
+            return # inotify is only available on linux
+        self.addWorkdirFile("d.txt", "d")
+        os.utime(os.path.join(self.workdir, "d.txt"), (1000000000, 1000000000))
+        self.wd.checkin()
+        # Modified while no watcher is running
+        self.addWorkdirFile("d.txt", "modified d")
+        os.utime(os.path.join(self.workdir, "d.txt"), (1000000100, 1000000100))
+        w = watcher.Watcher(self.workdir)
+        w.start()
+        stopping = []
+        def watch():
+            while not stopping:
+                time.sleep(0.05)
+                w.process_events()
+        t = threading.Thread(target = watch)
+        t.start()
+        cookie_dir = watcher.get_cookie_dir(self.workdir)
+        def interrupted_md5sum_files(paths, jobs = 1):
+            raise KeyboardInterrupt()
+        try:
+            workdir.md5sum_files = interrupted_md5sum_files
+            try:
+                self.assertRaises(KeyboardInterrupt, self.wd.get_changes)
+            finally:
+                workdir.md5sum_files = md5sum_files
+            self.assertEqual(self.wd.get_changes()[2], ("d.txt",))
+        finally:
+            stopping.append(True)
+            open(os.path.join(cookie_dir, "stop"), "wb").close()
+            t.join()
+            w.stop()
+
+    def testSessionFileCounts(self):
+        self.addWorkdirFile("a.txt", "a")
+        self.addWorkdirFile("b.txt", "b")
+        id1 = self.wd.checkin()
+        self.rmWorkdirFile("b.txt")
+        id2 = self.wd.checkin()
+        front = self.wd.get_front()
+        self.assertEqual(front.get_session_file_counts([id2, id1]), [1, 2])
+        self.assertEqual(front.get_session_file_counts([]), [])
+
+    def testParallelChecksums(self):
+        self.mkdir("subdir")
+        for n in range(0, 20):
+            self.addWorkdirFile("subdir/file%s.txt" % n, "content %s" % (n % 3))
+        self.wd.set_jobs(4)
+        self.wd.checkin()
+        self.addWorkdirFile("subdir/file20.txt", "new content")
+        self.wd.checkin()
+        unchanged_files, new_files, modified_files, deleted_files, ignored_files = self.wd.get_changes()
+        self.assertEqual(len(unchanged_files), 21)
+        self.assertEqual(self.wd.cached_md5sum("subdir/file4.txt"), md5sum("content 1"))
+        self.assertRaises(UserError, self.wd.set_jobs, 0)
+        missing_file = os.path.join(self.workdir, "nosuchfile.txt")
+        self.assertRaises(IOError, list, md5sum_files([missing_file], 4))
+
     def testWriteAndReadTree(self):
         """ Really only test helper functions write_tree() and
         read_tree() themselves"""
@@ -327,6 +586,66 @@ class TestWorkdir(unittest.TestCase, WorkdirHelper):
         self.assertEquals(updated_tree, {'file2.txt': 'f2 mod1',
                                          'file3.txt': 'f3'})
 
+    def testParallelFetch(self):
+        tree = {}
+        for n in range(0, 20):
+            tree["dir%s/file%s.txt" % (n % 3, n)] = "content %s" % (n % 7)
+        wd = self.createWorkdir(self.repoUrl, tree)
+        rev1 = wd.checkin()
+        fetched = []
+        original_fetch_blob = workdir.fetch_blob
+        def recording_fetch_blob(front, blobname, *args, **kwargs):
+            fetched.append(blobname)
+            return original_fetch_blob(front, blobname, *args, **kwargs)
+        workdir.fetch_blob = recording_fetch_blob
+        try:
+            wd = self.createWorkdir(self.repoUrl)
+            wd.set_jobs(4)
+            wd.checkout()
+            self.assertEquals(read_tree(wd.root, skiplist = boar_dirs), tree)
+            if not isinstance(wd.get_front(), Front):
+                # Local blobs are copied from the repository every time
+                self.assertEquals(sorted(fetched), sorted(set(md5sum(c) for c in tree.values())))
+            tree2 = dict((fn, c + " v2") for fn, c in tree.items())
+            rev2 = self.createWorkdir(self.repoUrl, tree2).checkin()
+            wd.update(log = DevNull())
+            self.assertEquals(read_tree(wd.root, skiplist = boar_dirs), tree2)
+        finally:
+            workdir.fetch_blob = original_fetch_blob
+
+    def testHardlinkCheckout(self):
+        # Large enough not to be packed
+        fc1, fc2 = "fc1" * 2000, "fc2" * 2000
+        wd = self.createWorkdir(self.repoUrl, {'file.txt': fc1, 'small.txt': 'small'})
+        if isinstance(wd.get_front(), Front):
+            wd.get_front().repo.max_packed_blob_size = repository.MAX_PACKED_BLOB_SIZE
+        wd.checkin()
+        wd = self.createWorkdir(self.repoUrl)
+        wd.set_hardlinks(True)
+        wd.checkout()
+        path = os.path.join(wd.root, "file.txt")
+        self.assertContents(path, fc1)
+        self.assertContents(os.path.join(wd.root, "small.txt"), "small")
+        front = wd.get_front()
+        if isinstance(front, Front):
+            self.assertEquals(os.stat(path).st_ino, os.stat(front.get_raw_blob_path(md5sum(fc1))).st_ino)
+            self.assertEquals(os.stat(path).st_mode & 0222, 0)
+            self.assertEquals(front.get_raw_blob_path(md5sum("small")), None)
+        self.createWorkdir(self.repoUrl, {'file.txt': fc2}).checkin()
+        wd.update(log = DevNull())
+        self.assertContents(path, fc2)
+
+    def testFastCopy(self):
+        data = os.urandom(3 * 2**20 + 17)
+        source = self.createTmpName()
+        with open(source, "wb") as f:
+            f.write(data)
+        dest = self.createTmpName()
+        with open(dest, "wb") as f:
+            method = fastcopy.copy_file(source, f)
+        self.assert_(method in ("reflink", "copy_file_range", "sendfile", "copy"), method)
+        self.assertContents(dest, data)
+
     def testUpdateResume(self):
         """ Test the case that some parts of the workdir are already
         up to date (like after an aborted update)."""
@@ -509,6 +828,161 @@ class TestWorkdirWithServer(TestWorkdir):
         id = self.wd.get_front().mksession("TestSession")
         assert id == 1
 
+    def tearDown(self):
+        client.connection_pool.close()
+        TestWorkdir.tearDown(self)
+
+    def testOneShotClient(self):
+        """Clients that connect anew for every call must still work."""
+        proxy = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(),
+                                    jsonrpc.TransportTcpIp(addr=("localhost", self.port),
+                                                           timeout=60.0))
+        self.assertEquals(proxy.front.get_session_ids(), [1])
+        self.assertEquals(proxy.front.get_session_ids(), [1])
+
+    def testOneShotClientsSerialized(self):
+        """The instance shared by one-shot clients must only handle
+        one request at a time."""
+        class Counter:
+            def __init__(self):
+                self.active = 0
+                self.max_active = 0
+            def work(self):
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+                time.sleep(0.05)
+                self.active -= 1
+                return self.max_active
+        self.server.server.register_factory(Counter, "counter")
+        request = jsonrpc.JsonRpc20().dumps_request("counter.work", [], 1)
+        handlers = [self.server.server.get_handler(False) for n in range(0, 4)]
+        threads = [threading.Thread(target = handler, args = [request]) for handler in handlers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(jsonrpc.JsonRpc20().loads_response(handlers[0](request))[0], 1)
+
+    def testKeepAliveConnectionReused(self):
+        front = self.wd.get_front()
+        front.get_session_ids()
+        transport = client.connection_pool.get_transport("localhost", self.port)
+        s = transport.local.s
+        assert s
+        for n in range(0, 10):
+            self.assertEquals(front.get_session_ids(), [1])
+        self.assert_(transport.local.s is s)
+
+    def testBatchRequest(self):
+        proxy = client.connection_pool.get_proxy("localhost", self.port)
+        results = proxy.batch([("front.get_session_ids", []),
+                               ("front.has_blobs", [[DATA1_MD5]]),
+                               ("front.get_session_infos", [[1]])])
+        self.assertEquals(results[0], [1])
+        self.assertEquals(results[1], [False])
+        self.assertEquals(results[2], [self.wd.get_front().get_session_info(1)])
+        self.assertRaises(jsonrpc.RPCMethodNotFound, proxy.batch,
+                          [("front.get_session_ids", []), ("front.no_such_method", [])])
+        self.assertEquals(proxy.batch([]), [])
+
+    def testCompressedTransfer(self):
+        """Compressible data must be compressed in both directions, and
+        incompressible data must survive the round trip as well."""
+        compressible = "boar " * 100000
+        incompressible = os.urandom(300000)
+        self.addWorkdirFile("text.txt", compressible)
+        self.addWorkdirFile("random.bin", incompressible)
+        payload_before, wire_before = client.connection_pool.get_stats()
+        self.wd.checkin()
+        wd2_path = self.createTmpName()
+        os.mkdir(wd2_path)
+        wd2 = workdir.Workdir(self.repoUrl, "TestSession", "", None, wd2_path)
+        wd2.checkout()
+        self.assertContents(os.path.join(wd2.root, "text.txt"), compressible)
+        self.assertContents(os.path.join(wd2.root, "random.bin"), incompressible)
+        payload_bytes, wire_bytes = client.connection_pool.get_stats()
+        payload_bytes -= payload_before
+        wire_bytes -= wire_before
+        self.assertEquals(payload_bytes, 2 * (len(compressible) + len(incompressible)))
+        self.assert_(2 * len(incompressible) < wire_bytes < payload_bytes / 2)
+
+    def testSendfileTransfer(self):
+        """Blob files must be sent by the OS when the client does not
+        accept compressed data."""
+        data = os.urandom(300000)
+        self.addWorkdirFile("random.bin", data)
+        self.wd.checkin()
+        transport = jsonrpc.KeepAliveTransportTcpIp(addr=("localhost", self.port), codecs=[],
+                                                    timeout=60.0)
+        proxy = jsonrpc.ServerProxy(jsonrpc.JsonRpc20(), transport)
+        calls = []
+        original_sendfile = fastcopy.sendfile
+        def recording_sendfile(*args, **kwargs):
+            calls.append(args)
+            return original_sendfile(*args, **kwargs)
+        fastcopy.sendfile = recording_sendfile
+        try:
+            self.assertEquals(proxy.front.get_blob(md5sum(data)).read(), data)
+            self.assertEquals(proxy.front.get_blob(md5sum(data), 1000, 10).read(), data[1000:1010])
+        finally:
+            fastcopy.sendfile = original_sendfile
+            transport.close_all()
+        self.assertEquals(len(calls), 2)
+
+    def testIdleSnapshotKept(self):
+        """A connection with a snapshot in progress must not be closed
+        for being idle, and must not be silently replaced if it is
+        lost anyway."""
+        front = self.wd.get_front()
+        transport = client.connection_pool.get_transport("localhost", self.port)
+        original_timeout = jsonrpc.KEEPALIVE_IDLE_TIMEOUT
+        jsonrpc.KEEPALIVE_IDLE_TIMEOUT = 0.2
+        try:
+            front.get_session_ids()
+            time.sleep(0.5)
+            # Idle connections without state are closed and replaced
+            self.assertEquals(front.get_session_ids(), [1])
+            front.create_session("TestSession", 1)
+            time.sleep(0.5)
+            add_file_simple(front, "file.txt", "idle")
+            self.assertEquals(front.commit({'name': "TestSession"}), 2)
+            self.assertEquals(get_file_contents(front, "TestSession", "file.txt"), "idle")
+            front.create_session("TestSession", 2)
+            transport.close_all()
+            self.assertRaises(jsonrpc.ConnectionLost, add_file_simple, front, "file.txt", "lost")
+            self.assertEquals(front.get_session_ids(), [1, 2])
+        finally:
+            jsonrpc.KEEPALIVE_IDLE_TIMEOUT = original_timeout
+
+    def testConcurrentSnapshots(self):
+        """Clients on different connections must be able to create
+        snapshots at the same time."""
+        front = self.wd.get_front()
+        front.mksession("Session1")
+        front.mksession("Session2")
+        created = {"Session1": threading.Event(), "Session2": threading.Event()}
+        errors = []
+        def create_snapshot(session_name):
+            try:
+                thread_front = client.connect(self.repoUrl)
+                thread_front.create_session(session_name, thread_front.find_last_revision(session_name))
+                add_file_simple(thread_front, "file.txt", session_name)
+                created[session_name].set()
+                for event in created.values():
+                    event.wait(10.0)
+                thread_front.commit({'name': session_name})
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target = create_snapshot, args = [name])
+                   for name in ("Session1", "Session2")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(errors, [])
+        for name in ("Session1", "Session2"):
+            self.assertEquals(get_file_contents(front, name, "file.txt"), name)
+
 class TestPartialCheckin(unittest.TestCase, WorkdirHelper):
     def setUp(self):
         self.remove_at_teardown = []
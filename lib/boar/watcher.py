@@ -0,0 +1,399 @@
+# -*- encoding: utf-8 -*-
+
+# Copyright 2010 Mats Ekberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+
+"""
+The watcher uses the Linux inotify interface to keep a journal of
+the paths in a workdir that have changed. This lets the workdir find
+its changes without scanning the whole tree.
+
+The journal file consists of json values, one per line. The first
+line is a header with the format version, the process id of the
+watcher and a token that is unique for every run of the watcher. It
+is followed by any number of records:
+
+["dirty", "some/path"]  The path (file or directory) may have changed
+["cookie", "name"]      A cookie file with the given name was created
+["overflow"]            Events were lost, the journal can not be trusted
+["stopped"]             The watcher has stopped
+
+A reader remembers the token and the offset up to which it has read
+the journal. The journal is only valid as long as the watcher that
+wrote it is running. Every time the watcher is started, a new journal
+is created with a new token.
+
+The watcher may not yet have recorded a change that was made just
+before the journal is read. A reader therefore first creates a
+uniquely named cookie file in the cookie directory of the workdir
+metadata, and waits until the watcher has recorded it. The events
+are delivered in order, so all earlier changes have been recorded by
+then. If the cookie does not show up in time, the reader has to
+perform a full scan.
+"""
+
+import os
+import sys
+import time
+import errno
+import struct
+import signal
+import binascii
+import tempfile
+import ctypes
+import ctypes.util
+
+from common import *
+from boar_exceptions import UserError
+import settings
+
+JOURNAL_FILE = "watchjournal"
+JOURNAL_VERSION = 2
+COOKIE_DIR = "watchcookies"
+
+# The number of seconds a reader waits for the watcher to record a
+# cookie before giving up and performing a full scan.
+SYNC_TIMEOUT = 2.0
+
+# The watcher starts over with a new journal when it grows larger
+# than this. Readers will then have to perform one full scan.
+JOURNAL_MAX_SIZE = 64 * 2**20
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+EVENT_HEADER_FORMAT = "iIII"
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER_FORMAT)
+
+def get_journal_path(root):
+    return os.path.join(root, settings.metadir, JOURNAL_FILE)
+
+def get_cookie_dir(root):
+    return os.path.join(root, settings.metadir, COOKIE_DIR)
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def read_journal_header(path):
+    """Returns the header of the journal at the given path, or None if
+    there is no journal written by a running watcher."""
+    try:
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+    except (IOError, ValueError):
+        return None
+    if type(header) != dict or header.get("version") != JOURNAL_VERSION:
+        return None
+    if not is_process_alive(header['pid']):
+        return None
+    return header
+
+def get_journal_position(path):
+    """Returns a (token, offset) tuple that identifies the current end
+    of the journal, or None if there is no valid journal. A reader
+    that is about to scan the tree should call this before scanning,
+    and later read the journal from the returned position."""
+    changes = read_journal(path, None, None)
+    if changes == None:
+        return None
+    token, offset, dirty_paths = changes
+    return token, offset
+
+def read_journal(path, token, offset):
+    """Returns a (token, offset, dirty_paths) tuple with all the dirty
+    paths recorded in the journal after the given position, and the
+    new position. If token is None, the journal is read from the
+    beginning. Returns None if the journal can not be used to find
+    all changes since the given position."""
+    header = read_journal_header(path)
+    if header == None:
+        return None
+    if token != None and header['token'] != token:
+        return None
+    try:
+        with open(path, "rb") as f:
+            header_line = f.readline()
+            if offset == None:
+                offset = len(header_line)
+            f.seek(offset)
+            data = f.read()
+    except IOError:
+        return None
+    # Ignore any partially written record
+    data = data[:data.rfind("\n") + 1]
+    dirty_paths = set()
+    for line in data.splitlines():
+        record = json.loads(line)
+        if record[0] == "cookie":
+            continue
+        if record[0] != "dirty":
+            # Overflow or stopped
+            return None
+        dirty_paths.add(record[1])
+    # The watcher may have stopped after writing the last record
+    if not is_process_alive(header['pid']):
+        return None
+    return header['token'], offset + len(data), dirty_paths
+
+def sync_journal(root, timeout = SYNC_TIMEOUT):
+    """Makes sure that the journal of the watcher of the given workdir
+    contains all changes made before this call. Returns False if there
+    is no running watcher, or if it did not record the cookie within
+    the timeout."""
+    journal_path = get_journal_path(root)
+    header = read_journal_header(journal_path)
+    if header == None:
+        return False
+    try:
+        # Start a bit before the end, so that a final record is seen
+        offset = max(0, os.path.getsize(journal_path) - 64)
+    except OSError:
+        return False
+    name = "%s-%s" % (os.getpid(), binascii.hexlify(os.urandom(8)))
+    cookie_path = os.path.join(get_cookie_dir(root), name)
+    try:
+        open(cookie_path, "wb").close()
+    except IOError:
+        return False # The watcher has not created the cookie directory
+    cookie_record = json.dumps(["cookie", name])
+    deadline = time.time() + timeout
+    try:
+        while True:
+            try:
+                with open(journal_path, "rb") as f:
+                    if json.loads(f.readline()).get("token") != header['token']:
+                        return False # A new journal, the reader has to start over
+                    f.seek(offset)
+                    data = f.read()
+            except (IOError, ValueError):
+                return False
+            if cookie_record in data:
+                return True
+            if json.dumps(["stopped"]) in data or json.dumps(["overflow"]) in data:
+                return False # The journal has ended
+            # Continue after the last complete record next time
+            offset += data.rfind("\n") + 1
+            if time.time() > deadline or not is_process_alive(header['pid']):
+                return False
+            time.sleep(0.005)
+    finally:
+        try:
+            os.remove(cookie_path)
+        except OSError:
+            pass
+
+class Inotify:
+    """A minimal wrapper around the inotify system calls."""
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        try:
+            self.libc = ctypes.CDLL(libc_name, use_errno = True)
+            self.libc.inotify_init
+        except (OSError, AttributeError):
+            raise UserError("Watching requires a system with inotify support (Linux)")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding()),
+                                         ctypes.c_uint32(mask))
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Could not watch " + path)
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Blocks until there are events, and returns them as a list
+        of (wd, mask, cookie, name) tuples."""
+        data = os.read(self.fd, 1024 * 1024)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = struct.unpack_from(EVENT_HEADER_FORMAT, data, pos)
+            pos += EVENT_HEADER_SIZE
+            name = data[pos:pos + length].rstrip("\0")
+            pos += length
+            events.append((wd, mask, cookie, name.decode(sys.getfilesystemencoding())))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    def __init__(self, root, log = None):
+        assert isinstance(root, unicode)
+        assert os.path.isabs(root)
+        self.root = root
+        self.journal_path = get_journal_path(root)
+        self.log = log
+        self.inotify = None
+        self.journal = None
+        self.watches = {} # { wd: relative dir path, ... }
+        self.cookie_wd = None
+
+    def run(self):
+        """Watches the workdir until interrupted."""
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        self.start()
+        try:
+            while True:
+                self.process_events()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def start(self):
+        self.inotify = Inotify()
+        cookie_dir = get_cookie_dir(self.root)
+        if not os.path.exists(cookie_dir):
+            os.mkdir(cookie_dir)
+        for name in os.listdir(cookie_dir):
+            os.remove(os.path.join(cookie_dir, name)) # Left by interrupted readers
+        self.cookie_wd = self.inotify.add_watch(cookie_dir, IN_CREATE | IN_ONLYDIR | IN_DONT_FOLLOW)
+        self.__start_journal()
+
+    def process_events(self):
+        """Waits for events and records them in the journal."""
+        self.__process(self.inotify.read_events())
+
+    def stop(self):
+        if self.journal:
+            self.__write_record(["stopped"])
+            self.journal.close()
+            self.journal = None
+        self.inotify.close()
+
+    def __start_journal(self):
+        """Creates a new journal, replacing any old one. All watches are
+        added before the journal is created, so that a reader can never
+        see a journal that misses changes."""
+        if self.journal:
+            self.__write_record(["stopped"])
+            self.journal.close()
+            self.journal = None
+        if not self.watches:
+            self.__add_watches(u"")
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(self.journal_path),
+                                        prefix = JOURNAL_FILE + "_")
+        os.write(fd, json.dumps({'version': JOURNAL_VERSION,
+                                 'pid': os.getpid(),
+                                 'token': binascii.hexlify(os.urandom(8))}) + "\n")
+        os.close(fd)
+        replace_file(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, "ab")
+        if self.log:
+            print >>self.log, "Watching %s (%s directories)" % (self.root, len(self.watches))
+
+    def __add_watches(self, relative_dir):
+        for dirpath, dirnames, filenames in os.walk(self.__abspath(relative_dir)):
+            if settings.metadir in dirnames:
+                dirnames.remove(settings.metadir)
+            relative_path = u""
+            if dirpath != self.root:
+                relative_path = convert_win_path_to_unix(my_relpath(dirpath, self.root))
+            try:
+                wd = self.inotify.add_watch(dirpath, WATCH_MASK)
+            except OSError, e:
+                if e.errno == errno.ENOSPC:
+                    raise UserError("Too many directories to watch. "+\
+                                        "Try increasing /proc/sys/fs/inotify/max_user_watches")
+                continue # Probably removed while walking
+            self.watches[wd] = relative_path
+
+    def __remove_watches(self, relative_dir):
+        prefix = relative_dir + "/"
+        for wd, path in self.watches.items():
+            if path == relative_dir or path.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def __abspath(self, relative_path):
+        if not relative_path:
+            return self.root
+        return os.path.join(self.root, relative_path)
+
+    def __process(self, events):
+        dirty = []
+        cookies = []
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.__write_record(["overflow"])
+                # Events for new directories may have been lost, so
+                # start over. Readers will have to do a full scan.
+                for old_wd in self.watches.keys():
+                    self.inotify.rm_watch(old_wd)
+                self.watches = {}
+                self.__start_journal()
+                return
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd == self.cookie_wd:
+                if mask & IN_CREATE:
+                    cookies.append(name)
+                continue
+            if wd not in self.watches:
+                continue
+            dirpath = self.watches[wd]
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue # Reported as a change in the parent directory
+            if dirpath == u"" and name == settings.metadir:
+                continue
+            path = name
+            if dirpath:
+                path = dirpath + u"/" + name
+            if mask & IN_ISDIR:
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.__remove_watches(path)
+                if mask & (IN_MOVED_TO | IN_CREATE):
+                    self.__add_watches(path)
+            dirty.append(path)
+        for path in set(dirty):
+            self.__write_record(["dirty", path])
+        # After the changes that happened before the cookies were created
+        for name in cookies:
+            self.__write_record(["cookie", name])
+        self.journal.flush()
+        if self.journal.tell() > JOURNAL_MAX_SIZE:
+            self.__start_journal()
+
+    def __write_record(self, record):
+        self.journal.write(json.dumps(record) + "\n")
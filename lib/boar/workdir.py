@@ -17,13 +17,15 @@
 from __future__ import with_statement
 
 import os
+import errno
 from front import Front, DryRunFront
-from blobrepo.sessions import bloblist_fingerprint
+from blobrepo.sessions import bloblist_fingerprint, AddException
 from blobrepo.repository import Repo
 from treecomp import TreeComparer
 from common import *
 from boar_exceptions import *
 import client
+from jsonrpc import DataSource, FileDataSource, RPCFault
 
 from base64 import b64decode, b64encode
 import settings
@@ -32,19 +34,29 @@ import hashlib
 import stat
 import copy
 import cPickle
-import anydbm
 import tempfile
+import shutil
 import fnmatch
-# shelve and dbhash are only imported as a workaround for py2exe,
-# which otherwise for some reason will forget to include a dbm implementation
-import shelve
-import dbhash
+from statcache import StatCache
+import watcher
+import fastcopy
 
 if sys.version_info >= (2, 6):
     import json
 else:
     import simplejson as json
 
+# The number of files that are handled by every bulk call to the
+# front when creating a snapshot
+BATCH_SIZE = 1000
+
+STATCACHE_FILE = "statcache.bin"
+WATCH_BASELINE_FILE = "watchbaseline.bin"
+WATCH_BASELINE_VERSION = 1
+
+# Interrupted downloads are kept here, so that they can be resumed
+PARTIAL_DIR = "partial"
+
 class FakeFile:
     def write(self, s):
         pass
@@ -65,24 +77,127 @@ class Workdir:
         if self.repoUrl:
             self.front = self.get_front()
         if os.path.exists(self.metadir):
-            self.md5cache = anydbm.open(self.metadir + "/" + 'md5sumcache', 'c')
+            self.statcache = StatCache(os.path.join(self.metadir, STATCACHE_FILE))
+            remove_old_md5cache(self.metadir)
         else:
-            self.md5cache = {}
+            self.statcache = StatCache()
         assert self.revision == None or self.revision > 0
 
         self.blobinfos = None
         self.bloblist_csums = None
         self.tree_csums = None
         self.tree = None
+        self.watch_position = None
         self.output = FakeFile()
+        self.jobs = 1
+        self.hardlinks = False
+        self.commit_stats = None
 
     def __reload_tree(self):
         self.tree = get_tree(self.root, skip = [settings.metadir], absolute_paths = False)
-        self.tree_csums == None
+        self.tree_csums = None
+
+    def __reload_tree_from_journal(self):
+        """Updates the tree using the journal written by a running
+        watcher ("boar watch"), if there is one. Returns the set of
+        files that may have changed since they were last seen, or None
+        if a full scan had to be performed. The new journal position
+        is not stored until __commit_watch_baseline() is called."""
+        self.watch_position = None
+        journal_path = watcher.get_journal_path(self.root)
+        if not os.path.exists(journal_path):
+            self.__reload_tree()
+            return None
+        baseline = self.__load_watch_baseline()
+        changes = None
+        # The watcher must have recorded every change made so far
+        if baseline and watcher.sync_journal(self.root):
+            changes = watcher.read_journal(journal_path, baseline['token'], baseline['offset'])
+        if changes == None:
+            position = watcher.get_journal_position(journal_path)
+            self.__reload_tree()
+            self.watch_position = position
+            return None
+        token, offset, dirty_paths = changes
+        tree = set(baseline['tree'])
+        tree_dirs = None
+        changed_files = set()
+        for path in dirty_paths:
+            if settings.metadir in path.split("/"):
+                continue
+            tree.discard(path)
+            if tree_dirs == None:
+                tree_dirs = set()
+                for f in tree:
+                    parts = f.split("/")
+                    for n in range(1, len(parts)):
+                        tree_dirs.add("/".join(parts[:n]))
+            if path in tree_dirs:
+                # Directory moved or deleted, forget its contents
+                prefix = path + "/"
+                tree.difference_update([f for f in tree if f.startswith(prefix)])
+            abspath = self.wd_abspath(path)
+            if os.path.isdir(abspath):
+                if not os.path.islink(abspath):
+                    for f in get_tree(abspath, skip = [settings.metadir], absolute_paths = False):
+                        changed_files.add(path + "/" + f)
+            elif os.path.lexists(abspath):
+                changed_files.add(path)
+        tree.update(changed_files)
+        self.tree = list(tree)
+        self.tree_csums = None
+        if offset != baseline['offset']:
+            self.watch_position = (token, offset)
+        return changed_files
+
+    def __commit_watch_baseline(self):
+        """Stores the journal position found by the last
+        __reload_tree_from_journal(). Must not be called until the
+        checksums of all changed files are in the saved stat cache, as
+        unchanged files are not checked again."""
+        if self.watch_position:
+            self.__save_watch_baseline(self.watch_position[0], self.watch_position[1])
+            self.watch_position = None
+
+    def __load_watch_baseline(self):
+        path = os.path.join(self.metadir, WATCH_BASELINE_FILE)
+        try:
+            with open(path, "rb") as f:
+                baseline = cPickle.load(f)
+        except Exception:
+            return None
+        if type(baseline) != dict or baseline.get('version') != WATCH_BASELINE_VERSION:
+            return None
+        return baseline
+
+    def __save_watch_baseline(self, token, offset):
+        """Stores the current tree, to be used together with the
+        journal from the given position the next time the tree is
+        needed."""
+        fd, tmp_path = tempfile.mkstemp(dir = self.metadir, prefix = "watchbaseline_")
+        with os.fdopen(fd, "wb") as f:
+            cPickle.dump({'version': WATCH_BASELINE_VERSION,
+                          'token': token,
+                          'offset': offset,
+                          'tree': self.tree}, f, cPickle.HIGHEST_PROTOCOL)
+        replace_file(tmp_path, os.path.join(self.metadir, WATCH_BASELINE_FILE))
 
     def setLogOutput(self, fout):
         self.output = fout
 
+    def set_jobs(self, jobs):
+        """Sets the number of files that may be checksummed, or
+        fetched from the repository, in parallel."""
+        if jobs < 1:
+            raise UserError("The number of jobs must be at least 1")
+        self.jobs = jobs
+
+    def set_hardlinks(self, hardlinks):
+        """If enabled, files that are fetched from a local repository
+        are hard linked to the blobs in the repository, and made read
+        only, instead of being copied."""
+        self.hardlinks = hardlinks
+
     def write_metadata(self):
         workdir_path = self.root
         metadir = self.metadir
@@ -109,12 +224,57 @@ class Workdir:
             self.revision = front.find_last_revision(self.sessionName)
         if write_meta:
             self.write_metadata()
+        fetches = []
         for info in front.get_session_bloblist(self.revision):
             if not is_child_path(self.offset, info['filename']):
                 continue
             target = strip_path_offset(self.offset, info['filename'])
-            target_path = os.path.join(self.root, target)
-            fetch_blob(front, info['md5sum'], target_path, overwrite = False)
+            fetches.append((info, os.path.join(self.root, target)))
+        for info, target_path, error in self.__fetch_blobs(front, fetches, overwrite = False):
+            if error:
+                raise error
+        self.__remove_partial_dir()
+
+    def __fetch_blobs(self, front, fetches, overwrite):
+        """Fetches the blobs for the given (blobinfo, target_path)
+        tuples, using the number of parallel jobs given by
+        set_jobs(). A blob that is needed for several files is only
+        fetched once, and then copied. Yields a (blobinfo,
+        target_path, error) tuple for every file, where error is the
+        EnvironmentError that prevented the file from being written,
+        or None."""
+        partial_dir = self.__get_partial_dir()
+        groups = {} # { md5sum: [(blobinfo, target_path), ...], ... }
+        md5sums = []
+        for blobinfo, target_path in fetches:
+            if blobinfo['md5sum'] not in groups:
+                groups[blobinfo['md5sum']] = []
+                md5sums.append(blobinfo['md5sum'])
+            groups[blobinfo['md5sum']].append((blobinfo, target_path))
+        progress = FetchProgress(self.output, len(fetches),
+                                 sum([blobinfo.get('size', 0) for blobinfo, target_path in fetches]))
+        def fetch(md5sum):
+            return fetch_blob_copies(front, md5sum, [target_path for blobinfo, target_path in groups[md5sum]],
+                                     overwrite = overwrite, partial_dir = partial_dir,
+                                     hardlink = self.hardlinks)
+        for md5sum, errors in parallel_map(fetch, md5sums, self.jobs):
+            for (blobinfo, target_path), error in zip(groups[md5sum], errors):
+                progress.file_done(blobinfo.get('size', 0))
+                yield blobinfo, target_path, error
+        progress.finish()
+
+    def __get_partial_dir(self):
+        """Returns the directory to keep interrupted downloads in, or
+        None if there is no metadata dir to keep them in."""
+        if not os.path.exists(self.metadir):
+            return None
+        partial_dir = os.path.join(self.metadir, PARTIAL_DIR)
+        if not os.path.exists(partial_dir):
+            os.mkdir(partial_dir)
+        return partial_dir
+
+    def __remove_partial_dir(self):
+        shutil.rmtree(os.path.join(self.metadir, PARTIAL_DIR), ignore_errors = True)
 
     def update(self, new_revision = None, log = None, ignore_errors = False):
         assert self.revision, "Cannot update. Current revision is unknown: '%s'" % self.revision
@@ -133,6 +293,7 @@ class Workdir:
         new_bloblist = front.get_session_bloblist(new_revision)
         new_bloblist_dict = bloblist_to_dict(new_bloblist)
         old_bloblist = self.get_bloblist()
+        fetches = []
         for b in new_bloblist:
             if not is_child_path(self.offset, b['filename']):
                 continue
@@ -143,12 +304,12 @@ class Workdir:
             target_abspath = os.path.join(self.root, target_wdpath)
             if not os.path.exists(target_abspath) or self.cached_md5sum(target_wdpath) != b['md5sum']:
                 print >>log, "Updating:", b['filename']
-                try:
-                    fetch_blob(front, b['md5sum'], target_abspath, overwrite = True)
-                except (IOError, OSError), e:
-                    print >>log, "Could not update file %s: %s" % (b['filename'], e.strerror)
-                    if not ignore_errors:
-                        raise UserError("Errors during update - update aborted")
+                fetches.append((b, target_abspath))
+        for b, target_abspath, error in self.__fetch_blobs(front, fetches, overwrite = True):
+            if error:
+                print >>log, "Could not update file %s: %s" % (b['filename'], error.strerror)
+                if not ignore_errors:
+                    raise UserError("Errors during update - update aborted")
         for b in old_bloblist:
             if not is_child_path(self.offset, b['filename']):
                 continue
@@ -166,6 +327,7 @@ class Workdir:
         self.bloblist_csums = None
         self.tree = None
         self.write_metadata()
+        self.__remove_partial_dir()
         print >>log, "Workdir now at revision", self.revision
 
     def checkin(self, write_meta = True, force_primary_session = False, \
@@ -209,30 +371,48 @@ class Workdir:
         new snapshot will be created as a modification of the snapshot
         given in the 'base_snapshot' argument."""
 
-        for f in files:
-            # A little hackish to store up the md5sums in one sweep
-            # before starting to check them in. An attempt to reduce
-            # the chance that the file is in disk cache when we read
-            # it again for check-in later. (To avoid the problem that
-            # a corrupted disk read is cached and not detected) TODO:
-            # This is really a broken way to do it, and it should be
-            # replaced with proper system-calls to read the file raw
-            # from disk. But that's complicated.
-            self.cached_md5sum(strip_path_offset(self.offset, f))
+        # A little hackish to store up the md5sums in one sweep
+        # before starting to check them in. An attempt to reduce
+        # the chance that the file is in disk cache when we read
+        # it again for check-in later. (To avoid the problem that
+        # a corrupted disk read is cached and not detected) TODO:
+        # This is really a broken way to do it, and it should be
+        # replaced with proper system-calls to read the file raw
+        # from disk. But that's complicated.
+        self.prefetch_md5sums([strip_path_offset(self.offset, f) for f in files])
 
         try:
             front.create_session(session_name = self.sessionName, base_session = base_snapshot)
         except FileMutex.MutexLocked, e:
             raise UserError("The session '%s' is in use (lockfile %s)" % (self.sessionName, e.mutex_file))
 
-        for sessionpath in files:
-            wd_path = strip_path_offset(self.offset, sessionpath)
-            expected_md5sum = self.cached_md5sum(wd_path)
-            abspath = self.abspath(sessionpath)
-            check_in_file(front, abspath, sessionpath, expected_md5sum, log = self.output)
-
-        for f in deleted_files:
-            front.remove(f)
+        start_time = time.time()
+        bytes_added = 0
+        # Round trips are expensive for remote repositories, so the
+        # blobs are looked up, and the files added, in batches.
+        for batch_start in range(0, len(files), BATCH_SIZE):
+            batch = files[batch_start:batch_start + BATCH_SIZE]
+            expected_md5sums = [self.cached_md5sum(strip_path_offset(self.offset, sessionpath))
+                                for sessionpath in batch]
+            unique_md5sums = list(set(expected_md5sums))
+            existing_blobs = set([md5 for md5, exists in \
+                                      zip(unique_md5sums, front.has_blobs(unique_md5sums)) if exists])
+            blobinfos = []
+            for sessionpath, expected_md5sum in zip(batch, expected_md5sums):
+                abspath = self.abspath(sessionpath)
+                blobinfos.append(create_blobinfo(abspath, sessionpath, expected_md5sum))
+                self.output.write("Checking in %s => %s\n" % (abspath, sessionpath))
+                if expected_md5sum not in existing_blobs:
+                    bytes_added += add_blob_file(front, abspath, expected_md5sum)
+                    existing_blobs.add(expected_md5sum)
+            front.add_many(blobinfos)
+        if bytes_added > 0:
+            elapsed = max(time.time() - start_time, 0.001)
+            self.output.write("Transferred %.1f MB in %.1f seconds (%.1f MB/s)\n" % \
+                                  (bytes_added / 2.0**20, elapsed, bytes_added / 2.0**20 / elapsed))
+
+        for batch_start in range(0, len(deleted_files), BATCH_SIZE):
+            front.remove_many(deleted_files[batch_start:batch_start + BATCH_SIZE])
 
         session_info = {}
         session_info["name"] = self.sessionName
@@ -242,6 +422,7 @@ class Workdir:
             assert type(log_message) == unicode, "Log message must be in unicode"
             session_info["log_message"] = log_message
         self.revision = front.commit(session_info)
+        self.commit_stats = front.get_commit_stats()
         self.blobinfos = None # Force reload of blobinfos
         return self.revision
 
@@ -313,13 +494,28 @@ class Workdir:
     def cached_md5sum(self, relative_path):
         assert not os.path.isabs(relative_path), "Path must be relative to the workdir. Was: "+relative_path
         abspath = self.wd_abspath(relative_path)
-        stat = os.stat(abspath)
-        key = relative_path.encode("utf-8") + "!" + str(int(stat.st_mtime))
-        if key in self.md5cache:
-            return self.md5cache[key]
-        csum = md5sum_file(abspath)
-        self.md5cache[key] = csum
-        return self.md5cache[key]
+        st = os.stat(abspath)
+        csum = self.statcache.lookup(relative_path, st)
+        if csum == None:
+            csum = md5sum_file(abspath)
+            self.statcache.record(relative_path, st, csum)
+        return csum
+
+    def prefetch_md5sums(self, relative_paths):
+        """Makes sure that the md5sums of all the given files are in
+        the cache. Any missing checksums are calculated using the
+        number of parallel jobs given by set_jobs()."""
+        missing = {}
+        for relative_path in relative_paths:
+            assert not os.path.isabs(relative_path), "Path must be relative to the workdir. Was: "+relative_path
+            abspath = self.wd_abspath(relative_path)
+            st = os.stat(abspath)
+            if self.statcache.lookup(relative_path, st) == None:
+                missing[abspath] = (relative_path, st)
+        for abspath, csum in md5sum_files(missing.keys(), self.jobs):
+            relative_path, st = missing[abspath]
+            self.statcache.record(relative_path, st, csum)
+        self.statcache.save()
 
     def wd_abspath(self, wd_path):
         """Transforms the given workdir path into a system absolute
@@ -345,15 +541,30 @@ class Workdir:
             new files, modified files, deleted files, ignored
             files. """
         front = self.get_front()
-        self.__reload_tree()
+        changed_files = self.__reload_tree_from_journal()
         existing_files_list = copy.copy(self.tree)
         prefix = ""
         if self.offset:
             prefix = self.offset + "/"
         filelist = {}
+        self.statcache.compact(existing_files_list)
+        if changed_files == None:
+            self.prefetch_md5sums(existing_files_list)
+        else:
+            # Files that are not in the journal are known to be unchanged
+            self.prefetch_md5sums([fn for fn in existing_files_list \
+                                       if fn in changed_files or self.statcache.get(fn) == None])
+        # Only now is it safe to trust the stat cache for files that
+        # are not in the journal from this position on
+        self.__commit_watch_baseline()
         for fn in existing_files_list:
             f = prefix + fn
-            filelist[f] = self.cached_md5sum(fn)
+            csum = None
+            if changed_files != None and fn not in changed_files:
+                csum = self.statcache.get(fn)
+            if csum == None:
+                csum = self.cached_md5sum(fn)
+            filelist[f] = csum
             assert not is_windows_path(f), "Was:" + f
             assert not os.path.isabs(f)
         
@@ -373,13 +584,19 @@ class Workdir:
 
         ignore_patterns = front.get_session_ignore_list(self.sessionName)
         include_patterns = front.get_session_include_list(self.sessionName)
+        # Modifications of committed files that are now ignored are
+        # ignored as well
         ignored_files = ()
         if include_patterns: # optimization
-            ignored_files = tuple([fn for fn in new_files if not fnmatch_multi(include_patterns, fn)])
-            new_files = tuple([fn for fn in new_files if fn not in ignored_files])
+            ignored_files = tuple([fn for fn in new_files + modified_files \
+                                       if not fnmatch_multi(include_patterns, fn)])
         if ignore_patterns: # optimization
-            ignored_files += tuple([fn for fn in new_files if fnmatch_multi(ignore_patterns, fn)])
-            new_files = tuple([fn for fn in new_files if fn not in ignored_files])
+            ignored_files += tuple([fn for fn in new_files + modified_files \
+                                        if fn not in ignored_files and fnmatch_multi(ignore_patterns, fn)])
+        if ignored_files:
+            ignored_set = set(ignored_files)
+            new_files = tuple([fn for fn in new_files if fn not in ignored_set])
+            modified_files = tuple([fn for fn in modified_files if fn not in ignored_set])
 
         if self.revision == None:
             assert not unchanged_files
@@ -400,26 +617,79 @@ def check_in_file(sessionwriter, abspath, sessionpath, expected_md5sum, log = Fa
     "sessionpath". The md5sum of the file has to be provided. The
     checksum is compared to the file while it is read, to ensure it is
     consistent."""
-    assert os.path.isabs(abspath), \
-        "abspath must be absolute. Was: '%s'" % (path)
-    assert ".." not in sessionpath.split("/"), \
-           "'..' not allowed in paths or filenames. Was: " + sessionpath
-    assert "\\" not in sessionpath, "Was: '%s'" % (path)
-    assert os.path.exists(abspath), "Tried to check in file that does not exist: " + abspath
     blobinfo = create_blobinfo(abspath, sessionpath, expected_md5sum)
     log.write("Checking in %s => %s\n" % (abspath, sessionpath))
+    bytes_added = 0
     if not sessionwriter.has_blob(expected_md5sum):
+        bytes_added = add_blob_file(sessionwriter, abspath, expected_md5sum)
+    sessionwriter.add(blobinfo)
+    return bytes_added
+
+def add_blob_file(sessionwriter, abspath, expected_md5sum):
+    """ Adds the contents of the file found at the given "abspath" as
+    a new blob to the active "sessionwriter". The checksum is compared
+    to the file while it is read. Returns the number of bytes
+    added."""
+    assert os.path.isabs(abspath), \
+        "abspath must be absolute. Was: '%s'" % (abspath)
+    assert os.path.exists(abspath), "Tried to check in file that does not exist: " + abspath
+    bytes_added = 0
+    if isinstance(sessionwriter, Front):
+        # Local repository - no need for base64 encoding
+        with open_raw(abspath) as f:
+            datasource = FileDataSource(f, os.fstat(f.fileno()).st_size)
+            try:
+                bytes_added = sessionwriter.add_blob_stream(expected_md5sum, datasource)
+            except AddException:
+                raise AssertionError("File changed during checkin process: " + abspath)
+    elif getattr(sessionwriter, "isRemote", False):
+        # Remote repository - the data is sent as a binary payload
+        with open_raw(abspath) as f:
+            datasource = ChecksummingDataSource(FileDataSource(f, os.fstat(f.fileno()).st_size))
+            try:
+                bytes_added = sessionwriter.add_blob_stream(expected_md5sum, datasource)
+            except RPCFault:
+                if datasource.bytes_left() == 0 and datasource.hexdigest() != expected_md5sum:
+                    raise AssertionError("File changed during checkin process: " + abspath)
+                raise
+    else:
         with open_raw(abspath) as f:
             m = hashlib.md5()
             while True:
                 data = f.read(1048576) # 1048576 = 2^20
                 m.update(data)
                 sessionwriter.add_blob_data(expected_md5sum, b64encode(data))
+                bytes_added += len(data)
                 if data == "":
                     assert m.hexdigest() == expected_md5sum, \
-                        "File changed during checkin process: " + path
+                        "File changed during checkin process: " + abspath
                     break
-    sessionwriter.add(blobinfo)
+    return bytes_added
+
+class ChecksummingDataSource(DataSource):
+    """Passes on the data of another data source, while calculating
+    the md5sum of it."""
+    def __init__(self, datasource):
+        self.datasource = datasource
+        self.summer = hashlib.md5()
+
+    def bytes_left(self):
+        return self.datasource.bytes_left()
+
+    def read(self, n = None):
+        data = self.datasource.read(n)
+        self.summer.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.summer.hexdigest()
+
+def remove_old_md5cache(metadir):
+    """Removes the dbm based checksum cache used by earlier versions.
+    It has been replaced by the stat cache."""
+    for filename in os.listdir(metadir):
+        if filename.startswith("md5sumcache"):
+            os.remove(os.path.join(metadir, filename))
 
 def init_workdir(path):
     """ Tries to find a workdir root directory at the given path or
@@ -478,6 +748,9 @@ def init_repo_from_meta(path):
 
 def create_blobinfo(abspath, sessionpath, md5sum):
     assert is_md5sum(md5sum)
+    assert ".." not in sessionpath.split("/"), \
+           "'..' not allowed in paths or filenames. Was: " + sessionpath
+    assert "\\" not in sessionpath, "Was: '%s'" % (sessionpath)
     assert sessionpath == convert_win_path_to_unix(sessionpath), \
         "Session path not valid: " + sessionpath
     st = os.lstat(abspath)
@@ -489,28 +762,172 @@ def create_blobinfo(abspath, sessionpath, md5sum):
     blobinfo["size"] = st[stat.ST_SIZE]
     return blobinfo
 
-def fetch_blob(front, blobname, target_path, overwrite = False):
+def fetch_blob(front, blobname, target_path, overwrite = False, partial_dir = None, hardlink = False):
+    """ Writes the contents of the given blob to target_path. If a
+    partial_dir is given, the blob is downloaded to a file in that
+    dir, which is kept if the download is interrupted. The next fetch
+    of the same blob will then continue where the last one stopped,
+    if the already downloaded data is found to be correct.
+
+    Blobs in a local repository are copied by the operating system
+    instead, or hard linked if hardlink is True. """
     assert overwrite or not os.path.exists(target_path)
-    target_dir = os.path.dirname(target_path)
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
+    target_dir = create_parent_dir(target_path)
+    if isinstance(front, Front):
+        blob_path = front.get_raw_blob_path(blobname)
+        if blob_path:
+            copy_local_blob(blob_path, target_path, overwrite = overwrite, hardlink = hardlink)
+            return
     size = front.get_blob_size(blobname)
+    summer = hashlib.md5()
     offset = 0
-    datareader = front.get_blob(blobname)
-    assert datareader
-    if overwrite and os.path.exists(target_path):
-        # TODO: some kind of garbage bin instead of deletion
-        os.remove(target_path)
+    if partial_dir:
+        tmpfile = os.path.join(partial_dir, blobname + ".partial")
+        if os.path.exists(tmpfile):
+            with open_raw(tmpfile) as f:
+                while offset < size:
+                    data = f.read(min(2**16, size - offset))
+                    if not data:
+                        break
+                    summer.update(data)
+                    offset += len(data)
+            if offset > 0 and front.get_blob_prefix_md5(blobname, offset) != summer.hexdigest():
+                summer = hashlib.md5()
+                offset = 0
+        f = open(tmpfile, "r+b" if offset > 0 else "wb")
+    else:
+        tmpfile_fd, tmpfile = tempfile.mkstemp(dir = target_dir)
+        f = os.fdopen(tmpfile_fd, "wb")
+    completed = False
+    try:
+        with f:
+            f.seek(offset)
+            f.truncate()
+            datareader = front.get_blob(blobname, offset)
+            assert datareader
+            while datareader.bytes_left() > 0:
+                data = datareader.read(2**16)
+                summer.update(data)
+                f.write(data)
+        completed = True
+        assert summer.hexdigest() == blobname, \
+            "Downloaded data did not match the expected checksum " + blobname
+        if overwrite and os.path.exists(target_path):
+            # TODO: some kind of garbage bin instead of deletion
+            os.remove(target_path)
+        shutil.move(tmpfile, target_path)
+    finally:
+        if os.path.exists(tmpfile) and (completed or not partial_dir):
+            os.remove(tmpfile)
+
+def fetch_blob_copies(front, blobname, target_paths, overwrite = False, partial_dir = None,
+                      hardlink = False):
+    """ Writes the contents of the given blob to all the given paths,
+    but only fetches it once from a remote repository. Returns a list
+    with the error for each path, which is the EnvironmentError that
+    prevented the file from being written, or None. """
+    errors = []
+    source_path = None
+    for target_path in target_paths:
+        try:
+            if source_path:
+                copy_fetched_file(source_path, target_path, overwrite = overwrite)
+            else:
+                fetch_blob(front, blobname, target_path, overwrite = overwrite, partial_dir = partial_dir,
+                           hardlink = hardlink)
+                if not isinstance(front, Front):
+                    source_path = target_path
+            errors.append(None)
+        except EnvironmentError, e:
+            errors.append(e)
+    return errors
+
+def copy_fetched_file(source_path, target_path, overwrite = False):
+    assert overwrite or not os.path.exists(target_path)
+    target_dir = create_parent_dir(target_path)
     tmpfile_fd, tmpfile = tempfile.mkstemp(dir = target_dir)
     try:
         with os.fdopen(tmpfile_fd, "wb") as f:
-            while datareader.bytes_left() > 0:
-                f.write(datareader.read(2**14))
+            fastcopy.copy_file(source_path, f)
+        if overwrite and os.path.exists(target_path):
+            os.remove(target_path)
         os.rename(tmpfile, target_path)
     finally:
         if os.path.exists(tmpfile):
             os.remove(tmpfile)
 
+def copy_local_blob(blob_path, target_path, overwrite = False, hardlink = False):
+    """ Writes the blob file at the given path in a local repository
+    to target_path. If hardlink is True, and the target is on the
+    same file system as the repository, the target is made a read
+    only hard link to the blob file. """
+    if not hardlink or not hasattr(os, "link"):
+        copy_fetched_file(blob_path, target_path, overwrite = overwrite)
+        return
+    target_dir = create_parent_dir(target_path)
+    tmpfile = tempfile.mktemp(dir = target_dir)
+    try:
+        os.link(blob_path, tmpfile)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        copy_fetched_file(blob_path, target_path, overwrite = overwrite)
+        return
+    try:
+        os.chmod(tmpfile, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        if overwrite and os.path.exists(target_path):
+            os.remove(target_path)
+        os.rename(tmpfile, target_path)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+def create_parent_dir(path):
+    """ Creates the parent dir of the given path, if it does not
+    exist, and returns it. Safe to call from several threads at
+    once. """
+    parent_dir = os.path.dirname(path)
+    if not os.path.exists(parent_dir):
+        try:
+            os.makedirs(parent_dir)
+        except OSError:
+            if not os.path.isdir(parent_dir):
+                raise
+    return parent_dir
+
+class FetchProgress:
+    """ Reports the progress of a checkout or update to the given
+    output, at most once per interval. """
+    def __init__(self, output, total_files, total_bytes, interval = 5.0):
+        self.output = output
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def __rate(self, now):
+        return self.bytes / 2.0**20 / max(now - self.start_time, 0.001)
+
+    def file_done(self, size):
+        self.files += 1
+        self.bytes += size
+        now = time.time()
+        if now - self.last_report >= self.interval and self.files < self.total_files:
+            self.last_report = now
+            self.output.write("Fetched %s of %s files, %.1f of %.1f MB (%.1f MB/s)\n" % \
+                                  (self.files, self.total_files, self.bytes / 2.0**20,
+                                   self.total_bytes / 2.0**20, self.__rate(now)))
+
+    def finish(self):
+        if self.files == 0:
+            return
+        now = time.time()
+        self.output.write("Fetched %s files, %.1f MB in %.1f seconds (%.1f MB/s)\n" % \
+                              (self.files, self.bytes / 2.0**20, now - self.start_time, self.__rate(now)))
+
 def bloblist_to_dict(bloblist):
     d = {}
     for b in bloblist: